@@ -0,0 +1,123 @@
+"""بنچمارک مسیریابی دکمه‌ها (user-023)
+
+زمان پیدا کردن اجرا کننده یک callback query با check_update روی فهرست اجرا کننده‌های
+هر وضعیت: زنجیره regex نسخه پیش از user-023 در برابر CallbackRouter درخت کاری فعلی.
+پیش از اندازه‌گیری بررسی می‌شود که هر داده دکمه در هر دو نسخه به همان متد برسد.
+
+    python bench/callback_router.py [revision]
+"""
+import functools
+import sys
+import time
+import warnings
+
+from telegram import CallbackQuery, Update, User
+from telegram.ext import Application, ConversationHandler
+
+from common import load_revision, workdir
+
+import shopbot
+
+BASELINE = "user-023~1"
+UPDATES = 50000
+USER = User(1, "u", False)
+# (وضعیت، داده قدیمی، داده جدید)
+CASES = [
+    (shopbot.SELECTING_ACTION, "products", "products"),
+    (shopbot.SELECTING_ACTION, "product_mafia", "product:mafia"),
+    (shopbot.SELECTING_ACTION, "pay_mafia", "pay:mafia"),
+    (shopbot.SELECTING_ACTION, "manage_products", "manage_products"),
+    (shopbot.ADMIN_ACTIONS, "orders_filter_status", "orders_filter:status"),
+    (shopbot.ADMIN_ACTIONS, "orders_older_5", "orders_page:older:5"),
+    (shopbot.ADMIN_ACTIONS, "confirm_5", "confirm:5"),
+    (shopbot.ADMIN_ACTIONS, "delete_5", "delete:5"),
+    (shopbot.ADMIN_ACTIONS, "view_orders", "view_orders"),
+    (shopbot.ADMIN_MANAGE_PRODUCTS, "edit_mafia", "edit:mafia"),
+    (shopbot.ADMIN_MANAGE_PRODUCTS, "edit_product", "edit_product"),
+    (shopbot.ADMIN_MANAGE_PRODUCTS, "remove_mafia", "remove:mafia"),
+    (shopbot.ADMIN_MANAGE_PRODUCTS, "admin", "admin"),
+    (shopbot.WALLET_ACTIONS, "confirm_convert_300", "confirm_convert:300"),
+    (shopbot.WALLET_ACTIONS, "transaction_history", "transaction_history"),
+    (shopbot.WALLET_ACTIONS, "transaction_history_older_9", "transaction_history:older:9"),
+    (shopbot.AVATAR_SELECTION, "select_avatar_ghost", "select_avatar:ghost"),
+    (shopbot.AVATAR_SELECTION, "locked_avatar", "locked_avatar"),
+]
+# داده‌های ترکیبی برای اندازه‌گیری در بزرگ‌ترین وضعیت‌ها
+MIXES = {
+    shopbot.SELECTING_ACTION: (
+        ["products", "pay_mafia", "manage_products", "leaderboard"],
+        ["products", "pay:mafia", "manage_products", "leaderboard"],
+    ),
+    shopbot.ADMIN_ACTIONS: (
+        ["view_orders", "confirm_12", "manage_products", "orders_older_9"],
+        ["view_orders", "confirm:12", "manage_products", "orders_page:older:9"],
+    ),
+}
+
+
+def update(data: str) -> Update:
+    return Update(1, callback_query=CallbackQuery("1", USER, "x", data=data))
+
+
+@functools.lru_cache(maxsize=None)
+def conversations(module) -> list:
+    builder = Application.builder().token("123:abc")
+    if hasattr(module, "SQLitePersistence"):
+        # گفتگوهای ماندگار بدون persistence ثبت نمی‌شوند
+        builder = builder.persistence(module.SQLitePersistence())
+    application = builder.build()
+    module.ShopBot().setup_handlers(application)
+    return [h for h in application.handlers[0] if isinstance(h, ConversationHandler)]
+
+
+def state_handlers(module, state) -> list:
+    """فهرست اجرا کننده‌های وضعیت در همه گفتگوها، بزرگ‌ترین فهرست اول"""
+    lists = [c.states[state] for c in conversations(module) if state in c.states]
+    return sorted(lists, key=len, reverse=True)
+
+
+def resolve(lists: list, data: str):
+    """نام متدی که داده دکمه به آن می‌رسد"""
+    candidate = update(data)
+    for handlers in lists:
+        for handler in handlers:
+            if handler.check_update(candidate) not in (None, False):
+                callback = handler.callback
+                if callback.__name__ == "dispatch":
+                    callback = callback.__self__.routes[data.partition(":")[0]]
+                return callback.__name__
+    return None
+
+
+def lookup_cost(handlers: list, datas: list) -> float:
+    updates = [update(data) for data in datas]
+    started = time.perf_counter()
+    for i in range(UPDATES):
+        candidate = updates[i & 3]
+        for handler in handlers:
+            if handler.check_update(candidate) not in (None, False):
+                break
+    return (time.perf_counter() - started) / UPDATES * 1e6
+
+
+def main() -> None:
+    baseline = load_revision(sys.argv[1] if len(sys.argv) > 1 else BASELINE)
+    for state, old_data, new_data in CASES:
+        old = resolve(state_handlers(baseline, state), old_data)
+        new = resolve(state_handlers(shopbot, state), new_data)
+        assert old == new, (old_data, old, new)
+    print(f"routing equivalent for {len(CASES)} callback values")
+
+    for state, (old_datas, new_datas) in MIXES.items():
+        for label, module, datas in (("regex chain", baseline, old_datas), ("router", shopbot, new_datas)):
+            handlers = state_handlers(module, state)[0]
+            print(
+                f"  state {state:3d} {label:12s} {lookup_cost(handlers, datas):6.2f} us/update "
+                f"over {len(handlers)} handlers"
+            )
+
+
+if __name__ == "__main__":
+    warnings.filterwarnings("ignore", message="If 'per_message=False'")
+    with workdir():
+        main()
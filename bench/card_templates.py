@@ -0,0 +1,54 @@
+"""بنچمارک لایه‌های ثابت کارت‌ها (user-007)
+
+زمان render_card (رسم + کدگذاری) برای هر نوع کارت در چند نسخه از shopbot.py.
+پیش‌فرض: نسخه پیش از user-007، خود user-007 و درخت کاری فعلی.
+
+    python bench/card_templates.py [revision ...]
+"""
+import sys
+import time
+
+from common import load_revision, workdir
+
+import shopbot
+
+RENDERS = 200
+REVISIONS = ["user-007~1", "user-007"]
+SPECS = {
+    "wallet": {"balance": 0.001, "coins": 120},
+    "referral": {"referral_code": "ABC", "referral_count": 3},
+    "profile": {
+        "user_id": 1, "username": "u", "coins": 5, "join_date": "2024", "avatar": "x",
+        "dark_mode": True, "level": "a", "progress": 40,
+    },
+    "leaderboard": {"leaderboard": [["a", 5]] * 5, "user_rank": 3},
+    "invoice": {"order_details": [["k", "v"]] * 8},
+}
+
+
+def timings(module) -> dict:
+    result = {}
+    for kind, spec in SPECS.items():
+        module.render_card(kind, spec)
+        started = time.perf_counter()
+        for _ in range(RENDERS):
+            module.render_card(kind, spec)
+        result[kind] = (time.perf_counter() - started) / RENDERS * 1000
+    return result
+
+
+def main() -> None:
+    revisions = sys.argv[1:] or REVISIONS
+    columns = [(revision, load_revision(revision, f"shopbot_{i}")) for i, revision in enumerate(revisions)]
+    columns.append(("worktree", shopbot))
+    results = [(label, timings(module)) for label, module in columns]
+
+    print(f"ms per render_card, {RENDERS} renders each")
+    print("card         " + "".join(f"{label:>14s}" for label, _ in results))
+    for kind in SPECS:
+        print(f"{kind:12s} " + "".join(f"{result[kind]:14.2f}" for _, result in results))
+
+
+if __name__ == "__main__":
+    with workdir():
+        main()
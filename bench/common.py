@@ -0,0 +1,86 @@
+"""ابزارهای مشترک اسکریپت‌های بنچمارک
+
+هر اسکریپت از ریشه مخزن اجرا می‌شود، مثلاً: python bench/db_pool.py
+دیتابیس‌ها در یک پوشه موقت ساخته می‌شوند تا فایل‌های data/ مخزن دست نخورند.
+"""
+import asyncio
+import contextlib
+import importlib.util
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+@contextlib.contextmanager
+def workdir():
+    """اجرا داخل یک پوشه موقت"""
+    previous = os.getcwd()
+    with tempfile.TemporaryDirectory() as path:
+        os.chdir(path)
+        try:
+            yield path
+        finally:
+            os.chdir(previous)
+
+
+def resolve_revision(revision: str) -> str:
+    """تبدیل شناسه درخواست (مثلاً user-007 یا user-007~1) به commit همان درخواست در تاریخچه"""
+    match = re.fullmatch(r"(user-\d+)(.*)", revision)
+    if match is None:
+        return revision
+    commits = subprocess.run(
+        ["git", "-C", ROOT, "log", "--reverse", "--format=%H", f"--grep=^\\[{match.group(1)}\\]"],
+        check=True, capture_output=True, text=True,
+    ).stdout.split()
+    if not commits:
+        raise SystemExit(f"commit درخواست {match.group(1)} پیدا نشد")
+    # قدیمی‌ترین commit با این برچسب خود درخواست است؛ بقیه اصلاحیه‌های بعدی هستند
+    return commits[0] + match.group(2)
+
+
+def load_revision(revision: str, name: str = "shopbot_baseline"):
+    """بارگذاری shopbot.py از یک نسخه git (یا شناسه درخواست) برای مقایسه با کد فعلی"""
+    source = subprocess.run(
+        ["git", "-C", ROOT, "show", f"{resolve_revision(revision)}:shopbot.py"],
+        check=True, capture_output=True, text=True,
+    ).stdout
+    path = os.path.join(tempfile.mkdtemp(), f"{name}.py")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(source)
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def run(coro, *modules):
+    """اجرای کوروتین و بستن استخرهای اتصال ماژول‌ها روی همان حلقه"""
+    async def wrapped():
+        try:
+            return await coro
+        finally:
+            for module in modules:
+                database = getattr(module, "Database", None)
+                if database is not None and hasattr(database, "close_all"):
+                    await database.close_all()
+    return asyncio.run(wrapped())
+
+
+def per_op(elapsed: float, count: int) -> str:
+    return f"{elapsed / count * 1e6:8.1f} us/op"
+
+
+class Timer:
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
@@ -0,0 +1,78 @@
+"""بنچمارک استخر اتصال (user-001)
+
+مقایسه الگوی قبلی (یک aiosqlite.connect برای هر کوئری) با Database که اتصالات
+نویسنده و خواننده را برای کل عمر ربات باز نگه می‌دارد.
+
+    python bench/db_pool.py
+"""
+import asyncio
+import random
+
+import aiosqlite
+
+from common import Timer, per_op, run, workdir
+
+import shopbot as sb
+
+USERS = 1000
+READS = 2000
+WRITES = 500
+CONCURRENCY = 50
+
+
+async def setup() -> str:
+    async with sb.Database.transaction(sb.COINS_DB_PATH) as db:
+        await db.execute("CREATE TABLE IF NOT EXISTS bench_coins (user_id INTEGER PRIMARY KEY, coins INTEGER)")
+        await db.executemany(
+            "INSERT INTO bench_coins (user_id, coins) VALUES (?, ?)",
+            [(i, random.randint(0, 5000)) for i in range(USERS)]
+        )
+    return sb.Database.resolve(sb.COINS_DB_PATH)
+
+
+async def gather_limited(factory, count: int) -> None:
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    async def one(i):
+        async with semaphore:
+            await factory(i)
+    await asyncio.gather(*(one(i) for i in range(count)))
+
+
+async def main() -> None:
+    path = await setup()
+
+    async def connect_read(i):
+        async with aiosqlite.connect(path) as db:
+            async with db.execute("SELECT coins FROM bench_coins WHERE user_id = ?", (i % USERS,)) as cursor:
+                await cursor.fetchone()
+
+    async def pooled_read(i):
+        await sb.Database.fetchone(sb.COINS_DB_PATH, "SELECT coins FROM bench_coins WHERE user_id = ?", (i % USERS,))
+
+    async def connect_write(i):
+        async with aiosqlite.connect(path) as db:
+            await db.execute("UPDATE bench_coins SET coins = coins + 1 WHERE user_id = ?", (i % USERS,))
+            await db.commit()
+
+    async def pooled_write(i):
+        await sb.Database.execute(sb.COINS_DB_PATH, "UPDATE bench_coins SET coins = coins + 1 WHERE user_id = ?", (i % USERS,))
+
+    print(f"{READS} point reads, {CONCURRENCY} in flight")
+    for label, factory in (("connect per query", connect_read), ("pooled", pooled_read)):
+        with Timer() as t:
+            await gather_limited(factory, READS)
+        print(f"  {label:18s} {per_op(t.elapsed, READS)}")
+
+    # الگوی قبلی زیر نوشتن همزمان با database is locked شکست می‌خورد؛ نوشتن‌ها پشت سر هم اجرا می‌شوند
+    print(f"{WRITES} single-row writes, sequential")
+    for label, factory in (("connect per query", connect_write), ("pooled", pooled_write)):
+        with Timer() as t:
+            for i in range(WRITES):
+                await factory(i)
+        print(f"  {label:18s} {per_op(t.elapsed, WRITES)}")
+
+
+if __name__ == "__main__":
+    with workdir():
+        run(main(), sb)
@@ -0,0 +1,91 @@
+"""بنچمارک نمای جدول رتبه‌بندی (user-016)
+
+تعداد نوشتن و خواندن دیتابیس و زمان هر بازدید جدول رتبه‌بندی
+(get_leaderboard + get_user_rank) با ۲۰ هزار کاربر. پیش‌فرض: نسخه پیش از user-015،
+نسخه پیش از user-016 و درخت کاری فعلی.
+
+    python bench/leaderboard.py [revision ...]
+"""
+import asyncio
+import random
+import sys
+
+from common import Timer, load_revision, run, workdir
+
+import shopbot
+
+USERS = 20000
+BASELINES = ["user-015~1", "user-016~1"]
+
+
+async def measure(sb, label: str) -> None:
+    await sb.CoinManager.init_db()
+    await sb.Database.execute(
+        sb.USERS_DB_PATH, "CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, full_name TEXT)"
+    )
+    random.seed(1)
+    async with sb.Database.transaction(sb.COINS_DB_PATH) as db:
+        await db.executemany(
+            "INSERT INTO user_coins (user_id, coins) VALUES (?, ?)",
+            [(i, random.randint(0, 5000)) for i in range(USERS)]
+        )
+    if hasattr(sb, "coin_ranking"):
+        await sb.coin_ranking.load()
+    if hasattr(sb, "leaderboard_snapshot"):
+        await sb.leaderboard_snapshot.refresh()
+
+    # شمارش مراجعه‌ها به دیتابیس با پوشاندن متدهای Database
+    counts = {"writes": 0, "reads": 0}
+    database = sb.Database
+    execute, transaction, fetchone, fetchall = (
+        database.execute, database.transaction, database.fetchone, database.fetchall
+    )
+
+    async def counted_execute(*args, **kwargs):
+        counts["writes"] += 1
+        return await execute(*args, **kwargs)
+
+    def counted_transaction(*args, **kwargs):
+        counts["writes"] += 1
+        return transaction(*args, **kwargs)
+
+    async def counted_fetchone(*args, **kwargs):
+        counts["reads"] += 1
+        return await fetchone(*args, **kwargs)
+
+    async def counted_fetchall(*args, **kwargs):
+        counts["reads"] += 1
+        return await fetchall(*args, **kwargs)
+
+    database.execute, database.transaction = counted_execute, counted_transaction
+    database.fetchone, database.fetchall = counted_fetchone, counted_fetchall
+    try:
+        for views in (100, 1000):
+            counts.update(writes=0, reads=0)
+
+            async def view(user_id):
+                await sb.CoinManager.get_leaderboard()
+                await sb.CoinManager.get_user_rank(user_id)
+
+            with Timer() as t:
+                await asyncio.gather(*(view(i) for i in range(views)))
+            print(
+                f"  {label:10s} views={views:5d}  writes/view={counts['writes'] / views:.2f}  "
+                f"reads/view={counts['reads'] / views:.2f}  {t.elapsed / views * 1000:.3f} ms/view"
+            )
+    finally:
+        database.execute, database.transaction = execute, transaction
+        database.fetchone, database.fetchall = fetchone, fetchall
+
+
+def main() -> None:
+    revisions = sys.argv[1:] or BASELINES
+    columns = [(revision, load_revision(revision, f"shopbot_{i}")) for i, revision in enumerate(revisions)]
+    print(f"leaderboard views over {USERS} users")
+    for label, module in columns + [("worktree", shopbot)]:
+        with workdir():
+            run(measure(module, label), module)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""بنچمارک رندر کارت‌ها در استخر پروسه (user-003)
+
+رندر روی حلقه رویداد (رفتار قبلی) در برابر RenderService. علاوه بر توان عملیاتی،
+بیشترین توقف حلقه رویداد با یک تیک ۵ میلی‌ثانیه‌ای اندازه‌گیری می‌شود؛ همین توقف
+است که پاسخ بقیه کاربران را در زمان رندر عقب می‌انداخت.
+
+    python bench/render_pool.py
+"""
+import asyncio
+import time
+
+from common import Timer, run, workdir
+
+import shopbot as sb
+
+CARDS = 48
+
+
+def spec(i: int) -> dict:
+    return {
+        "user_id": i, "username": f"user{i}", "coins": i * 7, "join_date": "2024-01-01",
+        "avatar": "🕴️ مافیا", "dark_mode": i % 2 == 0, "level": "فعال", "progress": i % 100,
+    }
+
+
+async def measure(render) -> tuple:
+    stalls = []
+    done = asyncio.Event()
+
+    async def ticker():
+        while not done.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(0.005)
+            stalls.append(time.perf_counter() - started - 0.005)
+
+    tick = asyncio.create_task(ticker())
+    await asyncio.sleep(0.02)
+    with Timer() as t:
+        await render()
+    done.set()
+    await tick
+    return CARDS / t.elapsed, max(stalls) * 1000
+
+
+async def main() -> None:
+    async def inline():
+        for i in range(CARDS):
+            sb.render_card("profile", spec(i))
+
+    service = sb.RenderService()
+    service.start()
+    # گرم کردن پروسه‌ها تا زمان spawn در نتیجه حساب نشود
+    await asyncio.gather(*(service.render("profile", spec(-i), cache=False) for i in range(1, service.workers + 1)))
+
+    async def pooled():
+        await asyncio.gather(*(service.render("profile", spec(i), cache=False) for i in range(CARDS)))
+
+    print(f"{CARDS} distinct profile cards, workers={service.workers} ({service.mode})")
+    for label, render in (("on event loop", inline), ("RenderService", pooled)):
+        rate, stall = await measure(render)
+        print(f"  {label:14s} {rate:7.1f} cards/s   worst loop stall {stall:7.1f} ms")
+    service.shutdown()
+
+
+if __name__ == "__main__":
+    with workdir():
+        run(main(), sb)
@@ -0,0 +1,84 @@
+"""بنچمارک پردازش همزمان آپدیت‌ها به تفکیک کاربر (user-024)
+
+آپدیت‌ها مانند حلقه دریافت Application به process_update داده می‌شوند: برای هر آپدیت
+یک task به ترتیب ورود. هر اجرا کننده ۵۰ میلی‌ثانیه منتظر I/O می‌ماند. در هر اجرا
+بررسی می‌شود که آپدیت‌های هر کاربر به ترتیب پردازش شده باشند.
+
+    python bench/update_processor.py
+"""
+import asyncio
+import time
+from datetime import datetime
+
+from telegram import Chat, Message, Update, User
+from telegram.ext import SimpleUpdateProcessor
+
+from common import Timer
+
+import shopbot as sb
+
+WORK = 0.05
+PER_USER = 5
+CAP = 32
+
+
+def make_update(user_id: int, update_id: int) -> Update:
+    user = User(user_id, "u", False)
+    chat = Chat(user_id, "private")
+    return Update(update_id, message=Message(update_id, datetime.now(), chat, from_user=user, text=str(update_id)))
+
+
+async def drive(processor, users: int) -> tuple:
+    seen = {}
+    active = peak = 0
+
+    async def handle(update):
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        await asyncio.sleep(WORK)
+        seen.setdefault(update.effective_user.id, []).append(update.update_id)
+        active -= 1
+
+    updates = [
+        make_update(user_id, i * 1000 + user_id) for i in range(PER_USER) for user_id in range(1, users + 1)
+    ]
+    with Timer() as t:
+        if processor.max_concurrent_updates > 1:
+            await asyncio.gather(
+                *(asyncio.create_task(processor.process_update(u, handle(u))) for u in updates)
+            )
+        else:
+            for u in updates:
+                await processor.process_update(u, handle(u))
+    for user_id, ids in seen.items():
+        assert ids == sorted(ids), f"ترتیب آپدیت‌های کاربر {user_id} به هم خورد"
+    return len(updates) / t.elapsed, peak
+
+
+async def main() -> None:
+    print(f"handler = {WORK * 1000:.0f} ms I/O wait, {PER_USER} updates per user, cap {CAP}")
+    for users in (1, 2, 4, 8, 16, 32, 64, 128):
+        # حالت پیش‌فرض ترتیبی است؛ برای تعداد زیاد کاربر فقط زمان را هدر می‌دهد
+        sequential = f"{(await drive(SimpleUpdateProcessor(1), users))[0]:7.1f}" if users <= 8 else "     - "
+        processor = sb.PerUserUpdateProcessor(max_active=CAP)
+        rate, peak = await drive(processor, users)
+        assert processor.active_users == 0 and peak <= CAP
+        print(f"  users={users:4d}  default={sequential} upd/s  per-user={rate:7.1f} upd/s  peak active={peak}")
+
+    # کاربری که پشت سر هم آپدیت می‌فرستد نباید جای بقیه را بگیرد
+    processor = sb.PerUserUpdateProcessor(max_active=4)
+    flood = [
+        asyncio.create_task(processor.process_update(make_update(1, i), asyncio.sleep(WORK)))
+        for i in range(40)
+    ]
+    await asyncio.sleep(0.01)
+    started = time.perf_counter()
+    await processor.process_update(make_update(2, 999), asyncio.sleep(WORK))
+    print(f"  other user's latency behind a 40-update flood (cap 4): {(time.perf_counter() - started) * 1000:.0f} ms")
+    await asyncio.gather(*flood)
+    assert processor.active_users == 0
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
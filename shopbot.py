@@ -20,23 +20,40 @@ import re
 import hashlib
 import aiosqlite
 from datetime import datetime, timedelta
-from typing import Dict, Optional, Tuple, List
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple, List, Union
 from PIL import Image, ImageDraw, ImageFont
 import textwrap
 import asyncio
 import io
+from functools import lru_cache
 import math
-
+import bisect
+import json
+from collections import Counter, OrderedDict, deque
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+
+import httpx
 from dotenv import load_dotenv
+import telegram
 from telegram import (
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
+    InputMediaAnimation,
     InputMediaPhoto,
+    Message,
     ReplyKeyboardRemove
 )
+from telegram.error import BadRequest
 from telegram.ext import (
     Application,
+    BasePersistence,
+    BaseUpdateProcessor,
+    PersistenceInput,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
@@ -80,15 +97,35 @@ USERS_DB_PATH = "data/users.db"
 WALLET_DB_PATH = "data/wallet.db"
 COINS_DB_PATH = "data/coins.db"
 
+# حالت ذخیره‌سازی: single (همه جداول در یک فایل) یا split (پنج فایل جداگانه)
+STORAGE_MODE = os.getenv("STORAGE_MODE", "single").lower()
+SHOP_DB_PATH = "data/shop.db"
+LEGACY_DB_PATHS = (DB_PATH, STATS_DB_PATH, USERS_DB_PATH, WALLET_DB_PATH, COINS_DB_PATH)
+
 # فونت‌های مورد استفاده
-try:
-    MONO_FONT = ImageFont.truetype("DejaVuSansMono.ttf", 14)
-    TITLE_FONT = ImageFont.truetype("DejaVuSansMono-Bold.ttf", 18)
-    DIGITAL_FONT = ImageFont.truetype("digital.ttf", 24) if os.path.exists("digital.ttf") else None
-except:
-    MONO_FONT = ImageFont.load_default()
-    TITLE_FONT = ImageFont.load_default()
-    DIGITAL_FONT = None
+FONT_FACES = {
+    "mono": "DejaVuSansMono.ttf",
+    "title": "DejaVuSansMono-Bold.ttf",
+    "digital": "digital.ttf",
+}
+
+
+@lru_cache(maxsize=32)
+def get_font(face: str, size: int) -> ImageFont.FreeTypeFont:
+    """بارگذاری هر فونت و اندازه فقط یک بار در هر پروسه"""
+    path = FONT_FACES.get(face)
+    if path:
+        try:
+            return ImageFont.truetype(path, size)
+        except OSError:
+            pass
+    return ImageFont.load_default(size=size)
+
+
+MONO_FONT = get_font("mono", 14)
+TITLE_FONT = get_font("title", 18)
+AVATAR_FONT = get_font("default", 72)
+DIGITAL_FONT = get_font("digital", 24) if os.path.exists("digital.ttf") else None
 
 HACKING_ANIMATIONS = [
     "🖥️ در حال اتصال به سرور امن...",
@@ -139,9 +176,357 @@ LOCKED_AVATARS = {
     "king": "VIP"       # نیاز به سطح VIP (701 سکه)
 }
 
+# *********************** لایه دیتابیس ***********************
+DB_READER_CONNECTIONS = int(os.getenv("DB_READER_CONNECTIONS", 4))
+
+# تنظیمات PRAGMA که فقط یک بار هنگام باز شدن هر اتصال اعمال می‌شوند
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -8000",
+    "PRAGMA mmap_size = 67108864",
+)
+
+
+class ConnectionPool:
+    """استخر اتصالات یک فایل دیتابیس: یک اتصال نویسنده و چند اتصال خواننده"""
+
+    def __init__(self, path: str, readers: int = DB_READER_CONNECTIONS):
+        self.path = path
+        self.readers = max(1, readers)
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._writer_lock = asyncio.Lock()
+        self._writer_owner: Optional[asyncio.Task] = None
+        self._idle_readers: Optional[asyncio.Queue] = None
+        self._connections: List[aiosqlite.Connection] = []
+        self._commit_hooks: List[Callable[[], None]] = []
+
+    async def open(self) -> None:
+        """باز کردن اتصالات استخر"""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._writer = await self._connect()
+        self._idle_readers = asyncio.Queue()
+        for _ in range(self.readers):
+            reader = await self._connect()
+            await reader.execute("PRAGMA query_only = ON")
+            self._idle_readers.put_nowait(reader)
+
+    async def _connect(self) -> aiosqlite.Connection:
+        """ایجاد یک اتصال جدید با تنظیمات بهینه"""
+        # تراکنش‌ها به صورت صریح با BEGIN/COMMIT مدیریت می‌شوند
+        conn = await aiosqlite.connect(self.path, isolation_level=None)
+        for pragma in SQLITE_PRAGMAS:
+            await conn.execute(pragma)
+        self._connections.append(conn)
+        return conn
+
+    async def close(self) -> None:
+        """بستن تمام اتصالات استخر"""
+        for conn in self._connections:
+            try:
+                await conn.close()
+            except Exception as e:
+                logger.error(f"خطا در بستن اتصال دیتابیس {self.path}: {e}")
+        self._connections.clear()
+        self._writer = None
+        self._idle_readers = None
+
+    @asynccontextmanager
+    async def reader(self):
+        """دریافت یک اتصال خواننده از استخر"""
+        # خواندن داخل تراکنش جاری باید تغییرات همان تراکنش را ببیند
+        if self._writer_owner is not None and self._writer_owner is asyncio.current_task():
+            yield self._writer
+            return
+
+        conn = await self._idle_readers.get()
+        try:
+            yield conn
+        finally:
+            self._idle_readers.put_nowait(conn)
+
+    def in_transaction(self) -> bool:
+        """آیا task جاری داخل تراکنش این استخر است"""
+        return self._writer_owner is not None and self._writer_owner is asyncio.current_task()
+
+    def after_commit(self, callback: Callable[[], None]) -> None:
+        """اجرای callback پس از commit تراکنش جاری (یا بلافاصله در نبود تراکنش)"""
+        if self.in_transaction():
+            self._commit_hooks.append(callback)
+        else:
+            callback()
+
+    def _run_commit_hooks(self) -> None:
+        hooks, self._commit_hooks = self._commit_hooks, []
+        for hook in hooks:
+            try:
+                hook()
+            except Exception as e:
+                logger.error(f"خطا در اجرای عملیات پس از commit: {e}")
+
+    @asynccontextmanager
+    async def transaction(self):
+        """اجرای یک تراکنش روی اتصال نویسنده"""
+        task = asyncio.current_task()
+        if self._writer_owner is task:
+            # تراکنش تودرتو در همان تراکنش بیرونی اجرا می‌شود
+            yield self._writer
+            return
+
+        async with self._writer_lock:
+            self._writer_owner = task
+            try:
+                await self._writer.execute("BEGIN IMMEDIATE")
+                try:
+                    yield self._writer
+                except BaseException:
+                    # تغییرات کش‌ها همراه تراکنش کنار گذاشته می‌شوند
+                    self._commit_hooks.clear()
+                    await self._writer.execute("ROLLBACK")
+                    raise
+                await self._writer.execute("COMMIT")
+            finally:
+                self._writer_owner = None
+            self._run_commit_hooks()
+
+
+class Database:
+    """دسترسی مشترک به استخرهای اتصال برای تمام مدیرها"""
+
+    _pools: Dict[str, ConnectionPool] = {}
+    _open_lock: Optional[asyncio.Lock] = None
+
+    @staticmethod
+    def resolve(path: str) -> str:
+        """تبدیل مسیر منطقی دیتابیس به فایل واقعی بر اساس حالت ذخیره‌سازی"""
+        if STORAGE_MODE == "single":
+            return SHOP_DB_PATH
+        return path
+
+    @classmethod
+    def shares_file(cls, *paths: str) -> bool:
+        """بررسی اینکه چند دیتابیس منطقی در یک فایل (و یک تراکنش) قرار دارند"""
+        return len({cls.resolve(path) for path in paths}) == 1
+
+    @classmethod
+    async def pool(cls, path: str) -> ConnectionPool:
+        """دریافت (و در صورت نیاز باز کردن) استخر یک فایل دیتابیس"""
+        path = cls.resolve(path)
+        pool = cls._pools.get(path)
+        if pool is not None:
+            return pool
+
+        if cls._open_lock is None:
+            cls._open_lock = asyncio.Lock()
+        async with cls._open_lock:
+            pool = cls._pools.get(path)
+            if pool is None:
+                pool = ConnectionPool(path)
+                await pool.open()
+                cls._pools[path] = pool
+        return pool
+
+    @classmethod
+    async def migrate_legacy_files(cls) -> None:
+        """انتقال یک‌باره داده‌های پنج فایل قدیمی به فایل واحد"""
+        if STORAGE_MODE != "single":
+            return
+
+        legacy_paths = [
+            path for path in LEGACY_DB_PATHS
+            if path != SHOP_DB_PATH and os.path.exists(path)
+        ]
+        if not legacy_paths:
+            return
+
+        os.makedirs(os.path.dirname(SHOP_DB_PATH), exist_ok=True)
+        async with aiosqlite.connect(SHOP_DB_PATH, isolation_level=None) as db:
+            for path in legacy_paths:
+                await db.execute("ATTACH DATABASE ? AS legacy", (path,))
+                try:
+                    await db.execute("BEGIN IMMEDIATE")
+                    try:
+                        tables = await db.execute_fetchall(
+                            """
+                            SELECT name, sql FROM legacy.sqlite_master
+                            WHERE type = 'table' AND name NOT LIKE 'sqlite_%'
+                            """
+                        )
+                        for name, sql in tables:
+                            if not await db.execute_fetchall(
+                                "SELECT 1 FROM main.sqlite_master WHERE type = 'table' AND name = ?",
+                                (name,)
+                            ):
+                                await db.execute(sql)
+
+                            main_columns = {
+                                row[1] for row in await db.execute_fetchall(f'PRAGMA main.table_info("{name}")')
+                            }
+                            columns = ", ".join(
+                                f'"{row[1]}"'
+                                for row in await db.execute_fetchall(f'PRAGMA legacy.table_info("{name}")')
+                                if row[1] in main_columns
+                            )
+                            await db.execute(
+                                f'INSERT OR IGNORE INTO main."{name}" ({columns}) '
+                                f'SELECT {columns} FROM legacy."{name}"'
+                            )
+                        await db.execute("COMMIT")
+                    except BaseException:
+                        await db.execute("ROLLBACK")
+                        raise
+                finally:
+                    await db.execute("DETACH DATABASE legacy")
+
+                # فایل قدیمی کنار گذاشته می‌شود تا انتقال دوباره انجام نشود
+                for suffix in ("", "-wal", "-shm"):
+                    if os.path.exists(path + suffix):
+                        os.replace(path + suffix, path + ".migrated" + suffix)
+                logger.info(f"داده‌های {path} به {SHOP_DB_PATH} منتقل شد")
+
+    @classmethod
+    async def close_all(cls) -> None:
+        """بستن تمام استخرها"""
+        for pool in list(cls._pools.values()):
+            await pool.close()
+        cls._pools.clear()
+
+    @classmethod
+    @asynccontextmanager
+    async def read(cls, path: str):
+        """اتصال خواندنی"""
+        pool = await cls.pool(path)
+        async with pool.reader() as db:
+            yield db
+
+    @classmethod
+    @asynccontextmanager
+    async def transaction(cls, path: str):
+        """تراکنش نوشتنی؛ در پایان بلوک commit و در صورت خطا rollback می‌شود"""
+        pool = await cls.pool(path)
+        async with pool.transaction() as db:
+            yield db
+
+    @classmethod
+    async def after_commit(cls, path: str, callback: Callable[[], None]) -> None:
+        """ثبت عملیاتی (مثل به‌روزرسانی کش) که فقط پس از commit تراکنش جاری اجرا شود"""
+        pool = await cls.pool(path)
+        pool.after_commit(callback)
+
+    @classmethod
+    def in_transaction(cls, *paths: str) -> bool:
+        """آیا task جاری داخل تراکنش یکی از دیتابیس‌ها است"""
+        for path in paths:
+            pool = cls._pools.get(cls.resolve(path))
+            if pool is not None and pool.in_transaction():
+                return True
+        return False
+
+    @classmethod
+    async def fetchone(cls, path: str, sql: str, params: tuple = ()) -> Optional[tuple]:
+        """اجرای کوئری و دریافت اولین سطر"""
+        async with cls.read(path) as db:
+            rows = await db.execute_fetchall(sql, params)
+            return rows[0] if rows else None
+
+    @classmethod
+    async def fetchall(cls, path: str, sql: str, params: tuple = ()) -> List[tuple]:
+        """اجرای کوئری و دریافت تمام سطرها"""
+        async with cls.read(path) as db:
+            return list(await db.execute_fetchall(sql, params))
+
+    @classmethod
+    async def execute(cls, path: str, sql: str, params: tuple = ()) -> int:
+        """اجرای یک دستور نوشتنی در تراکنش مستقل و بازگرداندن تعداد سطرهای تغییر یافته"""
+        async with cls.transaction(path) as db:
+            cursor = await db.execute(sql, params)
+            return cursor.rowcount
+
+# *********************** مسیریابی دکمه‌ها ***********************
+CALLBACK_DATA_MAX_BYTES = 64
+CALLBACK_SEPARATOR = ":"
+
+
+class CallbackData:
+    """قالب داده دکمه به شکل prefix:arg1:arg2 با نوع مشخص برای هر آرگومان"""
+
+    __slots__ = ("prefix", "types")
+
+    def __init__(self, prefix: str, *types: type):
+        if CALLBACK_SEPARATOR in prefix:
+            raise ValueError(f"پیشوند نامعتبر: {prefix}")
+        self.prefix = prefix
+        self.types = types
+
+    def encode(self, *args) -> str:
+        """ساخت داده دکمه؛ تلگرام بیش از ۶۴ بایت را نمی‌پذیرد"""
+        if len(args) != len(self.types):
+            raise ValueError(f"{self.prefix}: {len(self.types)} آرگومان لازم است")
+        values = [str(arg) for arg in args]
+        if any(CALLBACK_SEPARATOR in value for value in values):
+            raise ValueError(f"{self.prefix}: آرگومان شامل جداکننده است")
+        data = CALLBACK_SEPARATOR.join((self.prefix, *values))
+        if len(data.encode()) > CALLBACK_DATA_MAX_BYTES:
+            raise ValueError(f"داده دکمه بیش از {CALLBACK_DATA_MAX_BYTES} بایت است: {data}")
+        return data
+
+    def decode(self, data: str) -> tuple:
+        """استخراج آرگومان‌ها با تبدیل به نوع تعریف شده"""
+        prefix, *values = data.split(CALLBACK_SEPARATOR)
+        if prefix != self.prefix or len(values) != len(self.types):
+            raise ValueError(f"داده دکمه با قالب {self.prefix} سازگار نیست: {data}")
+        return tuple(kind(value) for kind, value in zip(self.types, values))
+
+
+PRODUCT_DETAILS = CallbackData("product", str)
+PRODUCT_PAY = CallbackData("pay", str)
+PRODUCT_EDIT = CallbackData("edit", str)
+PRODUCT_REMOVE = CallbackData("remove", str)
+TRANSACTIONS_PAGE = CallbackData("transaction_history", str, int)
+CONVERT_COINS = CallbackData("confirm_convert", int)
+AVATAR_SELECT = CallbackData("select_avatar", str)
+ORDERS_FILTER = CallbackData("orders_filter", str)
+ORDERS_PAGE = CallbackData("orders_page", str, int)
+ORDER_CONFIRM = CallbackData("confirm", int)
+ORDER_DELETE = CallbackData("delete", int)
+
+
+class CallbackRouter:
+    """ارسال دکمه‌های یک مرحله گفتگو با یک جستجوی دیکشنری به جای زنجیره الگوها"""
+
+    def __init__(self, routes: Dict[Union[str, CallbackData], Callable]):
+        self.routes: Dict[str, Callable] = {}
+        for key, callback in routes.items():
+            prefix = key.prefix if isinstance(key, CallbackData) else key
+            if CALLBACK_SEPARATOR in prefix or len(prefix.encode()) > CALLBACK_DATA_MAX_BYTES:
+                raise ValueError(f"پیشوند نامعتبر: {prefix}")
+            self.routes[prefix] = callback
+
+    def matches(self, data: object) -> bool:
+        return isinstance(data, str) and data.partition(CALLBACK_SEPARATOR)[0] in self.routes
+
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        prefix = update.callback_query.data.partition(CALLBACK_SEPARATOR)[0]
+        return await self.routes[prefix](update, context)
+
+    def handler(self) -> CallbackQueryHandler:
+        return CallbackQueryHandler(self.dispatch, pattern=self.matches)
+
 # *********************** کلاس‌های کمکی ***********************
+PRODUCT_DAILY_STOCK = 5
+RESERVATION_TTL = int(os.getenv("RESERVATION_TTL", 30 * 60))
+RESERVATION_SWEEP_INTERVAL = 60
+
+
 class Product:
-    """کلاس محصولات فروشگاه"""
+    """کلاس محصولات فروشگاه (تغییرناپذیر؛ هر ویرایش یک نسخه جدید از کاتالوگ می‌سازد)"""
+
+    __slots__ = ("key", "name", "price", "description", "features", "btc_address", "stock", "price_sats", "info")
 
     def __init__(
         self,
@@ -150,18 +535,30 @@ class Product:
         description: str,
         features: List[str],
         btc_address: str,
-        stock: int = 5  # موجودی اولیه
+        stock: int = PRODUCT_DAILY_STOCK,  # موجودی اولیه
+        key: str = "",
     ):
-        self.name = name
-        self.price = price
-        self.description = description
-        self.features = features
-        self.btc_address = btc_address
-        self.stock = stock
-        self.last_restock = datetime.now()
+        values = {
+            "key": key,
+            "name": name,
+            "price": price,
+            "description": description,
+            "features": tuple(features),
+            "btc_address": btc_address,
+            "stock": stock,
+        }
+        for field, value in values.items():
+            object.__setattr__(self, field, value)
+        
+        # قیمت به ساتوشی (از بخش BTC رشته قیمت)
+        match = re.search(r"(\d+(?:\.\d+)?)\s*BTC", price)
+        object.__setattr__(self, "price_sats", WalletManager.to_sats(float(match.group(1))) if match else 0)
+        object.__setattr__(self, "info", self._build_info())
 
-    def get_info(self) -> str:
-        """نمایش اطلاعات محصول"""
+    def __setattr__(self, name, value):
+        raise AttributeError("محصول تغییرناپذیر است؛ تغییرات از طریق کاتالوگ انجام می‌شود")
+
+    def _build_info(self) -> str:
         features = "\n".join(self.features)
         return f"""
 📦 *{self.name}*
@@ -178,13 +575,305 @@ class Product:
 `{self.btc_address}`
 """
 
-    def update_stock(self):
-        """به روزرسانی خودکار موجودی محصولات"""
-        now = datetime.now()
-        if (now - self.last_restock) >= timedelta(days=1):
-            self.stock = 5
-            self.last_restock = now
-        return self.stock
+    def get_info(self) -> str:
+        """نمایش اطلاعات محصول"""
+        return self.info
+
+
+class CatalogSnapshot:
+    """نسخه فقط-خواندنی کاتالوگ به همراه کیبوردهای آماده"""
+
+    __slots__ = ("version", "products", "list_keyboard", "detail_keyboards", "edit_keyboard", "remove_keyboard")
+
+    def __init__(self, version: int, products: Dict[str, Product]):
+        self.version = version
+        self.products = products
+        
+        # نمایش موجودی در دکمه
+        self.list_keyboard = InlineKeyboardMarkup([
+            *(
+                [InlineKeyboardButton(
+                    f"{product.name} {'🟢' if product.stock > 2 else '🟡' if product.stock > 0 else '🔴'}",
+                    callback_data=PRODUCT_DETAILS.encode(key)
+                )]
+                for key, product in products.items()
+            ),
+            [InlineKeyboardButton("🔙 بازگشت", callback_data="back")],
+        ])
+        self.detail_keyboards = {
+            key: InlineKeyboardMarkup([
+                [InlineKeyboardButton("💳 خرید محصول", callback_data=PRODUCT_PAY.encode(key))],
+                [InlineKeyboardButton("🔙 بازگشت به محصولات", callback_data="products")],
+            ])
+            for key in products
+        }
+        self.edit_keyboard = self._admin_keyboard(PRODUCT_EDIT)
+        self.remove_keyboard = self._admin_keyboard(PRODUCT_REMOVE)
+
+    def _admin_keyboard(self, action: CallbackData) -> InlineKeyboardMarkup:
+        return InlineKeyboardMarkup([
+            *([InlineKeyboardButton(product.name, callback_data=action.encode(key))] for key, product in self.products.items()),
+            [InlineKeyboardButton("🔙 بازگشت", callback_data="manage_products")],
+        ])
+
+
+class Catalog:
+    """کاتالوگ محصولات: جدول products و نمای نسخه‌دار درون‌حافظه‌ای که با هر ویرایش جایگزین می‌شود"""
+
+    def __init__(self):
+        self.snapshot = CatalogSnapshot(0, {})
+        self._reload_lock = asyncio.Lock()
+
+    @property
+    def products(self) -> Dict[str, Product]:
+        return self.snapshot.products
+
+    async def init_db(self, defaults: Dict[str, Product]) -> None:
+        """ایجاد جدول محصولات، افزودن محصولات پیش‌فرض در اولین اجرا و بارگذاری"""
+        async with Database.transaction(DB_PATH) as db:
+            await db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS products (
+                    key TEXT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    price TEXT NOT NULL,
+                    description TEXT NOT NULL,
+                    features TEXT NOT NULL DEFAULT '[]',
+                    btc_address TEXT,
+                    stock INTEGER NOT NULL DEFAULT 0,
+                    position INTEGER NOT NULL DEFAULT 0,
+                    last_restock DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+                """
+            )
+            (count,), = await db.execute_fetchall("SELECT COUNT(*) FROM products")
+            if not count:
+                await db.executemany(
+                    """
+                    INSERT INTO products (key, name, price, description, features, btc_address, stock, position)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    [
+                        (
+                            key, product.name, product.price, product.description,
+                            json.dumps(product.features, ensure_ascii=False),
+                            product.btc_address, product.stock, position,
+                        )
+                        for position, (key, product) in enumerate(defaults.items())
+                    ]
+                )
+            
+            # رزرو موجودی: held تا اتصال به سفارش یا انقضا، سپس committed یا released
+            await db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS stock_reservations (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    product_key TEXT NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'held',
+                    expires_at REAL NOT NULL,
+                    tracking_code TEXT UNIQUE,
+                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+                """
+            )
+            await db.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_reservations_expiry
+                ON stock_reservations (expires_at) WHERE status = 'held' AND tracking_code IS NULL
+                """
+            )
+            await db.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_reservations_user
+                ON stock_reservations (user_id, product_key) WHERE status = 'held'
+                """
+            )
+        await self.reload()
+
+    async def reload(self) -> None:
+        """ساخت نسخه جدید کاتالوگ از دیتابیس و جایگزینی یکجای آن"""
+        async with self._reload_lock:
+            rows = await Database.fetchall(
+                DB_PATH,
+                """
+                SELECT key, name, price, description, features, btc_address, stock
+                FROM products
+                ORDER BY position, rowid
+                """
+            )
+            products = {
+                key: Product(
+                    name=name,
+                    price=price,
+                    description=description,
+                    features=json.loads(features),
+                    btc_address=btc_address,
+                    stock=stock,
+                    key=key,
+                )
+                for key, name, price, description, features, btc_address, stock in rows
+            }
+            self.snapshot = CatalogSnapshot(self.snapshot.version + 1, products)
+
+    async def save(self, product: Product) -> None:
+        """افزودن یا جایگزینی یک محصول؛ موجودی وارد شده شامل واحدهای رزرو شده است"""
+        await Database.execute(
+            DB_PATH,
+            """
+            INSERT INTO products (key, name, price, description, features, btc_address, stock, position)
+            VALUES (
+                ?, ?, ?, ?, ?, ?,
+                MAX(0, ? - (SELECT COUNT(*) FROM stock_reservations WHERE product_key = ? AND status = 'held')),
+                (SELECT COALESCE(MAX(position), -1) + 1 FROM products)
+            )
+            ON CONFLICT(key) DO UPDATE SET
+                name = excluded.name,
+                price = excluded.price,
+                description = excluded.description,
+                features = excluded.features,
+                btc_address = excluded.btc_address,
+                stock = excluded.stock
+            """,
+            (
+                product.key, product.name, product.price, product.description,
+                json.dumps(product.features, ensure_ascii=False), product.btc_address, product.stock, product.key,
+            )
+        )
+        await self.reload()
+
+    @staticmethod
+    async def held(key: str) -> int:
+        """تعداد واحدهای رزرو شده محصول که هنوز قطعی یا آزاد نشده‌اند"""
+        row = await Database.fetchone(
+            DB_PATH, "SELECT COUNT(*) FROM stock_reservations WHERE product_key = ? AND status = 'held'", (key,)
+        )
+        return row[0]
+
+    async def remove(self, key: str) -> None:
+        """حذف یک محصول"""
+        await Database.execute(DB_PATH, "DELETE FROM products WHERE key = ?", (key,))
+        await self.reload()
+
+    async def reserve(self, key: str, user_id: int) -> Optional[int]:
+        """رزرو یک واحد برای کاربری که وارد مرحله پرداخت شده است؛ None یعنی موجودی تمام شده"""
+        now = time.time()
+        async with Database.transaction(DB_PATH) as db:
+            # رزرو فعال قبلی همین کاربر تمدید می‌شود
+            rows = await db.execute_fetchall(
+                """
+                UPDATE stock_reservations SET expires_at = ?
+                WHERE user_id = ? AND product_key = ? AND status = 'held' AND tracking_code IS NULL
+                RETURNING id
+                """,
+                (now + RESERVATION_TTL, user_id, key)
+            )
+            if rows:
+                return rows[0][0]
+            
+            if not await db.execute_fetchall(
+                "UPDATE products SET stock = stock - 1 WHERE key = ? AND stock > 0 RETURNING stock", (key,)
+            ):
+                return None
+            rows = await db.execute_fetchall(
+                "INSERT INTO stock_reservations (product_key, user_id, expires_at) VALUES (?, ?, ?) RETURNING id",
+                (key, user_id, now + RESERVATION_TTL)
+            )
+        await self.reload()
+        return rows[0][0]
+
+    @staticmethod
+    async def attach(
+        db: aiosqlite.Connection, reservation_id: Optional[int], key: str, user_id: int, tracking_code: str
+    ) -> bool:
+        """اتصال رزرو کاربر به سفارش؛ اگر رزرو آزاد شده باشد یک واحد جدید در صورت موجود بودن برداشته می‌شود"""
+        if reservation_id is not None:
+            rows = await db.execute_fetchall(
+                """
+                UPDATE stock_reservations SET tracking_code = ?
+                WHERE id = ? AND user_id = ? AND product_key = ? AND status = 'held' AND tracking_code IS NULL
+                RETURNING id
+                """,
+                (tracking_code, reservation_id, user_id, key)
+            )
+            if rows:
+                return True
+        
+        if not await db.execute_fetchall(
+            "UPDATE products SET stock = stock - 1 WHERE key = ? AND stock > 0 RETURNING stock", (key,)
+        ):
+            return False
+        await db.execute(
+            """
+            INSERT INTO stock_reservations (product_key, user_id, expires_at, tracking_code)
+            VALUES (?, ?, ?, ?)
+            """,
+            (key, user_id, time.time(), tracking_code)
+        )
+        return True
+
+    @staticmethod
+    async def resolve(db: aiosqlite.Connection, tracking_code: str, completed: bool) -> bool:
+        """قطعی کردن رزرو سفارش تکمیل شده یا بازگرداندن موجودی سفارش لغو شده؛ True یعنی موجودی تغییر کرد"""
+        if completed:
+            await db.execute(
+                "UPDATE stock_reservations SET status = 'committed' WHERE tracking_code = ? AND status = 'held'",
+                (tracking_code,)
+            )
+            return False
+        
+        rows = await db.execute_fetchall(
+            """
+            UPDATE stock_reservations SET status = 'released'
+            WHERE tracking_code = ? AND status = 'held'
+            RETURNING product_key
+            """,
+            (tracking_code,)
+        )
+        if rows:
+            await db.execute("UPDATE products SET stock = stock + 1 WHERE key = ?", (rows[0][0],))
+        return bool(rows)
+
+    async def sweep(self) -> float:
+        """آزادسازی رزروهای منقضی شده‌ای که به سفارشی متصل نشدند (کار زمان‌بندی شده)"""
+        async with Database.transaction(DB_PATH) as db:
+            rows = await db.execute_fetchall(
+                """
+                UPDATE stock_reservations SET status = 'released'
+                WHERE status = 'held' AND tracking_code IS NULL AND expires_at <= ?
+                RETURNING product_key
+                """,
+                (time.time(),)
+            )
+            released = Counter(key for key, in rows)
+            await db.executemany(
+                "UPDATE products SET stock = stock + ? WHERE key = ?",
+                [(count, key) for key, count in released.items()]
+            )
+        if rows:
+            logger.info(f"{len(rows)} رزرو منقضی شده آزاد شد")
+            await self.reload()
+        return time.time() + RESERVATION_SWEEP_INTERVAL
+
+    async def restock(self) -> float:
+        """شارژ روزانه موجودی محصولات (کار زمان‌بندی شده)؛ زمان بررسی بعدی
+
+        واحدهای رزرو شده از سهمیه روزانه کم می‌شوند تا با آزاد شدن آن‌ها موجودی از سهمیه بیشتر نشود.
+        """
+        changed = await Database.execute(
+            DB_PATH,
+            """
+            UPDATE products SET stock = MAX(0, ? - (
+                SELECT COUNT(*) FROM stock_reservations
+                WHERE product_key = products.key AND status = 'held'
+            )), last_restock = CURRENT_TIMESTAMP
+            WHERE last_restock <= datetime('now', '-1 day')
+            """,
+            (PRODUCT_DAILY_STOCK,)
+        )
+        if changed:
+            await self.reload()
+        return time.time() + 3600
 
 
 class FakeStatsGenerator:
@@ -254,252 +943,714 @@ class AuthManager:
         return len(password) >= 8 and any(c.isdigit() for c in password) and any(c.isalpha() for c in password)
 
 
+WALLET_RECONCILE_INTERVAL = int(os.getenv("WALLET_RECONCILE_INTERVAL", 3600))
+TRANSACTIONS_PAGE_SIZE = 10
+ORDERS_PAGE_SIZE = 10
+
+ORDER_STATUS_FILTERS = (None, "pending", "review", "completed", "canceled")
+ORDER_STATUS_LABELS = {
+    None: "همه وضعیت‌ها",
+    "pending": "در انتظار",
+    "review": "بررسی دستی",
+    "completed": "تکمیل شده",
+    "canceled": "لغو شده",
+}
+
+ORDER_DAYS_FILTERS = (None, 1, 7, 30)
+ORDER_DAYS_LABELS = {
+    None: "همه زمان‌ها",
+    1: "24 ساعت",
+    7: "7 روز",
+    30: "30 روز",
+}
+
+TRANSACTION_TYPES = {
+    "deposit": "📥 واریز",
+    "withdraw": "📤 برداشت",
+    "opening": "📂 موجودی اولیه",
+}
+
+TRANSACTION_STATUSES = {
+    "pending": "⏳ در انتظار",
+    "completed": "✅ انجام شده",
+    "rejected": "❌ رد شده",
+}
+
+
 class WalletManager:
-    """مدیریت کیف پول بیت کوین"""
+    """مدیریت کیف پول بیت کوین (موجودی به صورت عدد صحیح ساتوشی)"""
     
-    @staticmethod
-    async def get_balance(user_id: int) -> float:
-        """دریافت موجودی کیف پول"""
-        async with aiosqlite.connect(WALLET_DB_PATH) as db:
-            cursor = await db.execute(
-                "SELECT balance FROM wallets WHERE user_id = ?", 
-                (user_id,)
-            )
-            result = await cursor.fetchone()
-            return result[0] if result else 0.0
+    SATS_PER_BTC = 100_000_000
+    MIN_WITHDRAW_SATS = 50_000  # 0.0005 BTC معادل 1,250,000 تومان
     
     @staticmethod
-    async def deposit(user_id: int, amount: float) -> bool:
-        """واریز به کیف پول"""
-        if amount <= 0:
-            return False
-            
-        try:
-            async with aiosqlite.connect(WALLET_DB_PATH) as db:
-                await db.execute(
-                    """
-                    INSERT OR REPLACE INTO wallets (user_id, balance)
-                    VALUES (?, COALESCE((SELECT balance FROM wallets WHERE user_id = ?), 0) + ?)
-                    """,
-                    (user_id, user_id, amount),
-                )
-                await db.commit()
-                return True
-        except Exception as e:
-            logger.error(f"خطا در واریز کیف پول: {e}")
-            return False
+    def to_sats(amount: float) -> int:
+        """تبدیل مقدار بیت کوین به ساتوشی"""
+        return int(round(amount * WalletManager.SATS_PER_BTC))
     
     @staticmethod
-async def withdraw(user_id: int, amount: float, address: str) -> bool:
-    """برداشت از کیف پول"""
-    MIN_WITHDRAW = 0.0005  # معادل 1,250,000 تومان
-    
-    if amount < MIN_WITHDRAW:
-        return False
-        
-    if not re.match(r'^(bc1|[13])[a-zA-HJ-NP-Z0-9]{25,39}$', address):
-        return False
-        
-    try:
-        async with aiosqlite.connect(WALLET_DB_PATH) as db:
-            cursor = await db.execute(
-                "SELECT balance FROM wallets WHERE user_id = ?", 
-                (user_id,)
-            )
-            balance = (await cursor.fetchone())[0]
-            
-            if balance < amount:
-                return False
-                
-            await db.execute(
-                "UPDATE wallets SET balance = balance - ? WHERE user_id = ?",
-                (amount, user_id)
-            )
-            
-            await db.execute(
-                """INSERT INTO transactions 
-                (user_id, amount, address, type, status)
-                VALUES (?, ?, ?, 'withdraw', 'pending')""",
-                (user_id, amount, address)
-            )
-            await db.commit()
-            return True
-    except Exception as e:
-        logger.error(f"خطا در برداشت از کیف پول: {e}")
-        return False
-
-
-class CoinManager:
-    """مدیریت سکه‌های کاربران"""
+    def to_btc(sats: int) -> float:
+        """تبدیل ساتوشی به بیت کوین برای نمایش"""
+        return sats / WalletManager.SATS_PER_BTC
     
     @staticmethod
     async def init_db() -> None:
-        """تنظیمات دیتابیس سکه‌ها"""
-        async with aiosqlite.connect(COINS_DB_PATH) as db:
+        """تنظیمات دیتابیس کیف پول"""
+        async with Database.transaction(WALLET_DB_PATH) as db:
             await db.execute(
                 """
-                CREATE TABLE IF NOT EXISTS user_coins (
+                CREATE TABLE IF NOT EXISTS wallets (
                     user_id INTEGER PRIMARY KEY,
-                    coins INTEGER DEFAULT 0,
-                    last_daily_claim DATETIME,
-                    dark_mode BOOLEAN DEFAULT FALSE,
-                    avatar TEXT DEFAULT 'mafia',
-                    last_wheel_spin DATETIME,
+                    balance REAL DEFAULT 0,
+                    balance_sats INTEGER NOT NULL DEFAULT 0,
                     FOREIGN KEY (user_id) REFERENCES users (user_id)
                 )
                 """
             )
             await db.execute(
                 """
-                CREATE TABLE IF NOT EXISTS leaderboard (
+                CREATE TABLE IF NOT EXISTS transactions (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    username TEXT NOT NULL,
-                    coins INTEGER NOT NULL,
-                    is_fake BOOLEAN DEFAULT TRUE,
-                    last_updated DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-                """
-            )
-            await db.execute(
-                """
-                CREATE TABLE IF NOT EXISTS discount_codes (
-                    code TEXT PRIMARY KEY,
-                    user_id INTEGER,
-                    discount_percent INTEGER DEFAULT 10,
-                    expires_at DATETIME,
-                    used BOOLEAN DEFAULT FALSE,
+                    user_id INTEGER NOT NULL,
+                    amount REAL NOT NULL,
+                    amount_sats INTEGER,
+                    address TEXT,
+                    type TEXT NOT NULL,
+                    status TEXT DEFAULT 'pending',
+                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
                     FOREIGN KEY (user_id) REFERENCES users (user_id)
                 )
                 """
             )
-            await db.commit()
             
-            # ایجاد کاربران فیک برای جدول رتبه‌بندی
-            fake_users = [
-                ("𝙈𝙞𝙣𝙖", random.randint(100, 150)),
-                ("Ⓢ Ⓢ", random.randint(100, 150)),
-                ("𝕸𝖆𝖃𝖉𝖎", random.randint(100, 150)),
-                ("𝓜𝓪𝓧𝓭𝓲", random.randint(100, 150)),
-                ("𝕞𝕞𝕞", random.randint(100, 150)),
-                ("𝕄𝕖𝕥𝕚", random.randint(100, 150)),
-                ("3𝘼𝙞𝙙", random.randint(100, 150)),
-                ("𝕗𝕒𝕥𝕚 𝕄𝔾", random.randint(100, 200)),
-                ("𝟞𝟞𝟞", random.randint(100, 150)),
-                ("𝔳𝔞𝔥𝔦𝔡", random.randint(100, 150)),
-            ]
+            # انتقال کیف پول‌های قدیمی (موجودی REAL) به ساتوشی
+            wallet_columns = {row[1] for row in await db.execute_fetchall("PRAGMA table_info(wallets)")}
+            if "balance_sats" not in wallet_columns:
+                await db.execute("ALTER TABLE wallets ADD COLUMN balance_sats INTEGER NOT NULL DEFAULT 0")
+                await db.execute(
+                    "UPDATE wallets SET balance_sats = CAST(ROUND(balance * ?) AS INTEGER)",
+                    (WalletManager.SATS_PER_BTC,)
+                )
             
-            for username, coins in fake_users:
+            transaction_columns = {
+                row[1] for row in await db.execute_fetchall("PRAGMA table_info(transactions)")
+            }
+            if "amount_sats" not in transaction_columns:
+                await db.execute("ALTER TABLE transactions ADD COLUMN amount_sats INTEGER")
+                # برداشت‌ها منفی ثبت می‌شوند تا جمع تراکنش‌ها برابر موجودی باشد
                 await db.execute(
                     """
-                    INSERT OR IGNORE INTO leaderboard (username, coins, is_fake)
-                    VALUES (?, ?, TRUE)
+                    UPDATE transactions
+                    SET amount_sats = -CAST(ROUND(amount * ?) AS INTEGER)
+                    WHERE type = 'withdraw'
                     """,
-                    (username, coins)
+                    (WalletManager.SATS_PER_BTC,)
                 )
-            await db.commit()
-    
-    @staticmethod
-    async def get_user_level(coins: int) -> str:
-        """دریافت سطح کاربر بر اساس سکه‌ها"""
-        if coins >= 701:
-            return "VIP"
-        elif coins >= 301:
-            return "حرفه‌ای"
-        elif coins >= 101:
-            return "فعال"
-        else:
-            return "تازه کار"
+                # واریزهای قبلی ثبت نشده‌اند؛ یک سطر افتتاحیه اختلاف را پوشش می‌دهد
+                await db.execute(
+                    """
+                    INSERT INTO transactions (user_id, amount, amount_sats, type, status)
+                    SELECT w.user_id, 0, w.balance_sats - COALESCE(SUM(t.amount_sats), 0), 'opening', 'completed'
+                    FROM wallets w
+                    LEFT JOIN transactions t ON t.user_id = w.user_id
+                    GROUP BY w.user_id
+                    HAVING w.balance_sats != COALESCE(SUM(t.amount_sats), 0)
+                    """
+                )
+                await db.execute(
+                    "UPDATE transactions SET amount = CAST(amount_sats AS REAL) / ? WHERE type = 'opening'",
+                    (WalletManager.SATS_PER_BTC,)
+                )
+            
+            # ایندکس پوششی برای صفحه‌بندی تاریخچه و تطبیق موجودی‌ها بدون مراجعه به جدول
+            await db.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_transactions_user_id
+                ON transactions (user_id, id, amount_sats, type, status, timestamp)
+                """
+            )
     
     @staticmethod
-    async def get_level_progress(coins: int) -> Tuple[int, int, int]:
-        """دریافت پیشرفت به سطح بعدی"""
-        if coins >= 701:  # VIP
-            return (701, 1001, min(100, int((coins - 701) / 3)))
-        elif coins >= 301:  # حرفه‌ای
-            return (301, 701, min(100, int((coins - 301) / 4)))
-        elif coins >= 101:  # فعال
-            return (101, 301, min(100, int((coins - 101) / 2)))
-        else:  # تازه کار
-            return (0, 101, min(100, int(coins)))
+    async def get_balance(user_id: int) -> float:
+        """دریافت موجودی کیف پول"""
+        snapshot = await ProfileManager.get_snapshot(user_id)
+        return snapshot["balance"]
     
     @staticmethod
-    async def get_coins(user_id: int) -> int:
-        """دریافت تعداد سکه‌های کاربر"""
-        async with aiosqlite.connect(COINS_DB_PATH) as db:
-            cursor = await db.execute(
-                "SELECT coins FROM user_coins WHERE user_id = ?", (user_id,)
-            result = await cursor.fetchone()
-            return result[0] if result else 0
+    async def deposit(user_id: int, amount: float) -> bool:
+        """واریز به کیف پول"""
+        return await WalletManager.deposit_sats(user_id, WalletManager.to_sats(amount))
     
     @staticmethod
-    async def add_coins(user_id: int, amount: int, reason: str) -> bool:
-        """افزودن سکه به کاربر"""
+    async def deposit_sats(user_id: int, sats: int) -> bool:
+        """واریز ساتوشی به کیف پول همراه با ثبت تراکنش"""
+        if sats <= 0:
+            return False
+            
         try:
-            async with aiosqlite.connect(COINS_DB_PATH) as db:
-                await db.execute(
+            async with Database.transaction(WALLET_DB_PATH) as db:
+                rows = await db.execute_fetchall(
                     """
-                    INSERT OR REPLACE INTO user_coins (user_id, coins)
-                    VALUES (?, COALESCE((SELECT coins FROM user_coins WHERE user_id = ?), 0) + ?)
+                    INSERT INTO wallets (user_id, balance_sats) VALUES (?, ?)
+                    ON CONFLICT(user_id) DO UPDATE SET balance_sats = balance_sats + excluded.balance_sats
+                    RETURNING balance_sats
                     """,
-                    (user_id, user_id, amount),
+                    (user_id, sats),
                 )
-                await db.commit()
-                
-                # ثبت در تاریخچه
                 await db.execute(
-                    """
-                    INSERT INTO coin_history (user_id, amount, reason, timestamp)
-                    VALUES (?, ?, ?, CURRENT_TIMESTAMP)
-                    """,
-                    (user_id, amount, reason),
+                    """INSERT INTO transactions 
+                    (user_id, amount, amount_sats, type, status)
+                    VALUES (?, ?, ?, 'deposit', 'completed')""",
+                    (user_id, WalletManager.to_btc(sats), sats)
                 )
-                await db.commit()
-                return True
+                await ProfileManager.write_through(
+                    WALLET_DB_PATH, user_id, balance=WalletManager.to_btc(rows[0][0])
+                )
+            render_cache.invalidate(user_id)
+            return True
         except Exception as e:
-            logger.error(f"خطا در افزودن سکه: {e}")
+            logger.error(f"خطا در واریز کیف پول: {e}")
             return False
     
     @staticmethod
-    async def admin_add_coins(user_id: int, amount: int) -> bool:
-        """افزودن سکه به کاربر توسط ادمین"""
+    async def withdraw(user_id: int, amount: float, address: str) -> bool:
+        """برداشت از کیف پول"""
+        sats = WalletManager.to_sats(amount)
+        if sats < WalletManager.MIN_WITHDRAW_SATS:
+            return False
+            
+        if not re.match(r'^(bc1|[13])[a-zA-HJ-NP-Z0-9]{25,39}$', address):
+            return False
+            
         try:
-            async with aiosqlite.connect(COINS_DB_PATH) as db:
-                await db.execute(
+            async with Database.transaction(WALLET_DB_PATH) as db:
+                # بررسی موجودی و کسر آن در یک دستور؛ برداشت‌های همزمان نمی‌توانند هر دو موفق شوند
+                rows = await db.execute_fetchall(
                     """
-                    INSERT OR REPLACE INTO user_coins (user_id, coins)
-                    VALUES (?, COALESCE((SELECT coins FROM user_coins WHERE user_id = ?), 0) + ?)
+                    UPDATE wallets SET balance_sats = balance_sats - ?
+                    WHERE user_id = ? AND balance_sats >= ?
+                    RETURNING balance_sats
                     """,
-                    (user_id, user_id, amount),
+                    (sats, user_id, sats)
                 )
-                await db.commit()
+                if not rows:
+                    return False
                 
-                # ثبت در تاریخچه
                 await db.execute(
-                    """
-                    INSERT INTO coin_history (user_id, amount, reason, timestamp)
-                    VALUES (?, ?, 'ادمین', CURRENT_TIMESTAMP)
+                    """INSERT INTO transactions 
+                    (user_id, amount, amount_sats, address, type, status)
+                    VALUES (?, ?, ?, ?, 'withdraw', 'pending')""",
+                    (user_id, WalletManager.to_btc(sats), -sats, address)
+                )
+                await ProfileManager.write_through(
+                    WALLET_DB_PATH, user_id, balance=WalletManager.to_btc(rows[0][0])
+                )
+            render_cache.invalidate(user_id)
+            return True
+        except Exception as e:
+            logger.error(f"خطا در برداشت از کیف پول: {e}")
+            return False
+    
+    @staticmethod
+    async def get_transactions(
+        user_id: int,
+        limit: int = 10,
+        before_id: Optional[int] = None,
+        after_id: Optional[int] = None,
+    ) -> List[Tuple]:
+        """یک صفحه از تراکنش‌های کاربر (جدیدترین اول) با صفحه‌بندی بر اساس شناسه"""
+        if after_id is not None:
+            # صفحه جدیدتر: پیمایش صعودی از شناسه و برگرداندن ترتیب
+            rows = await Database.fetchall(
+                WALLET_DB_PATH,
+                """
+                SELECT id, amount_sats, type, status, timestamp FROM transactions
+                WHERE user_id = ? AND id > ?
+                ORDER BY id ASC
+                LIMIT ?
+                """,
+                (user_id, after_id, limit)
+            )
+            return rows[::-1]
+        
+        return await Database.fetchall(
+            WALLET_DB_PATH,
+            """
+            SELECT id, amount_sats, type, status, timestamp FROM transactions
+            WHERE user_id = ? AND id < ?
+            ORDER BY id DESC
+            LIMIT ?
+            """,
+            (user_id, before_id if before_id is not None else 2 ** 63 - 1, limit)
+        )
+    
+    @staticmethod
+    async def reconcile(repair: bool = True) -> List[Tuple[int, int, int]]:
+        """مقایسه موجودی کیف پول‌ها با جمع تراکنش‌ها و اصلاح موارد مغایر"""
+        # پیمایش کامل روی اتصال خواننده انجام می‌شود تا نویسنده در این مدت آزاد بماند
+        candidates = await Database.fetchall(
+            WALLET_DB_PATH,
+            """
+            SELECT w.user_id, w.balance_sats, COALESCE(SUM(t.amount_sats), 0) AS derived
+            FROM wallets w
+            LEFT JOIN transactions t ON t.user_id = w.user_id
+            GROUP BY w.user_id
+            HAVING w.balance_sats != derived
+            """
+        )
+        if not candidates or not repair:
+            for user_id, stored, derived in candidates:
+                logger.error(
+                    f"مغایرت کیف پول کاربر {user_id}: موجودی {stored} ساتوشی، جمع تراکنش‌ها {derived} ساتوشی"
+                )
+            return candidates
+        
+        # فقط همین کاربران در یک تراکنش کوتاه دوباره بررسی و اصلاح می‌شوند
+        mismatches = []
+        async with Database.transaction(WALLET_DB_PATH) as db:
+            user_ids = [row[0] for row in candidates]
+            for start in range(0, len(user_ids), 500):
+                chunk = user_ids[start:start + 500]
+                rows = await db.execute_fetchall(
+                    f"""
+                    SELECT w.user_id, w.balance_sats,
+                           (SELECT COALESCE(SUM(t.amount_sats), 0) FROM transactions t WHERE t.user_id = w.user_id)
+                    FROM wallets w
+                    WHERE w.user_id IN ({", ".join("?" * len(chunk))})
                     """,
-                    (user_id, amount),
+                    chunk
                 )
-                await db.commit()
-                return True
+                mismatches.extend(row for row in rows if row[1] != row[2])
+            
+            for user_id, stored, derived in mismatches:
+                logger.error(
+                    f"مغایرت کیف پول کاربر {user_id}: موجودی {stored} ساتوشی، جمع تراکنش‌ها {derived} ساتوشی"
+                )
+                await db.execute(
+                    "UPDATE wallets SET balance_sats = ? WHERE user_id = ?", (derived, user_id)
+                )
+                await ProfileManager.write_through(
+                    WALLET_DB_PATH, user_id, balance=WalletManager.to_btc(derived)
+                )
+        return mismatches
+
+
+COIN_BATCH_MAX = int(os.getenv("COIN_BATCH_MAX", 200))
+COIN_BATCH_DELAY = float(os.getenv("COIN_BATCH_DELAY", 0.01))
+COIN_LEDGER_RETENTION_DAYS = int(os.getenv("COIN_LEDGER_RETENTION_DAYS", 90))
+COIN_LEDGER_COMPACT_INTERVAL = int(os.getenv("COIN_LEDGER_COMPACT_INTERVAL", 6 * 3600))
+
+
+class CoinLedger:
+    """دفتر سکه‌ها: رویدادهای فقط-افزودنی و موجودی تجمیعی در user_coins"""
+
+    def __init__(self, batch_max: int = COIN_BATCH_MAX, batch_delay: float = COIN_BATCH_DELAY):
+        self.batch_max = batch_max
+        self.batch_delay = batch_delay
+        self.batches = 0
+        self.batched_events = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    @staticmethod
+    async def init_db(db: aiosqlite.Connection) -> None:
+        """ایجاد جدول رویدادها (داخل تراکنش init_db سکه‌ها)"""
+        await db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS coin_ledger (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                amount INTEGER NOT NULL,
+                reason TEXT,
+                ts DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+            """
+        )
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_coin_ledger_user_ts ON coin_ledger (user_id, ts)"
+        )
+        
+        # انتقال تاریخچه قدیمی سکه‌ها به دفتر
+        if await db.execute_fetchall(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'coin_history'"
+        ):
+            await db.execute(
+                """
+                INSERT INTO coin_ledger (user_id, amount, reason, ts)
+                SELECT user_id, amount, reason, timestamp FROM coin_history ORDER BY id
+                """
+            )
+            await db.execute("DROP TABLE coin_history")
+
+    @staticmethod
+    async def apply(db: aiosqlite.Connection, user_id: int, amount: int, reason: str) -> int:
+        """ثبت یک رویداد و به‌روزرسانی موجودی در تراکنش جاری"""
+        await db.execute(
+            "INSERT INTO coin_ledger (user_id, amount, reason) VALUES (?, ?, ?)",
+            (user_id, amount, reason),
+        )
+        return await CoinLedger._add_to_balance(db, user_id, amount)
+
+    @staticmethod
+    async def debit(db: aiosqlite.Connection, user_id: int, amount: int, reason: str) -> Optional[int]:
+        """کسر سکه در صورت کافی بودن موجودی؛ موجودی جدید یا None"""
+        rows = await db.execute_fetchall(
+            "UPDATE user_coins SET coins = coins - ? WHERE user_id = ? AND coins >= ? RETURNING coins",
+            (amount, user_id, amount)
+        )
+        if not rows:
+            return None
+        await db.execute(
+            "INSERT INTO coin_ledger (user_id, amount, reason) VALUES (?, ?, ?)",
+            (user_id, -amount, reason),
+        )
+        coins = rows[0][0]
+        await ProfileManager.write_through(COINS_DB_PATH, user_id, coins=coins)
+        await Database.after_commit(COINS_DB_PATH, lambda: render_cache.invalidate(user_id))
+        await Database.after_commit(COINS_DB_PATH, lambda: coin_ranking.update(user_id, coins))
+        return coins
+
+    @staticmethod
+    async def _add_to_balance(db: aiosqlite.Connection, user_id: int, amount: int) -> int:
+        """افزایش موجودی تجمیعی بدون تغییر سایر تنظیمات کاربر"""
+        rows = await db.execute_fetchall(
+            """
+            INSERT INTO user_coins (user_id, coins) VALUES (?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET coins = coins + excluded.coins
+            RETURNING coins, avatar, dark_mode
+            """,
+            (user_id, amount),
+        )
+        coins, avatar, dark_mode = rows[0]
+        await ProfileManager.write_through(
+            COINS_DB_PATH, user_id, coins=coins, avatar=avatar, dark_mode=bool(dark_mode)
+        )
+        await Database.after_commit(COINS_DB_PATH, lambda: render_cache.invalidate(user_id))
+        await Database.after_commit(COINS_DB_PATH, lambda: coin_ranking.update(user_id, coins))
+        return coins
+
+    async def record(self, user_id: int, amount: int, reason: str) -> bool:
+        """ثبت سکه؛ خارج از تراکنش با commit گروهی و داخل تراکنش همراه همان تراکنش"""
+        if Database.in_transaction(COINS_DB_PATH):
+            async with Database.transaction(COINS_DB_PATH) as db:
+                await self.apply(db, user_id, amount, reason)
+            return True
+        
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+        
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((user_id, amount, reason, future))
+        return await future
+
+    async def _run(self) -> None:
+        """جمع‌آوری رویدادهای نزدیک به هم و ثبت آن‌ها در یک تراکنش"""
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            stop = False
+            deadline = loop.time() + self.batch_delay
+            while len(batch) < self.batch_max:
+                timeout = deadline - loop.time()
+                try:
+                    item = self._queue.get_nowait() if timeout <= 0 else await asyncio.wait_for(self._queue.get(), timeout)
+                except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+            if stop:
+                return
+
+    async def _flush(self, batch: List[tuple]) -> None:
+        """ثبت یک دسته رویداد"""
+        totals: Dict[int, int] = {}
+        for user_id, amount, _, _ in batch:
+            totals[user_id] = totals.get(user_id, 0) + amount
+        
+        try:
+            async with Database.transaction(COINS_DB_PATH) as db:
+                await db.executemany(
+                    "INSERT INTO coin_ledger (user_id, amount, reason) VALUES (?, ?, ?)",
+                    [(user_id, amount, reason) for user_id, amount, reason, _ in batch],
+                )
+                for user_id, amount in totals.items():
+                    await self._add_to_balance(db, user_id, amount)
+            self.batches += 1
+            self.batched_events += len(batch)
+            results = [True] * len(batch)
+        except Exception as e:
+            logger.error(f"خطا در ثبت گروهی سکه‌ها، ثبت تکی انجام می‌شود: {e}")
+            results = []
+            for user_id, amount, reason, _ in batch:
+                try:
+                    async with Database.transaction(COINS_DB_PATH) as db:
+                        await self.apply(db, user_id, amount, reason)
+                    results.append(True)
+                except Exception as e:
+                    logger.error(f"خطا در افزودن سکه: {e}")
+                    results.append(False)
+        
+        for (_, _, _, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def close(self) -> None:
+        """ثبت رویدادهای باقی‌مانده و توقف"""
+        if self._worker is not None and not self._worker.done():
+            self._queue.put_nowait(None)
+            await self._worker
+        self._worker = None
+
+    @staticmethod
+    async def compact(retention_days: int = COIN_LEDGER_RETENTION_DAYS) -> int:
+        """ادغام رویدادهای قدیمی هر کاربر در یک سطر snapshot"""
+        cutoff = f"-{retention_days} days"
+        async with Database.transaction(COINS_DB_PATH) as db:
+            rows = await db.execute_fetchall(
+                "SELECT MAX(id) FROM coin_ledger WHERE ts < datetime('now', ?)", (cutoff,)
+            )
+            max_id = rows[0][0]
+            if max_id is None:
+                return 0
+            
+            await db.execute(
+                """
+                INSERT INTO coin_ledger (user_id, amount, reason, ts)
+                SELECT user_id, SUM(amount), 'snapshot', MAX(ts)
+                FROM coin_ledger
+                WHERE id <= ? AND ts < datetime('now', ?)
+                GROUP BY user_id
+                HAVING COUNT(*) > 1
+                """,
+                (max_id, cutoff)
+            )
+            # سطرهای snapshot جدید شناسه بزرگ‌تر از max_id دارند و حذف نمی‌شوند
+            cursor = await db.execute(
+                """
+                DELETE FROM coin_ledger
+                WHERE id <= ? AND ts < datetime('now', ?)
+                AND user_id IN (SELECT user_id FROM coin_ledger WHERE id > ? AND reason = 'snapshot')
+                """,
+                (max_id, cutoff, max_id)
+            )
+            return cursor.rowcount
+
+    @staticmethod
+    async def get_history(
+        user_id: int, limit: int = 20, before: Optional[Tuple[str, int]] = None
+    ) -> List[Tuple]:
+        """تاریخچه سکه‌های کاربر (جدیدترین اول) با صفحه‌بندی بر اساس (ts, id)"""
+        if before is None:
+            return await Database.fetchall(
+                COINS_DB_PATH,
+                """
+                SELECT id, amount, reason, ts FROM coin_ledger
+                WHERE user_id = ?
+                ORDER BY ts DESC, id DESC
+                LIMIT ?
+                """,
+                (user_id, limit)
+            )
+        return await Database.fetchall(
+            COINS_DB_PATH,
+            """
+            SELECT id, amount, reason, ts FROM coin_ledger
+            WHERE user_id = ? AND (ts, id) < (?, ?)
+            ORDER BY ts DESC, id DESC
+            LIMIT ?
+            """,
+            (user_id, before[0], before[1], limit)
+        )
+
+
+coin_ledger = CoinLedger()
+
+
+class CoinRanking:
+    """رتبه‌بندی درون‌حافظه‌ای کاربران بر اساس سکه (فهرست مرتب با جستجوی دودویی)"""
+
+    def __init__(self):
+        # (منفی سکه‌ها، شناسه کاربر) به ترتیب صعودی؛ یعنی بیشترین سکه در ابتدا
+        self._order: List[Tuple[int, int]] = []
+        self._coins: Dict[int, int] = {}
+        self.loaded = False
+
+    async def load(self) -> None:
+        """ساخت رتبه‌بندی از user_coins (یک بار هنگام راه‌اندازی)"""
+        rows = await Database.fetchall(COINS_DB_PATH, "SELECT user_id, coins FROM user_coins")
+        self._coins = {user_id: coins for user_id, coins in rows if coins}
+        self._order = sorted((-coins, user_id) for user_id, coins in self._coins.items())
+        self.loaded = True
+        logger.info(f"رتبه‌بندی سکه‌ها با {len(self._order)} کاربر ساخته شد")
+
+    def update(self, user_id: int, coins: int) -> None:
+        """اعمال موجودی جدید کاربر پس از commit"""
+        old = self._coins.pop(user_id, None)
+        if old is not None:
+            index = bisect.bisect_left(self._order, (-old, user_id))
+            if index < len(self._order) and self._order[index] == (-old, user_id):
+                del self._order[index]
+            else:
+                # فهرست با دیکشنری ناهماهنگ شده؛ هر ورودی این کاربر حذف می‌شود نه ورودی کاربر دیگر
+                logger.warning(f"ورودی رتبه‌بندی کاربر {user_id} پیدا نشد؛ فهرست اصلاح شد")
+                self._order = [entry for entry in self._order if entry[1] != user_id]
+        if coins:
+            self._coins[user_id] = coins
+            bisect.insort(self._order, (-coins, user_id))
+
+    def rank(self, user_id: int) -> int:
+        """رتبه کاربر: تعداد کاربران با سکه بیشتر به علاوه یک"""
+        coins = self._coins.get(user_id, 0)
+        return bisect.bisect_left(self._order, (-coins,)) + 1
+
+    def top(self, limit: int) -> List[Tuple[int, int]]:
+        """کاربران برتر به صورت (شناسه کاربر، سکه)"""
+        return [(user_id, -coins) for coins, user_id in self._order[:limit]]
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+
+coin_ranking = CoinRanking()
+
+LEADERBOARD_SIZE = 5
+LEADERBOARD_REFRESH_INTERVAL = int(os.getenv("LEADERBOARD_REFRESH_INTERVAL", 60))
+
+
+class LeaderboardSnapshot:
+    """نمای فقط-خواندنی کاربران برتر که توسط یک کار پس‌زمینه بازسازی می‌شود"""
+
+    def __init__(self, size: int = LEADERBOARD_SIZE):
+        self.size = size
+        self.entries: Tuple[Tuple[str, int], ...] = ()
+        self.refreshed_at: Optional[datetime] = None
+        self.refreshes = 0
+
+    async def refresh(self) -> None:
+        """بازسازی نما از رتبه‌بندی درون‌حافظه‌ای و نام کاربران"""
+        self.entries = tuple(await CoinManager.build_leaderboard(self.size))
+        self.refreshed_at = datetime.now()
+        self.refreshes += 1
+
+    def get(self, limit: int) -> List[Tuple[str, int]]:
+        """کاربران برتر از آخرین نمای ساخته شده"""
+        return list(self.entries[:limit])
+
+
+leaderboard_snapshot = LeaderboardSnapshot()
+
+
+class CoinManager:
+    """مدیریت سکه‌های کاربران"""
+    
+    @staticmethod
+    async def init_db() -> None:
+        """تنظیمات دیتابیس سکه‌ها"""
+        async with Database.transaction(COINS_DB_PATH) as db:
+            await db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS user_coins (
+                    user_id INTEGER PRIMARY KEY,
+                    coins INTEGER DEFAULT 0,
+                    last_daily_claim DATETIME,
+                    dark_mode BOOLEAN DEFAULT FALSE,
+                    avatar TEXT DEFAULT 'mafia',
+                    last_wheel_spin DATETIME,
+                    FOREIGN KEY (user_id) REFERENCES users (user_id)
+                )
+                """
+            )
+            await CoinLedger.init_db(db)
+            # جدول رتبه‌بندی فیک قدیمی؛ رتبه‌ها اکنون از CoinRanking و user_coins خوانده می‌شوند
+            await db.execute("DROP TABLE IF EXISTS leaderboard")
+            await db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS discount_codes (
+                    code TEXT PRIMARY KEY,
+                    user_id INTEGER,
+                    discount_percent INTEGER DEFAULT 10,
+                    expires_at DATETIME,
+                    used BOOLEAN DEFAULT FALSE,
+                    FOREIGN KEY (user_id) REFERENCES users (user_id)
+                )
+                """
+            )
+
+    @staticmethod
+    async def get_user_level(coins: int) -> str:
+        """دریافت سطح کاربر بر اساس سکه‌ها"""
+        if coins >= 701:
+            return "VIP"
+        elif coins >= 301:
+            return "حرفه‌ای"
+        elif coins >= 101:
+            return "فعال"
+        else:
+            return "تازه کار"
+    
+    @staticmethod
+    async def get_level_progress(coins: int) -> Tuple[int, int, int]:
+        """دریافت پیشرفت به سطح بعدی"""
+        if coins >= 701:  # VIP
+            return (701, 1001, min(100, int((coins - 701) / 3)))
+        elif coins >= 301:  # حرفه‌ای
+            return (301, 701, min(100, int((coins - 301) / 4)))
+        elif coins >= 101:  # فعال
+            return (101, 301, min(100, int((coins - 101) / 2)))
+        else:  # تازه کار
+            return (0, 101, min(100, int(coins)))
+    
+    @staticmethod
+    async def get_coins(user_id: int) -> int:
+        """دریافت تعداد سکه‌های کاربر"""
+        snapshot = await ProfileManager.get_snapshot(user_id)
+        return snapshot["coins"]
+    
+    @staticmethod
+    async def add_coins(user_id: int, amount: int, reason: str) -> bool:
+        """افزودن سکه به کاربر"""
+        try:
+            return await coin_ledger.record(user_id, amount, reason)
+        except Exception as e:
+            logger.error(f"خطا در افزودن سکه: {e}")
+            return False
+    
+    @staticmethod
+    async def admin_add_coins(user_id: int, amount: int) -> bool:
+        """افزودن سکه به کاربر توسط ادمین"""
+        try:
+            return await coin_ledger.record(user_id, amount, "ادمین")
         except Exception as e:
             logger.error(f"خطا در افزودن سکه توسط ادمین: {e}")
             return False
     
+    @staticmethod
+    async def get_coin_history(
+        user_id: int, limit: int = 20, before: Optional[Tuple[str, int]] = None
+    ) -> List[Tuple]:
+        """دریافت تاریخچه سکه‌های کاربر"""
+        return await CoinLedger.get_history(user_id, limit, before)
+    
     @staticmethod
     async def can_claim_daily(user_id: int) -> bool:
         """بررسی امکان دریافت پاداش روزانه"""
-        async with aiosqlite.connect(COINS_DB_PATH) as db:
-            cursor = await db.execute(
-                "SELECT last_daily_claim FROM user_coins WHERE user_id = ?", (user_id,)
-            result = await cursor.fetchone()
+        result = await Database.fetchone(
+            COINS_DB_PATH,
+            "SELECT last_daily_claim FROM user_coins WHERE user_id = ?", (user_id,)
+        )
+        
+        if not result or not result[0]:
+            return True
             
-            if not result or not result[0]:
-                return True
-                
-            last_claim = datetime.strptime(result[0], "%Y-%m-%d %H:%M:%S")
-            return (datetime.now() - last_claim) >= timedelta(hours=24)
+        last_claim = datetime.strptime(result[0], "%Y-%m-%d %H:%M:%S")
+        return (datetime.now() - last_claim) >= timedelta(hours=24)
     
     @staticmethod
     async def claim_daily_coins(user_id: int) -> bool:
@@ -508,16 +1659,21 @@ class CoinManager:
             return False
             
         try:
-            async with aiosqlite.connect(COINS_DB_PATH) as db:
-                await db.execute(
+            async with Database.transaction(COINS_DB_PATH) as db:
+                # ثبت زمان دریافت فقط اگر 24 ساعت از دریافت قبلی گذشته باشد
+                claimed = await db.execute_fetchall(
                     """
-                    INSERT OR REPLACE INTO user_coins (user_id, coins, last_daily_claim)
-                    VALUES (?, COALESCE((SELECT coins FROM user_coins WHERE user_id = ?), 0) + 5, CURRENT_TIMESTAMP)
+                    INSERT INTO user_coins (user_id, last_daily_claim) VALUES (?, CURRENT_TIMESTAMP)
+                    ON CONFLICT(user_id) DO UPDATE SET last_daily_claim = CURRENT_TIMESTAMP
+                    WHERE last_daily_claim IS NULL OR last_daily_claim <= datetime('now', '-1 day')
+                    RETURNING 1
                     """,
-                    (user_id, user_id),
+                    (user_id,),
                 )
-                await db.commit()
-                return True
+                if not claimed:
+                    return False
+                await CoinLedger.apply(db, user_id, 5, "پاداش روزانه")
+            return True
         except Exception as e:
             logger.error(f"خطا در دریافت سکه روزانه: {e}")
             return False
@@ -531,83 +1687,68 @@ class CoinManager:
         if coins < MIN_COINS:
             return False
             
-        btc_amount = (coins // COINS_PER_BTC) * 0.00002
+        sats_amount = (coins // COINS_PER_BTC) * 2000  # 0.00002 BTC
         
         try:
-            async with aiosqlite.connect(COINS_DB_PATH) as db:
-                # کسر سکه‌ها
-                await db.execute(
-                    "UPDATE user_coins SET coins = coins - ? WHERE user_id = ? AND coins >= ?",
-                    (coins, user_id, coins)
-                await db.commit()
+            # کسر سکه و واریز بیت کوین در یک تراکنش انجام می‌شوند
+            async with Database.transaction(COINS_DB_PATH) as db:
+                if await CoinLedger.debit(db, user_id, coins, "تبدیل به بیت کوین") is None:
+                    return False
                 
-                # واریز بیت کوین
-                await WalletManager.deposit(user_id, btc_amount)
-                return True
+                if not await WalletManager.deposit_sats(user_id, sats_amount):
+                    raise RuntimeError("واریز بیت کوین انجام نشد")
+            return True
         except Exception as e:
             logger.error(f"خطا در تبدیل سکه به بیت کوین: {e}")
             return False
     
     @staticmethod
-    async def get_leaderboard(limit: int = 5) -> List[Tuple]:
-        """دریافت جدول رتبه‌بندی"""
-        async with aiosqlite.connect(COINS_DB_PATH) as db:
-            # به روزرسانی سکه‌های کاربران فیک
-            await db.execute(
-                """
-                UPDATE leaderboard 
-                SET coins = coins + ?, 
-                    last_updated = CURRENT_TIMESTAMP 
-                WHERE is_fake = TRUE
-                """,
-                (random.randint(10, 30),)
-            await db.commit()
-            
-            cursor = await db.execute(
-                """
-                SELECT username, coins 
-                FROM leaderboard 
-                WHERE is_fake = TRUE
-                ORDER BY coins DESC 
-                LIMIT ?
-                """,
-                (limit,)
-            )
-            return await cursor.fetchall()
+    async def get_leaderboard(limit: int = LEADERBOARD_SIZE) -> List[Tuple]:
+        """دریافت جدول رتبه‌بندی از نمای کش شده (بدون مراجعه به دیتابیس)"""
+        return leaderboard_snapshot.get(limit)
+    
+    @staticmethod
+    async def build_leaderboard(limit: int) -> List[Tuple]:
+        """ساخت جدول رتبه‌بندی کاربران واقعی"""
+        top = coin_ranking.top(limit)
+        if not top:
+            return []
+        
+        user_ids = [user_id for user_id, _ in top]
+        rows = await Database.fetchall(
+            USERS_DB_PATH,
+            f"SELECT user_id, full_name FROM users WHERE user_id IN ({','.join('?' * len(user_ids))})",
+            user_ids
+        )
+        names = {user_id: full_name for user_id, full_name in rows if full_name}
+        return [
+            (names.get(user_id, f"کاربر ...{str(user_id)[-4:]}"), coins)
+            for user_id, coins in top
+        ]
     
     @staticmethod
     async def get_user_rank(user_id: int) -> Optional[int]:
         """دریافت رتبه کاربر در جدول رتبه‌بندی"""
-        async with aiosqlite.connect(COINS_DB_PATH) as db:
-            cursor = await db.execute(
-                """
-                SELECT COUNT(*) + 1
-                FROM (
-                    SELECT user_id, coins 
-                    FROM user_coins 
-                    WHERE coins > (SELECT coins FROM user_coins WHERE user_id = ?)
-                )
-                """,
-                (user_id,)
-            )
-            result = await cursor.fetchone()
-            return result[0] if result else None
+        return coin_ranking.rank(user_id)
     
     @staticmethod
     async def toggle_dark_mode(user_id: int) -> bool:
         """تغییر حالت تاریک/روشن"""
         try:
-            async with aiosqlite.connect(COINS_DB_PATH) as db:
-                await db.execute(
+            async with Database.transaction(COINS_DB_PATH) as db:
+                rows = await db.execute_fetchall(
                     """
                     UPDATE user_coins 
                     SET dark_mode = NOT dark_mode 
                     WHERE user_id = ?
+                    RETURNING dark_mode
                     """,
                     (user_id,)
                 )
-                await db.commit()
-                return True
+                if rows:
+                    await ProfileManager.write_through(COINS_DB_PATH, user_id, dark_mode=bool(rows[0][0]))
+            render_cache.invalidate(user_id)
+            return True
         except Exception as e:
             logger.error(f"خطا در تغییر حالت تاریک/روشن: {e}")
             return False
@@ -615,12 +1756,8 @@ class CoinManager:
     @staticmethod
     async def get_dark_mode(user_id: int) -> bool:
         """دریافت وضعیت حالت تاریک/روشن"""
-        async with aiosqlite.connect(COINS_DB_PATH) as db:
-            cursor = await db.execute(
-                "SELECT dark_mode FROM user_coins WHERE user_id = ?", (user_id,)
-            )
-            result = await cursor.fetchone()
-            return result[0] if result else False
+        snapshot = await ProfileManager.get_snapshot(user_id)
+        return snapshot["dark_mode"]
     
     @staticmethod
     async def set_avatar(user_id: int, avatar: str) -> bool:
@@ -642,135 +1779,1761 @@ class CoinManager:
                 return False
             
         try:
-            async with aiosqlite.connect(COINS_DB_PATH) as db:
-                await db.execute(
-                    "UPDATE user_coins SET avatar = ? WHERE user_id = ?",
+            async with Database.transaction(COINS_DB_PATH) as db:
+                rows = await db.execute_fetchall(
+                    "UPDATE user_coins SET avatar = ? WHERE user_id = ? RETURNING avatar",
                     (avatar, user_id)
                 )
-                await db.commit()
-                return True
+                if rows:
+                    await ProfileManager.write_through(COINS_DB_PATH, user_id, avatar=rows[0][0])
+            render_cache.invalidate(user_id)
+            return True
         except Exception as e:
             logger.error(f"خطا در تنظیم آواتار: {e}")
             return False
     
     @staticmethod
-    async def get_avatar(user_id: int) -> str:
-        """دریافت آواتار کاربر"""
-        async with aiosqlite.connect(COINS_DB_PATH) as db:
-            cursor = await db.execute(
-                "SELECT avatar FROM user_coins WHERE user_id = ?", (user_id,)
-            )
-            result = await cursor.fetchone()
-            return result[0] if result else "mafia"
-    
+    async def get_avatar(user_id: int) -> str:
+        """دریافت آواتار کاربر"""
+        snapshot = await ProfileManager.get_snapshot(user_id)
+        return snapshot["avatar"]
+    
+    @staticmethod
+    async def generate_discount_code(user_id: int) -> str:
+        """تولید کد تخفیف"""
+        code = f"DISCOUNT-{hashlib.md5(str(user_id + datetime.now().timestamp()).encode()).hexdigest()[:8].upper()}"
+        
+        try:
+            await Database.execute(
+                COINS_DB_PATH,
+                """
+                INSERT INTO discount_codes (code, user_id, expires_at)
+                VALUES (?, ?, datetime('now', '+1 day'))
+                """,
+                (code, user_id)
+            )
+            return code
+        except Exception as e:
+            logger.error(f"خطا در تولید کد تخفیف: {e}")
+            return ""
+    
+    @staticmethod
+    async def validate_discount_code(user_id: int, code: str) -> bool:
+        """اعتبارسنجی کد تخفیف"""
+        result = await Database.fetchone(
+            COINS_DB_PATH,
+            """
+            SELECT 1 FROM discount_codes 
+            WHERE code = ? AND user_id = ? AND used = FALSE AND expires_at > datetime('now')
+            """,
+            (code, user_id)
+        )
+        return result is not None
+    
+    @staticmethod
+    async def use_discount_code(user_id: int, code: str) -> bool:
+        """استفاده از کد تخفیف"""
+        await Database.execute(
+            COINS_DB_PATH,
+            "UPDATE discount_codes SET used = TRUE WHERE code = ? AND user_id = ?",
+            (code, user_id)
+        )
+        return True
+
+
+class ReferralSystem:
+    """سیستم معرفی دوستان"""
+    
+    REFERRAL_BONUS = 0.0001  # معادل 50,000 تومان
+    REQUIRED_REFERRALS = 10
+    
+    @staticmethod
+    async def get_referral_code(user_id: int) -> str:
+        """دریافت کد معرف کاربر"""
+        return f"REF-{user_id}-{hashlib.md5(str(user_id).encode()).hexdigest()[:5]}"
+    
+    @staticmethod
+    async def add_referral(referrer_id: int, referred_id: int) -> bool:
+        """ثبت معرفی جدید"""
+        if referrer_id == referred_id:
+            return False
+            
+        try:
+            async with Database.transaction(USERS_DB_PATH) as db:
+                # بررسی اینکه کاربر دعوت شده ثبت نام کرده است
+                if not await db.execute_fetchall(
+                    "SELECT 1 FROM users WHERE user_id = ?", (referred_id,)
+                ):
+                    return False
+                
+                # بررسی عدم وجود معرفی تکراری
+                if await db.execute_fetchall(
+                    "SELECT 1 FROM referrals WHERE referrer_id = ? AND referred_id = ?",
+                    (referrer_id, referred_id)
+                ):
+                    return False
+                
+                await db.execute(
+                    "INSERT INTO referrals (referrer_id, referred_id) VALUES (?, ?)",
+                    (referrer_id, referred_id),
+                )
+                
+                rows = await db.execute_fetchall(
+                    "SELECT COUNT(*) FROM referrals WHERE referrer_id = ?",
+                    (referrer_id,),
+                )
+                count = rows[0][0]
+                
+                # پاداش پیش از سکه‌ها واریز می‌شود تا شکست آن کل معرفی را برگرداند
+                if count >= ReferralSystem.REQUIRED_REFERRALS:
+                    if not await WalletManager.deposit(referrer_id, ReferralSystem.REFERRAL_BONUS):
+                        raise RuntimeError("واریز پاداش معرفی انجام نشد")
+                
+                # افزودن سکه به معرف
+                await CoinManager.add_coins(referrer_id, 10, "معرفی دوست")
+                return True
+        except Exception as e:
+            logger.error(f"خطا در ثبت معرف: {e}")
+            return False
+
+
+PROFILE_CACHE_MAX_ENTRIES = int(os.getenv("PROFILE_CACHE_MAX_ENTRIES", 5000))
+
+
+class ProfileCache:
+    """کش LRU اطلاعات پروفایل کاربران که با هر عملیات نوشتنی به‌روز می‌شود"""
+
+    def __init__(self, max_entries: int = PROFILE_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # شمارنده نوشتن‌ها؛ خواندنی که همزمان با یک نوشتن انجام شده در کش قرار نمی‌گیرد
+        self.writes = 0
+        self._entries: "OrderedDict[int, dict]" = OrderedDict()
+
+    def get(self, user_id: int) -> Optional[dict]:
+        """دریافت اطلاعات کش شده کاربر"""
+        snapshot = self._entries.get(user_id)
+        if snapshot is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return dict(snapshot)
+
+    def put(self, user_id: int, snapshot: dict, writes_seen: int) -> None:
+        """ذخیره اطلاعات خوانده شده از دیتابیس"""
+        if writes_seen != self.writes:
+            return
+        self._entries[user_id] = dict(snapshot)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def update(self, user_id: int, **fields) -> None:
+        """اعمال مقادیر جدید پس از commit یک تغییر"""
+        self.writes += 1
+        snapshot = self._entries.get(user_id)
+        if snapshot is not None:
+            snapshot.update(fields)
+
+    def invalidate(self, user_id: int) -> None:
+        """حذف اطلاعات کاربر از کش"""
+        self.writes += 1
+        self._entries.pop(user_id, None)
+
+    def get_stats(self) -> dict:
+        """آمار کش"""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+profile_cache = ProfileCache()
+
+
+class ProfileManager:
+    """بارگذاری یکجای اطلاعات پروفایل کاربر از جداول کاربران، کیف پول و سکه‌ها"""
+
+    @staticmethod
+    async def get_snapshot(user_id: int) -> dict:
+        """دریافت تاریخ عضویت، موجودی، سکه‌ها، سطح، آواتار و حالت نمایش کاربر"""
+        # داخل تراکنش باید تغییرات همان تراکنش دیده شود، پس کش استفاده نمی‌شود
+        in_transaction = Database.in_transaction(USERS_DB_PATH, WALLET_DB_PATH, COINS_DB_PATH)
+        if not in_transaction:
+            snapshot = profile_cache.get(user_id)
+            if snapshot is not None:
+                snapshot["level"] = await CoinManager.get_user_level(snapshot["coins"])
+                return snapshot
+        
+        writes_seen = profile_cache.writes
+        snapshot = await ProfileManager._load_snapshot(user_id)
+        if not in_transaction:
+            profile_cache.put(user_id, snapshot, writes_seen)
+        snapshot["level"] = await CoinManager.get_user_level(snapshot["coins"])
+        return snapshot
+
+    @staticmethod
+    async def write_through(path: str, user_id: int, **fields) -> None:
+        """به‌روزرسانی کش پروفایل با مقادیر RETURNING پس از commit تراکنش"""
+        await Database.after_commit(path, lambda: profile_cache.update(user_id, **fields))
+
+    @staticmethod
+    async def _load_snapshot(user_id: int) -> dict:
+        """خواندن اطلاعات پروفایل از دیتابیس"""
+        if Database.shares_file(USERS_DB_PATH, WALLET_DB_PATH, COINS_DB_PATH):
+            # هر سه جدول در یک فایل هستند: یک پرس‌وجو روی کلیدهای اصلی
+            row = await Database.fetchone(
+                USERS_DB_PATH,
+                """
+                SELECT u.user_id IS NOT NULL, u.registered_at, w.balance_sats, c.coins, c.avatar, c.dark_mode
+                FROM (SELECT ? AS user_id) AS k
+                LEFT JOIN users u ON u.user_id = k.user_id
+                LEFT JOIN wallets w ON w.user_id = k.user_id
+                LEFT JOIN user_coins c ON c.user_id = k.user_id
+                """,
+                (user_id,)
+            )
+            is_registered, registered_at, balance_sats, coins, avatar, dark_mode = row
+        else:
+            registered, wallet, coin_row = await asyncio.gather(
+                Database.fetchone(
+                    USERS_DB_PATH, "SELECT registered_at FROM users WHERE user_id = ?", (user_id,)
+                ),
+                Database.fetchone(
+                    WALLET_DB_PATH, "SELECT balance_sats FROM wallets WHERE user_id = ?", (user_id,)
+                ),
+                Database.fetchone(
+                    COINS_DB_PATH,
+                    "SELECT coins, avatar, dark_mode FROM user_coins WHERE user_id = ?",
+                    (user_id,)
+                ),
+            )
+            is_registered = registered is not None
+            registered_at = registered[0] if registered else None
+            balance_sats = wallet[0] if wallet else None
+            coins, avatar, dark_mode = coin_row if coin_row else (None, None, None)
+        
+        return {
+            "user_id": user_id,
+            "registered": bool(is_registered),
+            "registered_at": registered_at,
+            "balance": WalletManager.to_btc(balance_sats or 0),
+            "coins": coins if coins is not None else 0,
+            "avatar": avatar if avatar is not None else "mafia",
+            "dark_mode": bool(dark_mode),
+        }
+
+
+# *********************** موتور رندر تصاویر ***********************
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", max(1, min(4, (os.cpu_count() or 2) - 1))))
+RENDER_CACHE_MAX_BYTES = int(os.getenv("RENDER_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+RENDER_CACHE_MAX_ENTRIES = int(os.getenv("RENDER_CACHE_MAX_ENTRIES", 2048))
+RENDER_CACHE_TTL = int(os.getenv("RENDER_CACHE_TTL", 600))
+WHEEL_SPIN_FRAMES = int(os.getenv("WHEEL_SPIN_FRAMES", 36))
+WHEEL_SPIN_TURNS = 3
+SPIN_LATENCY_TARGET = float(os.getenv("SPIN_LATENCY_TARGET", 1.5))
+START_LATENCY_TARGET = float(os.getenv("START_LATENCY_TARGET", 1.0))
+TEXT_RUN_CACHE_SIZE = int(os.getenv("TEXT_RUN_CACHE_SIZE", 256))
+CARD_MAX_BYTES = int(os.getenv("CARD_MAX_BYTES", 256 * 1024))
+
+# قالب خروجی هر کارت: palette (PNG با پالت محدود)، png، webp یا jpeg
+# کارت‌ها رنگ‌های تخت دارند و PNG پالتی حدود یک سوم PNG معمولی حجم دارد
+DEFAULT_CARD_ENCODING = {"format": "palette", "colors": 64}
+CARD_ENCODINGS = {
+    "profile": {"format": "palette", "colors": 96},
+    "license": {"format": "palette", "colors": 32},
+}
+# تغییر قالب از طریق محیط، مثلاً CARD_ENCODING="profile=webp,invoice=jpeg"
+CARD_FORMAT_OVERRIDES = dict(
+    item.split("=", 1) for item in os.getenv("CARD_ENCODING", "").replace(" ", "").split(",") if "=" in item
+)
+
+
+def _encode_image(img: Image.Image, fmt: str, settings: dict) -> bytes:
+    """ذخیره تصویر در بایت با قالب مشخص"""
+    img_byte_arr = io.BytesIO()
+    if fmt == "palette":
+        palette_img = img.quantize(
+            colors=settings.get("colors", 64),
+            method=Image.Quantize.FASTOCTREE,
+            dither=Image.Dither.NONE,
+        )
+        palette_img.save(img_byte_arr, format='PNG')
+    elif fmt == "png":
+        img.save(img_byte_arr, format='PNG', optimize=True)
+    elif fmt == "webp":
+        img.save(img_byte_arr, format='WEBP', quality=settings.get("quality", 80), method=4)
+    elif fmt == "jpeg":
+        img.save(img_byte_arr, format='JPEG', quality=settings.get("quality", 85), optimize=True)
+    else:
+        raise ValueError(f"قالب تصویر نامعتبر: {fmt}")
+    return img_byte_arr.getvalue()
+
+
+def encode_card(kind: str, img: Image.Image) -> bytes:
+    """کدگذاری کارت با قالب تعیین شده و رعایت سقف حجم"""
+    settings = CARD_ENCODINGS.get(kind, DEFAULT_CARD_ENCODING)
+    fmt = CARD_FORMAT_OVERRIDES.get(kind, settings["format"])
+    data = _encode_image(img, fmt, settings)
+    
+    # در صورت عبور از سقف حجم، JPEG با کیفیت کاهشی
+    max_bytes = settings.get("max_bytes", CARD_MAX_BYTES)
+    quality = 85
+    while len(data) > max_bytes and quality >= 40:
+        data = _encode_image(img, "jpeg", {"quality": quality})
+        quality -= 15
+    return data
+
+
+@lru_cache(maxsize=TEXT_RUN_CACHE_SIZE)
+def _text_run(text: str, font: ImageFont.FreeTypeFont) -> Tuple[Image.Image, Tuple[int, int]]:
+    """ماسک رستر شده یک متن؛ برچسب‌های تکراری فقط یک بار شکل‌دهی و رستر می‌شوند"""
+    left, top, right, bottom = font.getbbox(text)
+    mask = Image.new('L', (max(1, right - left), max(1, bottom - top)))
+    ImageDraw.Draw(mask).text((-left, -top), text, font=font, fill=255)
+    return mask, (left, top)
+
+
+def draw_text(img: Image.Image, xy: Tuple[float, float], text: str,
+              font: ImageFont.FreeTypeFont, fill: Tuple[int, int, int]) -> None:
+    """رسم متن تکراری از روی ماسک کش شده"""
+    mask, (left, top) = _text_run(text, font)
+    img.paste(fill, (round(xy[0]) + left, round(xy[1]) + top), mask)
+
+
+CARD_THEMES = {
+    "dark": {"background": (30, 30, 60), "text": (255, 255, 255), "secondary": (200, 200, 255)},
+    "light": {"background": (240, 240, 240), "text": (0, 0, 0), "secondary": (100, 100, 150)},
+}
+
+PROFILE_FIELDS = [
+    ("👤 نام کاربری: ", "username"),
+    ("🆔 شناسه کاربری: ", "user_id"),
+    ("📅 تاریخ عضویت: ", "join_date"),
+    ("🪙 سکه‌ها: ", "coins"),
+    ("🏆 سطح: ", "level"),
+]
+PROFILE_PROGRESS_Y = 120 + 40 * len(PROFILE_FIELDS)
+
+
+def _wallet_template(theme: str) -> Image.Image:
+    """لایه ثابت کیف پول"""
+    img = Image.new('RGB', (600, 400), color=(20, 20, 40))
+    draw = ImageDraw.Draw(img)
+    draw.text((50, 50), "💰 کیف پول بیت کوین", font=TITLE_FONT, fill=(255, 255, 255))
+    draw.text((50, 150), "🪙 سکه‌های شما", font=TITLE_FONT, fill=(255, 255, 255))
+    draw.text((50, 250), f"هر 300 سکه = 0.00002 BTC (~50,000 تومان)", font=MONO_FONT, fill=(200, 200, 255))
+    return img
+
+
+def _referral_template(theme: str) -> Image.Image:
+    """لایه ثابت سیستم معرفی"""
+    img = Image.new('RGB', (600, 400), color=(30, 30, 60))
+    draw = ImageDraw.Draw(img)
+    draw.rectangle([(0, 0), (600, 60)], fill=(50, 50, 100))
+    draw.text((150, 20), "سیستم معرفی دوستان", font=TITLE_FONT, fill=(255, 255, 255))
+    draw.text((50, 100), f"کد معرف شما:", font=MONO_FONT, fill=(200, 200, 255))
+    draw.text((50, 180), f"تعداد معرفی‌های شما:", font=MONO_FONT, fill=(200, 200, 255))
+    draw.text((50, 260), "پاداش: 50,000 تومان بیت کوین", font=MONO_FONT, fill=(200, 255, 200))
+    draw.text((50, 290), "برای هر 10 معرفی موفق", font=MONO_FONT, fill=(200, 255, 200))
+    return img
+
+
+def _profile_template(theme: str) -> Image.Image:
+    """لایه ثابت کارت پروفایل: هدر، برچسب‌ها و قاب نوار پیشرفت"""
+    colors = CARD_THEMES[theme]
+    img = Image.new('RGB', (800, 600), color=colors["background"])
+    draw = ImageDraw.Draw(img)
+    
+    draw.rectangle([(0, 0), (800, 80)], fill=(50, 50, 100))
+    draw.text((20, 20), "پروفایل کاربری RedHotMafia", font=TITLE_FONT, fill=(255, 255, 255))
+    
+    y_position = 120
+    for label, _ in PROFILE_FIELDS:
+        draw.text((200, y_position), label, font=MONO_FONT, fill=colors["text"])
+        y_position += 40
+    
+    draw.rectangle(
+        [(200, PROFILE_PROGRESS_Y), (600, PROFILE_PROGRESS_Y + 20)], outline=colors["secondary"], width=2
+    )
+    return img
+
+
+def _leaderboard_template(theme: str) -> Image.Image:
+    """لایه ثابت جدول رتبه‌بندی"""
+    img = Image.new('RGB', (800, 600), color=(30, 30, 60))
+    draw = ImageDraw.Draw(img)
+    draw.rectangle([(0, 0), (800, 80)], fill=(50, 50, 100))
+    draw.text((250, 20), "جدول رتبه‌بندی", font=TITLE_FONT, fill=(255, 255, 255))
+    return img
+
+
+def _invoice_template(theme: str) -> Image.Image:
+    """لایه ثابت فاکتور"""
+    img = Image.new('RGB', (800, 600), color=(240, 240, 240))
+    draw = ImageDraw.Draw(img)
+    draw.rectangle([(0, 0), (800, 80)], fill=(30, 30, 60))
+    draw.text((20, 20), "فاکتور سفارش RedHotMafia", font=TITLE_FONT, fill=(255, 255, 255))
+    return img
+
+
+CARD_TEMPLATES = {
+    "wallet": _wallet_template,
+    "referral": _referral_template,
+    "profile": _profile_template,
+    "leaderboard": _leaderboard_template,
+    "invoice": _invoice_template,
+}
+
+# لایه‌های ثابت در هر پروسه رندر یک بار ساخته می‌شوند
+_template_layers: Dict[Tuple[str, str], Image.Image] = {}
+
+
+def card_canvas(name: str, theme: str = "dark") -> Tuple[Image.Image, ImageDraw.ImageDraw]:
+    """کپی لایه ثابت یک کارت برای نوشتن فیلدهای پویا"""
+    key = (name, theme)
+    layer = _template_layers.get(key)
+    if layer is None:
+        layer = CARD_TEMPLATES[name](theme)
+        _template_layers[key] = layer
+    img = layer.copy()
+    return img, ImageDraw.Draw(img)
+
+
+def render_wallet_card(spec: dict) -> Image.Image:
+    """تولید تصویر کیف پول دیجیتال"""
+    img, draw = card_canvas("wallet")
+    draw.text((50, 90), f"موجودی: {spec['balance']:.8f} BTC", font=MONO_FONT, fill=(200, 255, 200))
+    draw.text((50, 190), f"تعداد: {spec['coins']} سکه", font=MONO_FONT, fill=(255, 215, 0))
+    return img
+
+
+def render_referral_card(spec: dict) -> Image.Image:
+    """تولید تصویر سیستم معرفی"""
+    img, draw = card_canvas("referral")
+    draw.text((50, 130), spec['referral_code'], font=TITLE_FONT, fill=(0, 255, 255))
+    draw.text((50, 210), f"{spec['referral_count']}/10", font=TITLE_FONT, fill=(255, 255, 0))
+    return img
+
+
+WHEEL_BACKGROUND = (30, 30, 60)
+
+
+def _draw_wheel_disc() -> Image.Image:
+    """رسم صفحه گردونه بدون نشانگر"""
+    img = Image.new('RGB', (500, 500), color=WHEEL_BACKGROUND)
+    draw = ImageDraw.Draw(img)
+    
+    # رسم گردونه
+    center = (250, 250)
+    radius = 200
+    prizes = ["1 سکه", "3 سکه", "5 سکه", "10 سکه", "کد تخفیف 10%"]
+    colors = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 0), (255, 0, 255)]
+    
+    for i in range(5):
+        start_angle = i * 72
+        end_angle = (i + 1) * 72
+        draw.pieslice(
+            [center[0]-radius, center[1]-radius, center[0]+radius, center[1]+radius],
+            start_angle, end_angle, fill=colors[i]
+        )
+        
+        # افزودن متن جایزه
+        angle = math.radians(start_angle + 36)
+        text_pos = (
+            center[0] + (radius * 0.7) * math.cos(angle),
+            center[1] + (radius * 0.7) * math.sin(angle)
+        )
+        draw.text(text_pos, prizes[i], font=TITLE_FONT, fill=(0, 0, 0))
+    
+    return img
+
+
+def _draw_wheel_pointer(img: Image.Image) -> None:
+    """افزودن نشانگر ثابت بالای گردونه"""
+    center = (250, 250)
+    radius = 200
+    ImageDraw.Draw(img).polygon(
+        [(center[0], center[1]-radius-20), (center[0]-15, center[1]-radius), 
+         (center[0]+15, center[1]-radius)], fill=(255, 255, 255))
+
+
+def render_wheel_card(spec: dict) -> Image.Image:
+    """تولید تصویر گردونه شانس"""
+    img = _draw_wheel_disc()
+    _draw_wheel_pointer(img)
+    return img
+
+
+def render_wheel_spin(spec: dict) -> bytes:
+    """تولید انیمیشن GIF چرخش گردونه (یک بار برای همه کاربران)"""
+    disc = _draw_wheel_disc()
+    frames_count = spec.get("frames", WHEEL_SPIN_FRAMES)
+    turns = spec.get("turns", WHEEL_SPIN_TURNS)
+    
+    frames = []
+    durations = []
+    for i in range(frames_count):
+        # حرکت کند شونده: ابتدا سریع و در انتها آرام
+        t = (i + 1) / frames_count
+        angle = 360 * turns * (1 - (1 - t) ** 3)
+        frame = disc.rotate(-angle, resample=Image.BICUBIC, fillcolor=WHEEL_BACKGROUND)
+        _draw_wheel_pointer(frame)
+        frames.append(frame)
+        durations.append(int(40 + 160 * t ** 2))
+    
+    # پالت مشترک از اولین فریم؛ رنگ‌های گردونه در همه فریم‌ها یکسان است
+    palette = frames[0].quantize(colors=64, method=Image.MEDIANCUT)
+    frames = [frame.quantize(palette=palette, dither=Image.Dither.NONE) for frame in frames]
+    
+    buffer = io.BytesIO()
+    frames[0].save(
+        buffer, format='GIF', save_all=True, append_images=frames[1:],
+        duration=durations, loop=0, optimize=True
+    )
+    return buffer.getvalue()
+
+
+def render_profile_card(spec: dict) -> Image.Image:
+    """تولید کارت پروفایل گرافیکی"""
+    theme = "dark" if spec['dark_mode'] else "light"
+    text_color = CARD_THEMES[theme]["text"]
+    img, draw = card_canvas("profile", theme)
+    
+    # آواتار
+    avatar_emoji = AVATARS.get(spec['avatar'], "🕴️")
+    draw_text(img, (50, 120), avatar_emoji, AVATAR_FONT, text_color)
+    
+    # مقادیر کاربر کنار برچسب‌های ثابت
+    y_position = 120
+    for label, field in PROFILE_FIELDS:
+        x_position = 200 + MONO_FONT.getlength(label)
+        draw.text((x_position, y_position), str(spec[field]), font=MONO_FONT, fill=text_color)
+        y_position += 40
+    
+    # نوار پیشرفت
+    progress = spec['progress']
+    draw.rectangle(
+        [(200, PROFILE_PROGRESS_Y), (200 + (400 * progress // 100), PROFILE_PROGRESS_Y + 20)], fill=(0, 255, 0)
+    )
+    draw_text(img, (610, PROFILE_PROGRESS_Y), f"{progress}%", MONO_FONT, text_color)
+    
+    return img
+
+
+def render_leaderboard_card(spec: dict) -> Image.Image:
+    """تولید تصویر جدول رتبه‌بندی"""
+    img, draw = card_canvas("leaderboard")
+    
+    # اطلاعات رتبه‌بندی
+    y_position = 100
+    for i, (username, coins) in enumerate(spec['leaderboard'][:5], start=1):
+        draw.text((50, y_position), f"{i}. {username}", font=MONO_FONT, fill=(200, 200, 255))
+        draw.text((600, y_position), f"{coins} سکه", font=MONO_FONT, fill=(255, 215, 0))
+        y_position += 40
+    
+    # نمایش رتبه کاربر
+    if spec['user_rank']:
+        draw.text((50, 500), f"رتبه شما: {spec['user_rank']}", font=TITLE_FONT, fill=(0, 255, 255))
+    
+    return img
+
+
+def render_license_card(spec: dict) -> Image.Image:
+    """تولید کارت لایسنس گرافیکی"""
+    img = Image.new('RGB', (600, 300), color=(0, 0, 0))
+    draw = ImageDraw.Draw(img)
+    
+    # افزودن افکت هکری (با seed مشخص تا خروجی قابل تکرار باشد)
+    rng = random.Random(spec['seed'])
+    for _ in range(50):
+        x1, y1 = rng.randint(0, 600), rng.randint(0, 300)
+        x2, y2 = rng.randint(0, 600), rng.randint(0, 300)
+        draw.line([(x1, y1), (x2, y2)], fill=(0, 255, 0), width=1)
+    
+    # افزودن متن لایسنس
+    draw_text(img, (150, 100), "REDHOT MAFIA LICENSE", TITLE_FONT, (0, 255, 0))
+    draw.text((150, 150), spec['license_code'], font=TITLE_FONT, fill=(0, 255, 255))
+    draw_text(img, (150, 200), "Valid for 30 days", MONO_FONT, (255, 255, 255))
+    
+    return img
+
+
+def render_invoice_card(spec: dict) -> Image.Image:
+    """تولید فاکتور گرافیکی"""
+    img, draw = card_canvas("invoice")
+    
+    # جزئیات سفارش
+    y_position = 100
+    for key, value in spec['order_details']:
+        draw.text((20, y_position), f"{key}: {value}", font=MONO_FONT, fill=(0, 0, 0))
+        y_position += 30
+    
+    return img
+
+
+CARD_RENDERERS = {
+    "wallet": render_wallet_card,
+    "referral": render_referral_card,
+    "wheel": render_wheel_card,
+    "wheel_spin": render_wheel_spin,
+    "profile": render_profile_card,
+    "leaderboard": render_leaderboard_card,
+    "license": render_license_card,
+    "invoice": render_invoice_card,
+}
+
+
+def render_card_timed(kind: str, spec: dict) -> Tuple[bytes, float]:
+    """رندر و کدگذاری یک کارت (قابل اجرا در پروسه جداگانه) به همراه زمان کدگذاری"""
+    result = CARD_RENDERERS[kind](spec)
+    if isinstance(result, bytes):
+        # انیمیشن‌ها خودشان کدگذاری می‌شوند
+        return result, 0.0
+    started = time.perf_counter()
+    data = encode_card(kind, result)
+    return data, time.perf_counter() - started
+
+
+def render_card(kind: str, spec: dict) -> bytes:
+    """رندر یک کارت از روی مشخصات ساده (قابل اجرا در پروسه جداگانه)"""
+    return render_card_timed(kind, spec)[0]
+
+
+def render_key(kind: str, spec: dict) -> str:
+    """کلید محتوایی یک کارت: هش نوع کارت و ورودی‌های رندر"""
+    payload = json.dumps([kind, spec], sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class RenderCache:
+    """کش LRU با انقضای زمانی برای بایت‌های کارت‌های رندر شده"""
+
+    def __init__(
+        self,
+        max_bytes: int = RENDER_CACHE_MAX_BYTES,
+        max_entries: int = RENDER_CACHE_MAX_ENTRIES,
+        ttl: float = RENDER_CACHE_TTL,
+    ):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # کلید -> (بایت‌ها، زمان انقضا، برچسب کاربر)
+        self._entries: "OrderedDict[str, Tuple[bytes, float, Optional[int]]]" = OrderedDict()
+        self._tags: Dict[int, set] = {}
+
+    def get(self, key: str) -> Optional[bytes]:
+        """دریافت تصویر از کش"""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        
+        data, expires_at, _ = entry
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return None
+        
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return data
+
+    def put(self, key: str, data: bytes, tag: Optional[int] = None, ttl: Optional[float] = None) -> None:
+        """ذخیره تصویر در کش"""
+        if len(data) > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._entries[key] = (data, expires_at, tag)
+        self.size_bytes += len(data)
+        if tag is not None:
+            self._tags.setdefault(tag, set()).add(key)
+        
+        # حذف قدیمی‌ترین موارد تا رسیدن به سقف حافظه و تعداد
+        while self._entries and (
+            self.size_bytes > self.max_bytes or len(self._entries) > self.max_entries
+        ):
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def invalidate(self, tag: int) -> None:
+        """حذف تمام کارت‌های یک کاربر پس از تغییر اطلاعات او"""
+        for key in self._tags.pop(tag, ()):
+            self._remove(key)
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        data, _, tag = entry
+        self.size_bytes -= len(data)
+        if tag is not None:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def get_stats(self) -> dict:
+        """آمار کش"""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+# کش مشترک کارت‌ها؛ مدیرهای سکه و کیف پول پس از هر تغییر آن را باطل می‌کنند
+render_cache = RenderCache()
+
+
+class CardImage:
+    """مشخصات یک کارت قابل رندر: نوع، ورودی‌ها و تنظیمات کش"""
+
+    __slots__ = ("kind", "spec", "tag", "ttl", "cache", "animated")
+
+    def __init__(
+        self,
+        kind: str,
+        spec: dict,
+        tag: Optional[int] = None,
+        ttl: Optional[float] = None,
+        cache: bool = True,
+        animated: bool = False,
+    ):
+        self.kind = kind
+        self.spec = spec
+        self.tag = tag
+        self.ttl = ttl
+        self.cache = cache
+        self.animated = animated
+
+    @property
+    def key(self) -> str:
+        """هش محتوایی کارت"""
+        return render_key(self.kind, self.spec)
+
+
+class RenderService:
+    """اجرای رندر کارت‌ها در استخر پروسه محدود، خارج از حلقه رویداد"""
+
+    def __init__(self, workers: int = RENDER_WORKERS, cache: RenderCache = render_cache):
+        self.workers = max(1, workers)
+        self.cache = cache
+        self.mode = None
+        self.rendered = 0
+        self.render_seconds = 0.0
+        # آمار کدگذاری هر نوع کارت: [تعداد، مجموع بایت، مجموع زمان کدگذاری]
+        self.encode_stats: Dict[str, List[float]] = {}
+        self._executor = None
+        self._inflight: Dict[str, asyncio.Future] = {}
+        # محدود کردن کارهای در صف تا حافظه در بار زیاد کنترل شود
+        self._slots = asyncio.Semaphore(self.workers * 2)
+
+    def start(self) -> None:
+        """راه‌اندازی استخر پروسه (یا استخر نخ در صورت عدم پشتیبانی)"""
+        if self._executor is not None:
+            return
+        try:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            self.mode = "process"
+        except (OSError, ImportError, NotImplementedError) as e:
+            logger.warning(f"استخر پروسه در دسترس نیست، رندر در استخر نخ انجام می‌شود: {e}")
+            self._use_threads()
+
+    def _use_threads(self) -> None:
+        """جایگزینی استخر با استخر نخ"""
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="render")
+        self.mode = "thread"
+
+    def shutdown(self) -> None:
+        """توقف استخر رندر"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def render(
+        self,
+        kind: str,
+        spec: dict,
+        tag: Optional[int] = None,
+        cache: bool = True,
+        ttl: Optional[float] = None,
+    ) -> bytes:
+        """رندر یک کارت (یا دریافت آن از کش) بدون مسدود کردن حلقه رویداد"""
+        if not cache:
+            return await self._render(kind, spec)
+        
+        key = render_key(kind, spec)
+        data = self.cache.get(key)
+        if data is not None:
+            return data
+        
+        # درخواست‌های همزمان برای یک کارت فقط یک بار رندر می‌شوند
+        pending = self._inflight.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+        
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            data = await self._render(kind, spec)
+            self.cache.put(key, data, tag=tag, ttl=ttl)
+            future.set_result(data)
+            return data
+        except BaseException as e:
+            future.set_exception(e)
+            # جلوگیری از هشدار «exception never retrieved» در صورت نبود منتظر دیگر
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+
+    async def render_card(self, card: CardImage) -> bytes:
+        """رندر یک کارت بر اساس مشخصات آن"""
+        return await self.render(card.kind, card.spec, tag=card.tag, cache=card.cache, ttl=card.ttl)
+
+    async def _render(self, kind: str, spec: dict) -> bytes:
+        """اجرای رندر در استخر"""
+        self.start()
+        loop = asyncio.get_running_loop()
+        
+        async with self._slots:
+            started = time.perf_counter()
+            try:
+                data, encode_seconds = await loop.run_in_executor(
+                    self._executor, render_card_timed, kind, spec
+                )
+            except BrokenProcessPool as e:
+                logger.error(f"استخر پروسه رندر از کار افتاد، ادامه با استخر نخ: {e}")
+                self.shutdown()
+                self._use_threads()
+                data, encode_seconds = await loop.run_in_executor(
+                    self._executor, render_card_timed, kind, spec
+                )
+            self.rendered += 1
+            self.render_seconds += time.perf_counter() - started
+        
+        stats = self.encode_stats.setdefault(kind, [0, 0, 0.0])
+        stats[0] += 1
+        stats[1] += len(data)
+        stats[2] += encode_seconds
+        logger.debug(f"کارت {kind}: {len(data)} بایت، کدگذاری {encode_seconds * 1000:.1f}ms")
+        return data
+
+    def get_stats(self) -> dict:
+        """آمار رندر (تعداد کارت، میانگین زمان و وضعیت کش)"""
+        average = self.render_seconds / self.rendered if self.rendered else 0.0
+        return {
+            "mode": self.mode,
+            "rendered": self.rendered,
+            "avg_seconds": average,
+            "encoding": {
+                kind: {
+                    "count": count,
+                    "avg_bytes": total_bytes / count,
+                    "avg_encode_ms": encode_seconds / count * 1000,
+                }
+                for kind, (count, total_bytes, encode_seconds) in self.encode_stats.items()
+            },
+            "cache": self.cache.get_stats(),
+        }
+
+
+class LatencyTracker:
+    """نگهداری زمان‌های اخیر یک مسیر و مقایسه با زمان هدف"""
+
+    def __init__(self, name: str, target: float, window: int = 500):
+        self.name = name
+        self.target = target
+        self.samples: deque = deque(maxlen=window)
+        self.over_target = 0
+
+    def observe(self, seconds: float) -> None:
+        """ثبت یک نمونه زمان (ثانیه)"""
+        self.samples.append(seconds)
+        if seconds > self.target:
+            self.over_target += 1
+            logger.warning(f"زمان {self.name} ({seconds:.2f}s) از هدف {self.target:.2f}s بیشتر شد")
+
+    def percentile(self, q: float) -> float:
+        """صدک q از نمونه‌های اخیر"""
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, max(0, math.ceil(q / 100 * len(ordered)) - 1))
+        return ordered[index]
+
+    def get_stats(self) -> dict:
+        """خلاصه آمار زمان پاسخ"""
+        return {
+            "count": len(self.samples),
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "target": self.target,
+            "over_target": self.over_target,
+        }
+
+
+MEDIA_CACHE_MAX_ENTRIES = int(os.getenv("MEDIA_CACHE_MAX_ENTRIES", 10000))
+MEDIA_CACHE_DAYS = int(os.getenv("MEDIA_CACHE_DAYS", 30))
+
+
+class MediaRegistry:
+    """نگهداری file_id تلگرام برای تصاویر آپلود شده بر اساس هش محتوای رندر"""
+
+    def __init__(self, max_entries: int = MEDIA_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._file_ids: "OrderedDict[str, str]" = OrderedDict()
+
+    async def init_db(self) -> None:
+        """ایجاد جدول file_id ها و حذف موارد قدیمی"""
+        async with Database.transaction(STATS_DB_PATH) as db:
+            await db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS media_cache (
+                    content_hash TEXT PRIMARY KEY,
+                    file_id TEXT NOT NULL,
+                    last_used DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+                """
+            )
+            await db.execute(
+                "DELETE FROM media_cache WHERE last_used < datetime('now', ?)",
+                (f"-{MEDIA_CACHE_DAYS} days",)
+            )
+
+    def _store(self, content_hash: str, file_id: str) -> None:
+        self._file_ids[content_hash] = file_id
+        self._file_ids.move_to_end(content_hash)
+        while len(self._file_ids) > self.max_entries:
+            self._file_ids.popitem(last=False)
+
+    async def get(self, content_hash: str) -> Optional[str]:
+        """دریافت file_id ذخیره شده برای یک محتوا"""
+        file_id = self._file_ids.get(content_hash)
+        if file_id is not None:
+            self._file_ids.move_to_end(content_hash)
+            self.hits += 1
+            return file_id
+        
+        row = await Database.fetchone(
+            STATS_DB_PATH,
+            "SELECT file_id FROM media_cache WHERE content_hash = ?",
+            (content_hash,)
+        )
+        if row is None:
+            self.misses += 1
+            return None
+        
+        self.hits += 1
+        self._store(content_hash, row[0])
+        await Database.execute(
+            STATS_DB_PATH,
+            "UPDATE media_cache SET last_used = CURRENT_TIMESTAMP WHERE content_hash = ?",
+            (content_hash,)
+        )
+        return row[0]
+
+    async def remember(self, content_hash: str, file_id: str) -> None:
+        """ذخیره file_id بازگشتی تلگرام پس از اولین آپلود"""
+        if self._file_ids.get(content_hash) == file_id:
+            return
+        self._store(content_hash, file_id)
+        try:
+            await Database.execute(
+                STATS_DB_PATH,
+                """
+                INSERT INTO media_cache (content_hash, file_id) VALUES (?, ?)
+                ON CONFLICT(content_hash) DO UPDATE
+                SET file_id = excluded.file_id, last_used = CURRENT_TIMESTAMP
+                """,
+                (content_hash, file_id)
+            )
+        except Exception as e:
+            logger.error(f"خطا در ذخیره file_id: {e}")
+
+    async def forget(self, content_hash: str) -> None:
+        """حذف file_id نامعتبر"""
+        self._file_ids.pop(content_hash, None)
+        await Database.execute(
+            STATS_DB_PATH, "DELETE FROM media_cache WHERE content_hash = ?", (content_hash,)
+        )
+
+
+SCHEDULER_BATCH_SIZE = int(os.getenv("SCHEDULER_BATCH_SIZE", 100))
+SCHEDULER_MAX_SLEEP = 60.0
+SCHEDULER_LAG_TARGET = 5.0
+SCHEDULER_MAX_ATTEMPTS = 5
+SCHEDULER_MAX_BACKOFF = 15 * 60
+SCHEDULER_JOB_BUDGET = float(os.getenv("SCHEDULER_JOB_BUDGET", 10))
+SCHEDULER_RETENTION_DAYS = 7
+
+
+class JobScheduler:
+    """زمان‌بند کارهای ماندگار: کارها در دیتابیس هستند و یک حلقه تا نزدیک‌ترین موعد می‌خوابد"""
+
+    def __init__(self):
+        # نوع کار -> تابع اجرا کننده؛ خروجی عددی یعنی زمان اجرای بعدی (کار تکرار شونده)
+        self.handlers: Dict[str, Callable] = {}
+        # کارهای تکرار شونده هیچ‌وقت failed نمی‌شوند و پس از خطا با فاصله محدود دوباره اجرا می‌شوند
+        self.recurring = set()
+        self.lag = LatencyTracker("تأخیر زمان‌بند", SCHEDULER_LAG_TARGET)
+        self.completed = 0
+        self.failed = 0
+        self._wakeup = asyncio.Event()
+        self._next_run: Optional[float] = None
+        # کارهای طولانی که از دسته جدا شده‌اند و نتیجه‌شان را خودشان ثبت می‌کنند
+        self._detached = set()
+
+    def register(self, kind: str, handler: Callable, recurring: bool = False) -> None:
+        """ثبت اجرا کننده یک نوع کار"""
+        self.handlers[kind] = handler
+        if recurring:
+            self.recurring.add(kind)
+
+    async def init_db(self) -> None:
+        """ایجاد جدول کارها و بازگرداندن کارهای نیمه‌تمام به صف"""
+        async with Database.transaction(STATS_DB_PATH) as db:
+            await db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS scheduled_jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    run_at REAL NOT NULL,
+                    payload TEXT NOT NULL DEFAULT '{}',
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    dedup_key TEXT UNIQUE,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+                """
+            )
+            await db.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_scheduled_jobs_due
+                ON scheduled_jobs (run_at) WHERE status = 'pending'
+                """
+            )
+            # کارهایی که هنگام خاموش شدن در حال اجرا بودند دوباره اجرا می‌شوند
+            await db.execute("UPDATE scheduled_jobs SET status = 'pending' WHERE status = 'running'")
+            await db.execute(
+                "DELETE FROM scheduled_jobs WHERE status IN ('done', 'failed') AND run_at < ?",
+                (time.time() - SCHEDULER_RETENTION_DAYS * 86400,)
+            )
+            overdue = await db.execute_fetchall(
+                "SELECT COUNT(*), MIN(run_at) FROM scheduled_jobs WHERE status = 'pending' AND run_at <= ?",
+                (time.time(),)
+            )
+        count, oldest = overdue[0]
+        if count:
+            logger.warning(
+                f"{count} کار عقب‌افتاده از پیش از راه‌اندازی از سر گرفته می‌شود "
+                f"(بیشترین تأخیر {time.time() - oldest:.0f} ثانیه)"
+            )
+
+    async def schedule(
+        self, kind: str, run_at: float, payload: Optional[dict] = None, dedup_key: Optional[str] = None
+    ) -> bool:
+        """ثبت یک کار برای زمان run_at (ثانیه یونیکس)
+
+        کار فعال با همان کلید نادیده گرفته می‌شود؛ کار تمام‌شده یا شکست‌خورده با همان کلید
+        دوباره در صف قرار می‌گیرد.
+        """
+        try:
+            added = await Database.execute(
+                STATS_DB_PATH,
+                """
+                INSERT INTO scheduled_jobs (kind, run_at, payload, dedup_key)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(dedup_key) DO UPDATE SET
+                    status = 'pending', attempts = 0, run_at = excluded.run_at
+                WHERE status IN ('failed', 'done')
+                """,
+                (kind, run_at, json.dumps(payload or {}), dedup_key)
+            )
+            if added and (self._next_run is None or run_at < self._next_run):
+                self._wakeup.set()
+            return bool(added)
+        except Exception as e:
+            logger.error(f"خطا در زمان‌بندی کار {kind}: {e}")
+            return False
+
+    async def run(self) -> None:
+        """حلقه اصلی: اجرای کارهای سررسید و خواب تا موعد بعدی"""
+        while True:
+            # پاک کردن پیش از خواندن موعد بعدی تا سیگنال schedule در این فاصله گم نشود
+            self._wakeup.clear()
+            try:
+                await self._run_due()
+                row = await Database.fetchone(
+                    STATS_DB_PATH, "SELECT MIN(run_at) FROM scheduled_jobs WHERE status = 'pending'"
+                )
+                self._next_run = row[0]
+            except Exception as e:
+                logger.error(f"خطا در حلقه زمان‌بند: {e}")
+                self._next_run = None
+            
+            delay = SCHEDULER_MAX_SLEEP
+            if self._next_run is not None:
+                delay = min(delay, max(0.0, self._next_run - time.time()))
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run_due(self) -> None:
+        """اجرای همه کارهای سررسید در دسته‌های محدود"""
+        while True:
+            async with Database.transaction(STATS_DB_PATH) as db:
+                jobs = await db.execute_fetchall(
+                    """
+                    UPDATE scheduled_jobs SET status = 'running', attempts = attempts + 1
+                    WHERE id IN (
+                        SELECT id FROM scheduled_jobs
+                        WHERE status = 'pending' AND run_at <= ?
+                        ORDER BY run_at
+                        LIMIT ?
+                    )
+                    RETURNING id, kind, run_at, payload, attempts
+                    """,
+                    (time.time(), SCHEDULER_BATCH_SIZE)
+                )
+            if not jobs:
+                return
+            
+            # تأخیر حلقه بر اساس قدیمی‌ترین کار هر دسته (ترتیب RETURNING مشخص نیست)
+            self.lag.observe(max(0.0, time.time() - min(job[2] for job in jobs)))
+            tasks = [asyncio.ensure_future(self._run_job(*job)) for job in jobs]
+            done, pending = await asyncio.wait(tasks, timeout=SCHEDULER_JOB_BUDGET)
+            
+            # کارهای طولانی (مثلاً اعلان روزانه به همه کاربران) بقیه دسته را معطل نمی‌کنند
+            for task in pending:
+                detached = asyncio.ensure_future(self._finish_detached(task))
+                self._detached.add(detached)
+                detached.add_done_callback(self._detached.discard)
+            
+            # نتیجه کارهای تمام شده دسته در یک تراکنش ثبت می‌شود
+            await self._save_results([task.result() for task in tasks if task in done])
+            if len(jobs) < SCHEDULER_BATCH_SIZE:
+                return
+
+    async def _save_results(self, results: List[Tuple[str, Optional[float], bool, int]]) -> None:
+        async with Database.transaction(STATS_DB_PATH) as db:
+            await db.executemany(
+                "UPDATE scheduled_jobs SET status = ?, run_at = COALESCE(?, run_at), "
+                "attempts = CASE WHEN ? THEN 0 ELSE attempts END WHERE id = ?",
+                results
+            )
+
+    async def _finish_detached(self, task: asyncio.Task) -> None:
+        try:
+            await self._save_results([await task])
+        except Exception as e:
+            logger.error(f"خطا در ثبت نتیجه کار زمان‌بندی شده: {e}")
+        # موعد بعدی کار ممکن است زودتر از خواب فعلی حلقه باشد
+        self._wakeup.set()
+
+    async def _run_job(
+        self, job_id: int, kind: str, run_at: float, payload: str, attempts: int
+    ) -> Tuple[str, Optional[float], bool, int]:
+        """اجرای یک کار؛ خروجی (وضعیت جدید، زمان اجرای بعدی، صفر کردن تلاش‌ها، شناسه)"""
+        try:
+            handler = self.handlers[kind]
+            next_run = await handler(**json.loads(payload))
+        except Exception as e:
+            logger.error(f"خطا در اجرای کار {kind} (#{job_id}): {e}")
+            if kind in self.recurring:
+                # کار تکرار شونده نباید برای همیشه متوقف شود؛ فاصله تلاش مجدد سقف دارد
+                backoff = min(60 * 2 ** min(attempts, 10), SCHEDULER_MAX_BACKOFF)
+                return "pending", time.time() + backoff, False, job_id
+            if attempts >= SCHEDULER_MAX_ATTEMPTS:
+                self.failed += 1
+                return "failed", None, False, job_id
+            # تلاش مجدد با فاصله افزایشی
+            return "pending", time.time() + 60 * 2 ** attempts, False, job_id
+        
+        self.completed += 1
+        if next_run is not None:
+            return "pending", next_run, True, job_id
+        return "done", None, False, job_id
+
+    async def get_stats(self) -> dict:
+        """آمار زمان‌بند"""
+        row = await Database.fetchone(
+            STATS_DB_PATH, "SELECT COUNT(*) FROM scheduled_jobs WHERE status = 'pending'"
+        )
+        return {
+            "pending": row[0],
+            "completed": self.completed,
+            "failed": self.failed,
+            "lag": self.lag.get_stats(),
+        }
+
+
+CHAIN_BACKEND = os.getenv("CHAIN_BACKEND", "esplora").lower()
+CHAIN_API_URL = os.getenv("CHAIN_API_URL", "https://blockstream.info/api")
+CHAIN_CACHE_TTL = int(os.getenv("CHAIN_CACHE_TTL", 300))
+PAYMENT_MIN_CONFIRMATIONS = int(os.getenv("PAYMENT_MIN_CONFIRMATIONS", 1))
+PAYMENT_VERIFY_INTERVAL = int(os.getenv("PAYMENT_VERIFY_INTERVAL", 60))
+PAYMENT_VERIFY_BATCH = int(os.getenv("PAYMENT_VERIFY_BATCH", 50))
+PAYMENT_EXPIRY_HOURS = int(os.getenv("PAYMENT_EXPIRY_HOURS", 24))
+
+
+class ChainBackend:
+    """رابط سرویس بلاکچین؛ خروجی هر تراکنش: تعداد تأیید و مجموع ساتوشی هر آدرس خروجی"""
+
+    async def get_transactions(self, tx_hashes: List[str]) -> Dict[str, Optional[dict]]:
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        pass
+
+    @staticmethod
+    def from_env() -> "ChainBackend":
+        """ساخت سرویس بلاکچین بر اساس تنظیمات محیطی"""
+        if CHAIN_BACKEND == "rpc":
+            return BitcoinRPCBackend(
+                os.getenv("BTC_RPC_URL", "http://127.0.0.1:8332"),
+                os.getenv("BTC_RPC_USER"),
+                os.getenv("BTC_RPC_PASSWORD"),
+            )
+        return EsploraBackend(CHAIN_API_URL)
+
+
+class EsploraBackend(ChainBackend):
+    """سرویس بلاکچین از طریق API سازگار با Esplora (blockstream.info، mempool.space یا نود محلی)"""
+
+    def __init__(self, base_url: str, concurrency: int = 8):
+        self.base_url = base_url.rstrip("/")
+        self._client = httpx.AsyncClient(timeout=10)
+        self._limit = asyncio.Semaphore(concurrency)
+
+    async def _get(self, path: str) -> Optional[httpx.Response]:
+        async with self._limit:
+            response = await self._client.get(f"{self.base_url}{path}")
+        if response.status_code in (400, 404):
+            return None
+        response.raise_for_status()
+        return response
+
+    async def _fetch(self, tx_hash: str, tip_height: int) -> Optional[dict]:
+        response = await self._get(f"/tx/{tx_hash}")
+        if response is None:
+            return None
+        data = response.json()
+        status = data.get("status", {})
+        confirmations = tip_height - status["block_height"] + 1 if status.get("confirmed") else 0
+        outputs: Dict[str, int] = {}
+        for output in data.get("vout", []):
+            address = output.get("scriptpubkey_address")
+            if address:
+                outputs[address] = outputs.get(address, 0) + output["value"]
+        return {"confirmations": confirmations, "outputs": outputs}
+
+    async def get_transactions(self, tx_hashes: List[str]) -> Dict[str, Optional[dict]]:
+        response = await self._get("/blocks/tip/height")
+        if response is None:
+            # بدون ارتفاع بلاک تأییدها قابل محاسبه نیست؛ سفارش‌ها در دور بعد بررسی می‌شوند
+            return {tx_hash: None for tx_hash in tx_hashes}
+        tip_height = int(response.text)
+        results = await asyncio.gather(*(self._fetch(tx_hash, tip_height) for tx_hash in tx_hashes))
+        return dict(zip(tx_hashes, results))
+
+    async def close(self) -> None:
+        await self._client.aclose()
+
+
+class BitcoinRPCBackend(ChainBackend):
+    """سرویس بلاکچین از طریق JSON-RPC نود بیت کوین (نیازمند txindex)؛ هر دسته در یک درخواست"""
+
+    def __init__(self, url: str, user: Optional[str] = None, password: Optional[str] = None):
+        self.url = url
+        self._client = httpx.AsyncClient(timeout=10, auth=(user, password or "") if user else None)
+
+    async def get_transactions(self, tx_hashes: List[str]) -> Dict[str, Optional[dict]]:
+        response = await self._client.post(
+            self.url,
+            json=[
+                {"jsonrpc": "1.0", "id": index, "method": "getrawtransaction", "params": [tx_hash, True]}
+                for index, tx_hash in enumerate(tx_hashes)
+            ],
+        )
+        response.raise_for_status()
+        
+        results: Dict[str, Optional[dict]] = dict.fromkeys(tx_hashes)
+        for item in response.json():
+            data = item.get("result")
+            if not data:
+                continue
+            outputs: Dict[str, int] = {}
+            for output in data.get("vout", []):
+                address = output.get("scriptPubKey", {}).get("address")
+                if address:
+                    outputs[address] = outputs.get(address, 0) + WalletManager.to_sats(output["value"])
+            results[tx_hashes[item["id"]]] = {
+                "confirmations": data.get("confirmations", 0),
+                "outputs": outputs,
+            }
+        return results
+
+    async def close(self) -> None:
+        await self._client.aclose()
+
+
+class PaymentVerifier:
+    """بررسی پرداخت سفارش‌ها روی بلاکچین با کش زمان‌دار نتایج"""
+
+    def __init__(self, backend: ChainBackend, cache_ttl: int = CHAIN_CACHE_TTL):
+        self.backend = backend
+        self.cache_ttl = cache_ttl
+        self.lookups = 0
+        self.cache_hits = 0
+        self._cache: Dict[str, Tuple[float, Optional[dict]]] = {}
+
+    async def lookup(self, tx_hashes: List[str]) -> Dict[str, Optional[dict]]:
+        """دریافت تراکنش‌ها؛ فقط موارد خارج از کش از سرویس بلاکچین پرسیده می‌شوند"""
+        now = time.monotonic()
+        found: Dict[str, Optional[dict]] = {}
+        missing = []
+        for tx_hash in tx_hashes:
+            cached = self._cache.get(tx_hash)
+            if cached is not None and cached[0] > now:
+                found[tx_hash] = cached[1]
+                self.cache_hits += 1
+            else:
+                missing.append(tx_hash)
+        
+        if missing:
+            self.lookups += len(missing)
+            fetched = await self.backend.get_transactions(missing)
+            for tx_hash, tx in fetched.items():
+                self._cache[tx_hash] = (now + self.cache_ttl, tx)
+                found[tx_hash] = tx
+        
+        # حذف موارد منقضی شده
+        for tx_hash in [key for key, (expires, _) in self._cache.items() if expires <= now]:
+            del self._cache[tx_hash]
+        return found
+
+    @staticmethod
+    def check(tx: Optional[dict], address: Optional[str], amount_sats: Optional[int]) -> str:
+        """نتیجه بررسی: review، missing، invalid، waiting یا confirmed"""
+        # بدون آدرس یا مبلغ مشخص هر تراکنشی از آستانه عبور می‌کند؛ تأیید فقط با ادمین
+        if not address or amount_sats is None or amount_sats <= 0:
+            return "review"
+        if tx is None:
+            return "missing"
+        if tx["outputs"].get(address, 0) < amount_sats:
+            return "invalid"
+        if tx["confirmations"] < PAYMENT_MIN_CONFIRMATIONS:
+            return "waiting"
+        return "confirmed"
+
+
+# *********************** پردازش همزمان آپدیت‌ها ***********************
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", 32))
+UPDATE_BACKLOG_MAX = int(os.getenv("UPDATE_BACKLOG_MAX", 1024))
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """پردازش همزمان آپدیت‌های کاربران مختلف با حفظ ترتیب آپدیت‌های هر کاربر"""
+
+    __slots__ = ("max_active", "prepare", "_active", "_users")
+
+    def __init__(self, max_active: int = UPDATE_CONCURRENCY, max_backlog: int = UPDATE_BACKLOG_MAX):
+        # سمافور پایه فقط تعداد کل آپدیت‌های در جریان را محدود می‌کند؛ سقف اجرای همزمان
+        # بعد از گرفتن قفل کاربر اعمال می‌شود تا آپدیت‌های منتظر یک کاربر جای بقیه را نگیرند
+        super().__init__(max(max_backlog, max_active, 2))
+        self.max_active = max_active
+        # فراخوانی پیش از هر آپدیت کاربر (داخل قفل او)؛ برای بارگذاری وضعیت گفتگوهای کاربر
+        self.prepare: Optional[Callable[[int], Awaitable[None]]] = None
+        self._active = asyncio.Semaphore(max_active)
+        # کلید کاربر -> [قفل، تعداد آپدیت‌های در جریان]؛ با صفر شدن شمارنده حذف می‌شود
+        self._users: Dict[int, list] = {}
+
     @staticmethod
-    async def generate_discount_code(user_id: int) -> str:
-        """تولید کد تخفیف"""
-        code = f"DISCOUNT-{hashlib.md5(str(user_id + datetime.now().timestamp()).encode()).hexdigest()[:8].upper()}"
-        
+    def _key(update: object) -> Optional[int]:
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    @property
+    def active_users(self) -> int:
+        return len(self._users)
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        key = self._key(update)
+        if key is None:
+            async with self._active:
+                await coroutine
+            return
+        
+        # قفل asyncio به ترتیب ورود آزاد می‌شود و تسک‌ها به ترتیب دریافت آپدیت ساخته می‌شوند
+        entry = self._users.get(key)
+        if entry is None:
+            entry = self._users[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
         try:
-            async with aiosqlite.connect(COINS_DB_PATH) as db:
-                await db.execute(
-                    """
-                    INSERT INTO discount_codes (code, user_id, expires_at)
-                    VALUES (?, ?, datetime('now', '+1 day'))
-                    """,
-                    (code, user_id)
+            async with entry[0]:
+                async with self._active:
+                    if self.prepare is not None:
+                        try:
+                            await self.prepare(key)
+                        except Exception as e:
+                            logger.error(f"خطا در آماده‌سازی آپدیت کاربر {key}: {e}")
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._users[key]
+
+    def is_busy(self, key: int) -> bool:
+        """آیا آپدیتی از این کاربر در حال پردازش یا در صف است"""
+        return key in self._users
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+# *********************** ذخیره وضعیت گفتگوها ***********************
+PERSISTENCE_FLUSH_INTERVAL = int(os.getenv("PERSISTENCE_FLUSH_INTERVAL", 30))
+USER_DATA_IDLE_TTL = int(os.getenv("USER_DATA_IDLE_TTL", 30 * 60))
+USER_DATA_EVICT_INTERVAL = 300
+
+
+class SQLitePersistence(BasePersistence):
+    """ذخیره user_data و وضعیت ConversationHandlerها در SQLite
+
+    داده و وضعیت گفتگوهای هر کاربر در اولین آپدیت او خوانده می‌شود، تغییرات در هر دوره
+    ذخیره‌سازی در یک تراکنش نوشته می‌شوند و داده کاربران غیرفعال از حافظه خارج می‌شود.
+    """
+
+    def __init__(self, path: str = USERS_DB_PATH, update_interval: float = PERSISTENCE_FLUSH_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.path = path
+        self._tables_ready = False
+        # تغییرات نوشته نشده؛ None یعنی حذف ردیف
+        self._dirty_users: Dict[int, Optional[str]] = {}
+        self._dirty_conversations: Dict[Tuple[str, str], Optional[int]] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        # کاربران بارگذاری شده در حافظه -> زمان آخرین آپدیت
+        self._last_seen: Dict[int, float] = {}
+        self._evicted = set()
+        # کاربرانی که وضعیت گفتگوهایشان در حافظه ConversationHandlerها بارگذاری شده است
+        self._conversation_users = set()
+        # نام گفتگو -> جایگاه شناسه کاربر در کلید؛ None یعنی کلید شامل کاربر نیست و گفتگو کامل بارگذاری می‌شود
+        self._user_index: Dict[str, Optional[int]] = {}
+        self._application: Optional[Application] = None
+
+    async def _ensure_tables(self) -> None:
+        if self._tables_ready:
+            return
+        async with Database.transaction(self.path) as db:
+            await db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS user_state (
+                    user_id INTEGER PRIMARY KEY,
+                    data TEXT NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
-                await db.commit()
-                return code
-        except Exception as e:
-            logger.error(f"خطا در تولید کد تخفیف: {e}")
-            return ""
-    
-    @staticmethod
-    async def validate_discount_code(user_id: int, code: str) -> bool:
-        """اعتبارسنجی کد تخفیف"""
-        async with aiosqlite.connect(COINS_DB_PATH) as db:
-            cursor = await db.execute(
                 """
-                SELECT 1 FROM discount_codes 
-                WHERE code = ? AND user_id = ? AND used = FALSE AND expires_at > datetime('now')
-                """,
-                (code, user_id)
             )
-            return await cursor.fetchone() is not None
-    
-    @staticmethod
-    async def use_discount_code(user_id: int, code: str) -> bool:
-        """استفاده از کد تخفیف"""
-        async with aiosqlite.connect(COINS_DB_PATH) as db:
             await db.execute(
-                "UPDATE discount_codes SET used = TRUE WHERE code = ? AND user_id = ?",
-                (code, user_id)
+                """
+                CREATE TABLE IF NOT EXISTS conversation_state (
+                    name TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    state INTEGER NOT NULL,
+                    user_id INTEGER,
+                    PRIMARY KEY (name, key)
+                ) WITHOUT ROWID
+                """
             )
-            await db.commit()
-            return True
-
+            # کلید گفتگو (chat_id, user_id) است؛ ستون user_id برای بارگذاری گفتگوهای یک کاربر
+            columns = {row[1] for row in await db.execute_fetchall("PRAGMA table_info(conversation_state)")}
+            if "user_id" not in columns:
+                await db.execute("ALTER TABLE conversation_state ADD COLUMN user_id INTEGER")
+                await db.execute("UPDATE conversation_state SET user_id = json_extract(key, '$[#-1]')")
+            await db.execute(
+                "CREATE INDEX IF NOT EXISTS idx_conversation_state_user ON conversation_state (user_id)"
+            )
+        self._tables_ready = True
+
+    def attach(self, application: Application) -> None:
+        """اتصال به برنامه برای بارگذاری و خارج کردن وضعیت گفتگوها از حافظه
+
+        بارگذاری تنبل گفتگوها به جزئیات داخلی python-telegram-bot 22 وابسته است
+        (Application._conversation_handler_conversations و TrackingDict)؛ نسخه در
+        requirements.txt ثابت شده و با نسخه دیگر ربات از ابتدا اجرا نمی‌شود.
+        """
+        if telegram.__version_info__[0] != 22 or not isinstance(
+            getattr(application, "_conversation_handler_conversations", None), dict
+        ):
+            raise RuntimeError(
+                f"SQLitePersistence با python-telegram-bot {telegram.__version__} سازگار نیست؛ "
+                f"نسخه 22 لازم است"
+            )
+        self._application = application
+
+    def _key_user_index(self, name: str) -> Optional[int]:
+        """جایگاه شناسه کاربر در کلیدهای یک ConversationHandler (کلید: chat، user، message به ترتیب)"""
+        if name not in self._user_index:
+            index = None
+            for handlers in self._application.handlers.values():
+                for handler in handlers:
+                    if isinstance(handler, ConversationHandler) and handler.name == name and handler.per_user:
+                        index = int(handler.per_chat)
+            self._user_index[name] = index
+        return self._user_index[name]
+
+    def _key_user(self, name: str, key: Union[str, tuple]) -> Optional[int]:
+        if self._application is None:
+            return None
+        index = self._key_user_index(name)
+        if index is None:
+            return None
+        return (json.loads(key) if isinstance(key, str) else key)[index]
+
+    def _conversation_dicts(self) -> Dict[str, Any]:
+        """دیکشنری وضعیت گفتگوهایی که بارگذاری تنبل دارند (کلید شامل شناسه کاربر)"""
+        conversations = self._application._conversation_handler_conversations
+        lazy = {}
+        for name, states in conversations.items():
+            if self._key_user_index(name) is None:
+                continue
+            if not (hasattr(states, "update_no_track") and isinstance(getattr(states, "data", None), dict)):
+                raise RuntimeError(f"ساختار وضعیت گفتگوی {name} در python-telegram-bot تغییر کرده است")
+            lazy[name] = states
+        return lazy
+
+    async def get_user_data(self) -> Dict[int, dict]:
+        # داده کاربران به صورت تنبل در refresh_user_data خوانده می‌شود
+        await self._ensure_tables()
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        """بارگذاری داده کاربر پیش از پردازش اولین آپدیت او"""
+        if user_id not in self._last_seen:
+            if user_id in self._dirty_users:
+                data = self._dirty_users[user_id]
+            else:
+                row = await Database.fetchone(
+                    self.path, "SELECT data FROM user_state WHERE user_id = ?", (user_id,)
+                )
+                data = row[0] if row else None
+            if data and user_id not in self._last_seen:
+                for key, value in json.loads(data).items():
+                    user_data.setdefault(key, value)
+        self._last_seen[user_id] = time.monotonic()
 
-class ReferralSystem:
-    """سیستم معرفی دوستان"""
-    
-    REFERRAL_BONUS = 0.0001  # معادل 50,000 تومان
-    REQUIRED_REFERRALS = 10
-    
-    @staticmethod
-    async def get_referral_code(user_id: int) -> str:
-        """دریافت کد معرف کاربر"""
-        return f"REF-{user_id}-{hashlib.md5(str(user_id).encode()).hexdigest()[:5]}"
-    
-    @staticmethod
-    async def add_referral(referrer_id: int, referred_id: int) -> bool:
-        """ثبت معرفی جدید"""
-        if referrer_id == referred_id:
-            return False
-            
+    async def update_user_data(self, user_id: int, data: dict) -> None:
         try:
-            async with aiosqlite.connect(USERS_DB_PATH) as db:
-                # بررسی اینکه کاربر دعوت شده ثبت نام کرده است
-                cursor = await db.execute(
-                    "SELECT 1 FROM users WHERE user_id = ?", (referred_id,)
+            self._dirty_users[user_id] = json.dumps(data, ensure_ascii=False) if data else None
+        except (TypeError, ValueError) as e:
+            logger.error(f"خطا در ذخیره داده کاربر {user_id}: {e}")
+            return
+        await self._schedule_flush()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        if user_id in self._evicted:
+            # فقط از حافظه خارج شده بود؛ اگر کاربر در این فاصله برگشته، تغییراتش دوره بعد نوشته می‌شود
+            self._evicted.discard(user_id)
+            if user_id in self._last_seen and self._application is not None:
+                self._application.mark_data_for_update_persistence(user_ids=user_id)
+            return
+        self._last_seen.pop(user_id, None)
+        self._dirty_users[user_id] = None
+        await self._schedule_flush()
+
+    async def get_conversations(self, name: str) -> Dict[tuple, object]:
+        await self._ensure_tables()
+        if self._application is not None and self._key_user_index(name) is not None:
+            # وضعیت گفتگوها به صورت تنبل در load_conversations خوانده می‌شود
+            return {}
+        rows = await Database.fetchall(
+            self.path, "SELECT key, state FROM conversation_state WHERE name = ?", (name,)
+        )
+        return {tuple(json.loads(key)): state for key, state in rows}
+
+    async def load_conversations(self, user_id: int) -> None:
+        """بارگذاری وضعیت گفتگوهای کاربر پیش از بررسی اولین آپدیت او توسط ConversationHandlerها"""
+        if user_id in self._conversation_users or self._application is None:
+            return
+        rows = await Database.fetchall(
+            self.path, "SELECT name, key, state FROM conversation_state WHERE user_id = ?", (user_id,)
+        )
+        states = {(name, key): state for name, key, state in rows}
+        # تغییرات نوشته نشده بر ردیف‌های دیتابیس اولویت دارند
+        states.update(
+            (entry, state) for entry, state in self._dirty_conversations.items()
+            if self._key_user(*entry) == user_id
+        )
+        conversations = self._conversation_dicts()
+        for (name, key), state in states.items():
+            key = tuple(json.loads(key))
+            if state is not None and name in conversations and key not in conversations[name]:
+                conversations[name].update_no_track({key: state})
+        self._conversation_users.add(user_id)
+
+    def _drop_conversations(self, user_ids: set) -> None:
+        # حذف بدون ثبت تغییر تا ردیف‌های دیتابیس دست نخورند
+        if self._application is None:
+            return
+        for name, states in self._conversation_dicts().items():
+            index = self._key_user_index(name)
+            for key in [key for key in states.data if key[index] in user_ids]:
+                del states.data[key]
+        self._conversation_users -= user_ids
+
+    async def update_conversation(self, name: str, key: tuple, new_state: Optional[object]) -> None:
+        self._dirty_conversations[(name, json.dumps(key))] = new_state
+        await self._schedule_flush()
+
+    async def _schedule_flush(self) -> None:
+        # تمام به‌روزرسانی‌های یک دوره ذخیره‌سازی منتظر یک تسک نوشتن مشترک می‌مانند
+        if self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._write_dirty())
+        await self._flush_task
+
+    async def _write_dirty(self) -> None:
+        # یک دور اجرا تا بقیه کوروتین‌های همان دوره هم تغییراتشان را ثبت کنند
+        await asyncio.sleep(0)
+        users, self._dirty_users = self._dirty_users, {}
+        conversations, self._dirty_conversations = self._dirty_conversations, {}
+        self._flush_task = None
+        try:
+            async with Database.transaction(self.path) as db:
+                await db.executemany(
+                    """
+                    INSERT INTO user_state (user_id, data) VALUES (?, ?)
+                    ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = CURRENT_TIMESTAMP
+                    """,
+                    [(user_id, data) for user_id, data in users.items() if data is not None]
                 )
-                if not await cursor.fetchone():
-                    return False
-                
-                # بررسی عدم وجود معرفی تکراری
-                cursor = await db.execute(
-                    "SELECT 1 FROM referrals WHERE referrer_id = ? AND referred_id = ?",
-                    (referrer_id, referred_id)
+                await db.executemany(
+                    "DELETE FROM user_state WHERE user_id = ?",
+                    [(user_id,) for user_id, data in users.items() if data is None]
                 )
-                if await cursor.fetchone():
-                    return False
-                
-                await db.execute(
-                    "INSERT INTO referrals (referrer_id, referred_id) VALUES (?, ?)",
-                    (referrer_id, referred_id),
+                await db.executemany(
+                    """
+                    INSERT INTO conversation_state (name, key, state, user_id) VALUES (?, ?, ?, ?)
+                    ON CONFLICT(name, key) DO UPDATE SET state = excluded.state
+                    """,
+                    [
+                        (name, key, state, self._key_user(name, key))
+                        for (name, key), state in conversations.items() if state is not None
+                    ]
                 )
-                await db.commit()
-                
-                # افزودن سکه به معرف
-                await CoinManager.add_coins(referrer_id, 10, "معرفی دوست")
-                
-                cursor = await db.execute(
-                    "SELECT COUNT(*) FROM referrals WHERE referrer_id = ?",
-                    (referrer_id,),
+                await db.executemany(
+                    "DELETE FROM conversation_state WHERE name = ? AND key = ?",
+                    [(name, key) for (name, key), state in conversations.items() if state is None]
                 )
-                count = (await cursor.fetchone())[0]
-                
-                if count >= ReferralSystem.REQUIRED_REFERRALS:
-                    await WalletManager.deposit(referrer_id, ReferralSystem.REFERRAL_BONUS)
-                    return True
-                return True
         except Exception as e:
-            logger.error(f"خطا در ثبت معرف: {e}")
-            return False
+            logger.error(f"خطا در ذخیره وضعیت کاربران: {e}")
+            # تغییرات برای دوره بعد نگه داشته می‌شوند؛ مقدارهای جدیدتر اولویت دارند
+            self._dirty_users = {**users, **self._dirty_users}
+            self._dirty_conversations = {**conversations, **self._dirty_conversations}
+
+    async def flush(self) -> None:
+        if self._flush_task is not None:
+            await self._flush_task
+        if self._dirty_users or self._dirty_conversations:
+            await self._schedule_flush()
+
+    async def evict_idle(self, application: Application, is_busy: Callable[[int], bool]) -> int:
+        """خارج کردن داده کاربرانی که مدتی آپدیتی نداشته‌اند از حافظه"""
+        cutoff = time.monotonic() - USER_DATA_IDLE_TTL
+        if not any(seen < cutoff for seen in self._last_seen.values()):
+            return 0
+        
+        # تغییرات علامت‌خورده ابتدا ذخیره می‌شوند تا با خروج از حافظه از دست نروند
+        await application.update_persistence()
+        self._application = application
+        idle = [
+            user_id for user_id, seen in self._last_seen.items()
+            if seen < cutoff and not is_busy(user_id)
+        ]
+        for user_id in idle:
+            del self._last_seen[user_id]
+            self._evicted.add(user_id)
+            application.drop_user_data(user_id)
+        # گفتگوهای ناتمام کاربران غیرفعال هم از حافظه خارج و در آپدیت بعدی دوباره خوانده می‌شوند
+        self._drop_conversations(set(idle))
+        return len(idle)
+
+    @property
+    def loaded_users(self) -> int:
+        return len(self._last_seen)
+
+    # فقط user_data و گفتگوها ذخیره می‌شوند
+    async def get_chat_data(self) -> Dict[int, dict]:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
 
 
 class ShopBot:
     """کلاس اصلی ربات فروشگاه"""
 
     def __init__(self):
-        self.products = self._load_products()
+        self.catalog = Catalog()
         self.bot_token = os.getenv("BOT_TOKEN")
         self.admin_id = int(os.getenv("ADMIN_ID", 0))
         self.support_username = os.getenv("SUPPORT_USERNAME")
@@ -781,11 +3544,27 @@ class ShopBot:
         self.wallet_manager = WalletManager()
         self.referral_system = ReferralSystem()
         self.coin_manager = CoinManager()
-        self.daily_notification_task = None
+        self.profile_manager = ProfileManager()
+        self.render_service = RenderService()
+        self.media_registry = MediaRegistry()
+        self.spin_latency = LatencyTracker("چرخش گردونه", SPIN_LATENCY_TARGET)
+        self.start_latency = LatencyTracker("/start", START_LATENCY_TARGET)
+        self.scheduler = JobScheduler()
+        self.payment_verifier = PaymentVerifier(ChainBackend.from_env())
+        self.scheduler.register("verify_payments", self.verify_payments, recurring=True)
+        self.scheduler.register("daily_notification", self.send_daily_notification, recurring=True)
+        self.scheduler.register("restock_products", self.catalog.restock, recurring=True)
+        self.scheduler.register("release_reservations", self.catalog.sweep, recurring=True)
+        self.background_tasks = set()
+
+    @property
+    def products(self) -> Dict[str, Product]:
+        """محصولات نسخه جاری کاتالوگ (بدون قفل)"""
+        return self.catalog.products
 
     @staticmethod
-    def _load_products() -> Dict[str, Product]:
-        """بارگذاری محصولات"""
+    def _default_products() -> Dict[str, Product]:
+        """محصولات پیش‌فرض برای اولین اجرا"""
         return {
             "mafia": Product(
                 name="چیت بازی شب های مافیا",
@@ -816,9 +3595,10 @@ class ShopBot:
     async def init_db(self) -> None:
         """تنظیمات دیتابیس"""
         os.makedirs("data", exist_ok=True)
+        await Database.migrate_legacy_files()
         
         # دیتابیس سفارشات
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with Database.transaction(DB_PATH) as db:
             await db.execute(
                 """
                 CREATE TABLE IF NOT EXISTS orders (
@@ -836,10 +3616,45 @@ class ShopBot:
             )
             await db.execute("CREATE INDEX IF NOT EXISTS idx_user_id ON orders (user_id)")
             await db.execute("CREATE INDEX IF NOT EXISTS idx_status ON orders (status)")
-            await db.commit()
+            
+            # آدرس و مبلغ مورد انتظار برای بررسی پرداخت روی بلاکچین
+            order_columns = {row[1] for row in await db.execute_fetchall("PRAGMA table_info(orders)")}
+            if "btc_address" not in order_columns:
+                await db.execute("ALTER TABLE orders ADD COLUMN btc_address TEXT")
+            if "amount_sats" not in order_columns:
+                await db.execute("ALTER TABLE orders ADD COLUMN amount_sats INTEGER")
+            
+            # هر هش تراکنش فقط یک سفارش: نسخه‌های تکراری قبلی لغو و از ایندکس یکتا خارج می‌شوند
+            has_tx_index = await db.execute_fetchall(
+                "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_tx_hash'"
+            )
+            if not has_tx_index:
+                await db.execute("UPDATE orders SET tx_hash = lower(tx_hash) WHERE tx_hash != lower(tx_hash)")
+                await db.execute(
+                    """
+                    UPDATE orders
+                    SET status = 'canceled', tx_hash = tx_hash || ':duplicate:' || id
+                    WHERE id IN (
+                        SELECT id FROM (
+                            SELECT id, ROW_NUMBER() OVER (
+                                PARTITION BY tx_hash
+                                ORDER BY CASE status WHEN 'completed' THEN 0 WHEN 'pending' THEN 1 ELSE 2 END, id
+                            ) AS position
+                            FROM orders
+                        )
+                        WHERE position > 1
+                    )
+                    """
+                )
+            await db.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_tx_hash ON orders (tx_hash)")
+            
+            # ایندکس‌های صفحه‌بندی سفارشات ادمین (idx_status همان (status, id) است)
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_product_id ON orders (product, id)")
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_status_product_id ON orders (status, product, id)")
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_timestamp ON orders (timestamp)")
         
         # دیتابیس آمار
-        async with aiosqlite.connect(STATS_DB_PATH) as db:
+        async with Database.transaction(STATS_DB_PATH) as db:
             await db.execute(
                 """
                 CREATE TABLE IF NOT EXISTS stats (
@@ -859,12 +3674,11 @@ class ShopBot:
                     "INSERT OR IGNORE INTO stats (stat_name, stat_value) VALUES (?, ?)",
                     ("successful_orders", 16),
                 )
-                await db.commit()
             except Exception as e:
                 logger.error(f"خطا در مقداردهی اولیه آمار: {e}")
 
         # دیتابیس کاربران
-        async with aiosqlite.connect(USERS_DB_PATH) as db:
+        async with Database.transaction(USERS_DB_PATH) as db:
             await db.execute(
                 """
                 CREATE TABLE IF NOT EXISTS users (
@@ -888,37 +3702,18 @@ class ShopBot:
                 )
                 """
             )
-            await db.commit()
         
         # دیتابیس کیف پول
-        async with aiosqlite.connect(WALLET_DB_PATH) as db:
-            await db.execute(
-                """
-                CREATE TABLE IF NOT EXISTS wallets (
-                    user_id INTEGER PRIMARY KEY,
-                    balance REAL DEFAULT 0,
-                    FOREIGN KEY (user_id) REFERENCES users (user_id)
-                )
-                """
-            )
-            await db.execute(
-                """
-                CREATE TABLE IF NOT EXISTS transactions (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    amount REAL NOT NULL,
-                    address TEXT,
-                    type TEXT NOT NULL,
-                    status TEXT DEFAULT 'pending',
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users (user_id)
-                )
-                """
-            )
-            await db.commit()
+        await self.wallet_manager.init_db()
         
         # دیتابیس سکه‌ها
         await self.coin_manager.init_db()
+        
+        # file_id تصاویر ارسال شده
+        await self.media_registry.init_db()
+        
+        # کاتالوگ محصولات
+        await self.catalog.init_db(self._default_products())
 
     # *********************** متدهای دیتابیس ***********************
     @staticmethod
@@ -929,15 +3724,17 @@ class ShopBot:
         tracking_code: str,
         tx_hash: str,
         status: str = "pending",
-    ) -> bool:
-        """ذخیره سفارش جدید"""
+    ) -> Optional[Tuple]:
+        """ذخیره سفارش جدید؛ برای هش تکراری سفارش موجود (user_id، کد پیگیری، وضعیت) برگردانده می‌شود"""
         try:
-            async with aiosqlite.connect(DB_PATH) as db:
-                await db.execute(
+            async with Database.transaction(DB_PATH) as db:
+                rows = await db.execute_fetchall(
                     """
                     INSERT INTO orders 
-                    (user_id, full_name, product, price, tracking_code, tx_hash, status)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    (user_id, full_name, product, price, tracking_code, tx_hash, status, btc_address, amount_sats)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(tx_hash) DO NOTHING
+                    RETURNING user_id, tracking_code, status
                     """,
                     (
                         user_id,
@@ -947,37 +3744,51 @@ class ShopBot:
                         tracking_code,
                         tx_hash,
                         status,
+                        product.btc_address,
+                        product.price_sats,
                     ),
                 )
-                await db.commit()
+                if not rows:
+                    existing = await db.execute_fetchall(
+                        "SELECT user_id, tracking_code, status FROM orders WHERE tx_hash = ?", (tx_hash,)
+                    )
+                    return existing[0]
                 
                 # افزودن سکه به کاربر برای خرید موفق
                 await CoinManager.add_coins(user_id, 50, "خرید موفق")
-                return True
+            return rows[0]
         except Exception as e:
             logger.error(f"خطای دیتابیس: {e}", exc_info=True)
-            return False
+            return None
+
+    @staticmethod
+    async def get_order_by_tx_hash(tx_hash: str) -> Optional[Tuple]:
+        """دریافت سفارش ثبت شده با یک هش تراکنش (user_id، کد پیگیری، وضعیت)"""
+        return await Database.fetchone(
+            DB_PATH,
+            "SELECT user_id, tracking_code, status FROM orders WHERE tx_hash = ?",
+            (tx_hash,)
+        )
 
     @staticmethod
     async def get_order(order_id: int) -> Optional[Tuple]:
         """دریافت سفارش"""
-        async with aiosqlite.connect(DB_PATH) as db:
-            cursor = await db.execute(
-                "SELECT * FROM orders WHERE id = ?", (order_id,)
-            )
-            return await cursor.fetchone()
+        return await Database.fetchone(
+            DB_PATH, "SELECT * FROM orders WHERE id = ?", (order_id,)
+        )
 
     @staticmethod
     async def update_order_status(order_id: int, status: str) -> bool:
-        """به‌روزرسانی وضعیت سفارش"""
+        """به‌روزرسانی وضعیت سفارش و قطعی کردن یا آزادسازی رزرو موجودی آن"""
         try:
-            async with aiosqlite.connect(DB_PATH) as db:
-                await db.execute(
-                    "UPDATE orders SET status = ? WHERE id = ?",
+            async with Database.transaction(DB_PATH) as db:
+                rows = await db.execute_fetchall(
+                    "UPDATE orders SET status = ? WHERE id = ? RETURNING tracking_code",
                     (status, order_id),
                 )
-                await db.commit()
-                return True
+                if rows and status in ("completed", "canceled"):
+                    await Catalog.resolve(db, rows[0][0], status == "completed")
+            return True
         except Exception as e:
             logger.error(f"خطای دیتابیس: {e}")
             return False
@@ -985,32 +3796,64 @@ class ShopBot:
     @staticmethod
     async def get_user_orders(user_id: int) -> List[Tuple]:
         """دریافت سفارشات کاربر"""
-        async with aiosqlite.connect(DB_PATH) as db:
-            cursor = await db.execute(
-                """
-                SELECT id, product, price, tracking_code, status, timestamp 
-                FROM orders 
-                WHERE user_id = ?
-                ORDER BY timestamp DESC
-                """,
-                (user_id,),
-            )
-            return await cursor.fetchall()
+        return await Database.fetchall(
+            DB_PATH,
+            """
+            SELECT id, product, price, tracking_code, status, timestamp 
+            FROM orders 
+            WHERE user_id = ?
+            ORDER BY timestamp DESC
+            """,
+            (user_id,),
+        )
 
     @staticmethod
-    async def get_all_orders(limit: int = 50) -> List[Tuple]:
-        """دریافت تمام سفارشات"""
-        async with aiosqlite.connect(DB_PATH) as db:
-            cursor = await db.execute(
-                """
-                SELECT id, user_id, full_name, product, price, tracking_code, status, timestamp
-                FROM orders
-                ORDER BY timestamp DESC
-                LIMIT ?
-                """,
-                (limit,),
+    async def get_orders_page(
+        status: Optional[str] = None,
+        product: Optional[str] = None,
+        days: Optional[int] = None,
+        before_id: Optional[int] = None,
+        after_id: Optional[int] = None,
+        limit: int = 10,
+    ) -> List[Tuple]:
+        """یک صفحه از سفارشات (جدیدترین اول) با فیلتر و صفحه‌بندی بر اساس شناسه"""
+        conditions, params = [], []
+        if status:
+            conditions.append("status = ?")
+            params.append(status)
+        if product:
+            conditions.append("product = ?")
+            params.append(product)
+        if days:
+            # شناسه‌ها به ترتیب زمان ثبت هستند؛ بازه زمانی به حد پایین شناسه تبدیل می‌شود
+            first = await Database.fetchone(
+                DB_PATH,
+                "SELECT id FROM orders WHERE timestamp >= datetime('now', ?) ORDER BY timestamp LIMIT 1",
+                (f"-{days} days",)
             )
-            return await cursor.fetchall()
+            if first is None:
+                return []
+            conditions.append("id >= ?")
+            params.append(first[0])
+        if after_id is not None:
+            conditions.append("id > ?")
+            params.append(after_id)
+        elif before_id is not None:
+            conditions.append("id < ?")
+            params.append(before_id)
+        
+        rows = await Database.fetchall(
+            DB_PATH,
+            f"""
+            SELECT id, user_id, full_name, product, price, tracking_code, status, timestamp
+            FROM orders
+            WHERE {" AND ".join(conditions) or "1"}
+            ORDER BY id {"ASC" if after_id is not None else "DESC"}
+            LIMIT ?
+            """,
+            (*params, limit),
+        )
+        return rows[::-1] if after_id is not None else rows
 
     # *********************** متدهای کمکی ***********************
     @staticmethod
@@ -1048,6 +3891,18 @@ class ShopBot:
         
         await message.delete()
 
+    def run_in_background(self, coro) -> asyncio.Task:
+        """اجرای یک کار جانبی بدون منتظر ماندن پاسخ اصلی"""
+        task = asyncio.create_task(coro)
+        self.background_tasks.add(task)
+        task.add_done_callback(self._background_done)
+        return task
+
+    def _background_done(self, task: asyncio.Task) -> None:
+        self.background_tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            logger.error(f"خطا در کار پس‌زمینه: {task.exception()}")
+
     async def show_loading_animation(self, update: Update, text: str = "در حال پردازش...") -> None:
         """نمایش انیمیشن لودینگ"""
         message = await update.message.reply_text(f"⏳ {text}")
@@ -1058,6 +3913,59 @@ class ShopBot:
         
         await message.delete()
 
+    async def card_media(self, card: CardImage) -> Union[str, bytes]:
+        """file_id کارت در صورت آپلود قبلی، در غیر این صورت بایت‌های رندر شده"""
+        if card.cache:
+            file_id = await self.media_registry.get(card.key)
+            if file_id:
+                return file_id
+        return await self.render_service.render_card(card)
+
+    async def remember_card(self, card: CardImage, message) -> None:
+        """ثبت file_id کارتی که تازه آپلود شده است"""
+        if not card.cache or not isinstance(message, Message):
+            return
+        if card.animated and message.animation:
+            await self.media_registry.remember(card.key, message.animation.file_id)
+        elif message.photo:
+            await self.media_registry.remember(card.key, message.photo[-1].file_id)
+
+    async def reply_card(self, message: Message, card: CardImage, **kwargs) -> Message:
+        """ارسال کارت در پاسخ؛ کارت‌های تکراری فقط با file_id ارسال می‌شوند"""
+        photo = await self.card_media(card)
+        try:
+            sent = await message.reply_photo(photo=photo, **kwargs)
+        except BadRequest as e:
+            if not isinstance(photo, str):
+                raise
+            # file_id منقضی یا نامعتبر است؛ تصویر دوباره آپلود می‌شود
+            logger.warning(f"file_id نامعتبر برای کارت {card.kind}: {e}")
+            await self.media_registry.forget(card.key)
+            photo = await self.render_service.render_card(card)
+            sent = await message.reply_photo(photo=photo, **kwargs)
+        
+        if not isinstance(photo, str):
+            await self.remember_card(card, sent)
+        return sent
+
+    async def edit_card(self, query, card: CardImage, **kwargs) -> Message:
+        """جایگزینی رسانه پیام با کارت؛ در صورت نامعتبر بودن file_id دوباره آپلود می‌شود"""
+        media_type = InputMediaAnimation if card.animated else InputMediaPhoto
+        media = await self.card_media(card)
+        try:
+            message = await query.edit_message_media(media_type(media, **kwargs))
+        except BadRequest as e:
+            if not isinstance(media, str):
+                raise
+            logger.warning(f"file_id نامعتبر برای کارت {card.kind}: {e}")
+            await self.media_registry.forget(card.key)
+            media = await self.render_service.render_card(card)
+            message = await query.edit_message_media(media_type(media, **kwargs))
+        
+        if not isinstance(media, str):
+            await self.remember_card(card, message)
+        return message
+
     async def send_to_admin(self, context: ContextTypes.DEFAULT_TYPE, message: str) -> bool:
         """ارسال پیام به ادمین"""
         try:
@@ -1116,20 +4024,42 @@ class ShopBot:
         """شروع فرآیند احراز هویت"""
         user = update.effective_user
         
-        async with aiosqlite.connect(USERS_DB_PATH) as db:
-            cursor = await db.execute(
-                "SELECT 1 FROM users WHERE user_id = ?", (user.id,)
-            )
-            if await cursor.fetchone():
-                await update.message.reply_text(
+        # همان snapshot کش شده‌ای که منو و پروفایل پس از ورود از آن استفاده می‌کنند
+        snapshot = await self.profile_manager.get_snapshot(user.id)
+        if snapshot["registered"]:
+            # کارت پروفایل همزمان با پاسخ ورود ارسال می‌شود و پاسخ منتظر رندر نمی‌ماند
+            await asyncio.gather(
+                update.message.reply_text(
                     "شما قبلاً ثبت‌نام کرده‌اید. لطفاً وارد شوید.",
                     reply_markup=InlineKeyboardMarkup([
                         [InlineKeyboardButton("🔐 ورود به حساب", callback_data="login")]
                     ])
-                )
-                return SELECTING_ACTION
-            else:
-                return await self.check_channel_membership(update, context)
+                ),
+                self.send_start_card(update, snapshot),
+            )
+            return SELECTING_ACTION
+        else:
+            return await self.check_channel_membership(update, context)
+
+    async def send_start_card(self, update: Update, snapshot: dict) -> None:
+        """ارسال کارت پروفایل خوش‌آمد /start"""
+        try:
+            user = update.effective_user
+            profile_card, stats_msg = await asyncio.gather(
+                self.generate_profile_card(
+                    user.id, user.full_name, snapshot["coins"], snapshot["registered_at"] or "نامشخص",
+                    snapshot["avatar"], snapshot["dark_mode"]
+                ),
+                self.get_stats_message(),
+            )
+            await self.reply_card(
+                update.message,
+                profile_card,
+                caption=f"👋 سلام {user.full_name}!\n\nبه ربات فروشگاه RedHotMafia خوش آمدید!\n\n{stats_msg}",
+                parse_mode='Markdown'
+            )
+        except Exception as e:
+            logger.error(f"خطا در ارسال کارت شروع: {e}")
 
     async def register_email(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """ثبت ایمیل کاربر"""
@@ -1140,13 +4070,11 @@ class ShopBot:
             return REGISTER_EMAIL
         
         # بررسی تکراری نبودن ایمیل
-        async with aiosqlite.connect(USERS_DB_PATH) as db:
-            cursor = await db.execute(
-                "SELECT 1 FROM users WHERE email = ?", (email,)
-            )
-            if await cursor.fetchone():
-                await update.message.reply_text("این ایمیل قبلاً ثبت شده است. لطفاً ایمیل دیگری وارد کنید:")
-                return REGISTER_EMAIL
+        if await Database.fetchone(
+            USERS_DB_PATH, "SELECT 1 FROM users WHERE email = ?", (email,)
+        ):
+            await update.message.reply_text("این ایمیل قبلاً ثبت شده است. لطفاً ایمیل دیگری وارد کنید:")
+            return REGISTER_EMAIL
         
         context.user_data['email'] = email
         await update.message.reply_text(
@@ -1168,7 +4096,8 @@ class ShopBot:
         hashed_password = self.auth_manager.hash_password(password)
         
         try:
-            async with aiosqlite.connect(USERS_DB_PATH) as db:
+            # کاربر، کیف پول و سکه ثبت نام در یک تراکنش ثبت می‌شوند
+            async with Database.transaction(USERS_DB_PATH) as db:
                 await db.execute(
                     """
                     INSERT INTO users (user_id, email, password, full_name)
@@ -1176,24 +4105,23 @@ class ShopBot:
                     """,
                     (user.id, context.user_data['email'], hashed_password, user.full_name),
                 )
-                await db.commit()
                 
-                async with aiosqlite.connect(WALLET_DB_PATH) as wallet_db:
+                async with Database.transaction(WALLET_DB_PATH) as wallet_db:
                     await wallet_db.execute(
-                        "INSERT OR IGNORE INTO wallets (user_id, balance) VALUES (?, 0)",
+                        "INSERT OR IGNORE INTO wallets (user_id) VALUES (?)",
                         (user.id,),
                     )
-                    await wallet_db.commit()
                 
                 # افزودن سکه برای ثبت نام
                 await self.coin_manager.add_coins(user.id, 10, "ثبت نام")
-                
-                await update.message.reply_text(
-                    "ثبت‌نام شما با موفقیت انجام شد! 🎉\n\n"
-                    "اکنون می‌توانید از تمام امکانات ربات استفاده کنید.",
-                )
-                context.user_data.clear()
-                return await self.show_main_menu(update, context)
+                await Database.after_commit(USERS_DB_PATH, lambda: profile_cache.invalidate(user.id))
+            
+            await update.message.reply_text(
+                "ثبت‌نام شما با موفقیت انجام شد! 🎉\n\n"
+                "اکنون می‌توانید از تمام امکانات ربات استفاده کنید.",
+            )
+            context.user_data.clear()
+            return await self.show_main_menu(update, context)
         except Exception as e:
             logger.error(f"خطا در ثبت کاربر: {e}")
             await update.message.reply_text(
@@ -1224,58 +4152,39 @@ class ShopBot:
         email = context.user_data['login_email']
         hashed_password = self.auth_manager.hash_password(password)
         
-        async with aiosqlite.connect(USERS_DB_PATH) as db:
-            cursor = await db.execute(
-                "SELECT user_id FROM users WHERE email = ? AND password = ?",
-                (email, hashed_password),
-            )
-            user = await cursor.fetchone()
-            
-            if user:
-                # دریافت سکه روزانه
-                if await self.coin_manager.can_claim_daily(user[0]):
-                    await self.coin_manager.claim_daily_coins(user[0])
-                    await update.message.reply_text(
-                        "🎉 شما 5 سکه برای ورود امروز دریافت کردید!"
-                    )
-                
-                await update.message.reply_text(
-                    "ورود با موفقیت انجام شد! ✅",
-                )
-                context.user_data.clear()
-                return await self.show_main_menu(update, context)
-            else:
+        user = await Database.fetchone(
+            USERS_DB_PATH,
+            "SELECT user_id FROM users WHERE email = ? AND password = ?",
+            (email, hashed_password),
+        )
+        
+        if user:
+            # دریافت سکه روزانه
+            if await self.coin_manager.can_claim_daily(user[0]):
+                await self.coin_manager.claim_daily_coins(user[0])
                 await update.message.reply_text(
-                    "ایمیل یا رمز عبور اشتباه است. لطفاً مجدداً تلاش کنید.",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("🔄 تلاش مجدد", callback_data="login")],
-                        [InlineKeyboardButton("📝 ثبت‌نام", callback_data="register")]
-                    ])
+                    "🎉 شما 5 سکه برای ورود امروز دریافت کردید!"
                 )
-                return ConversationHandler.END
+            
+            await update.message.reply_text(
+                "ورود با موفقیت انجام شد! ✅",
+            )
+            context.user_data.clear()
+            return await self.show_main_menu(update, context)
+        else:
+            await update.message.reply_text(
+                "ایمیل یا رمز عبور اشتباه است. لطفاً مجدداً تلاش کنید.",
+                reply_markup=InlineKeyboardMarkup([
+                    [InlineKeyboardButton("🔄 تلاش مجدد", callback_data="login")],
+                    [InlineKeyboardButton("📝 ثبت‌نام", callback_data="register")]
+                ])
+            )
+            return ConversationHandler.END
 
     # *********************** سیستم کیف پول و سکه‌ها ***********************
-    async def generate_wallet_image(self, balance: float, coins: int) -> bytes:
+    async def generate_wallet_card(self, balance: float, coins: int, user_id: Optional[int] = None) -> CardImage:
         """تولید تصویر کیف پول دیجیتال"""
-        img = Image.new('RGB', (600, 400), color=(20, 20, 40))
-        draw = ImageDraw.Draw(img)
-        
-        # نمایش موجودی بیت کوین
-        draw.text((50, 50), "💰 کیف پول بیت کوین", font=TITLE_FONT, fill=(255, 255, 255))
-        draw.text((50, 90), f"موجودی: {balance:.8f} BTC", font=MONO_FONT, fill=(200, 255, 200))
-        
-        # نمایش سکه‌ها
-        draw.text((50, 150), "🪙 سکه‌های شما", font=TITLE_FONT, fill=(255, 255, 255))
-        draw.text((50, 190), f"تعداد: {coins} سکه", font=MONO_FONT, fill=(255, 215, 0))
-        
-        # اطلاعات تبدیل
-        draw.text((50, 250), f"هر 300 سکه = 0.00002 BTC (~50,000 تومان)", font=MONO_FONT, fill=(200, 200, 255))
-        
-        # ذخیره تصویر در بایت
-        img_byte_arr = io.BytesIO()
-        img.save(img_byte_arr, format='PNG')
-        img_byte_arr.seek(0)
-        return img_byte_arr.getvalue()
+        return CardImage("wallet", {"balance": balance, "coins": coins}, tag=user_id)
 
     async def show_wallet(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """نمایش کیف پول کاربر"""
@@ -1284,7 +4193,7 @@ class ShopBot:
         coins = await self.coin_manager.get_coins(user_id)
         
         # تولید تصویر کیف پول
-        wallet_image = await self.generate_wallet_image(balance, coins)
+        wallet_card = await self.generate_wallet_card(balance, coins, user_id)
         
         keyboard = [
             [InlineKeyboardButton("💳 واریز بیت کوین", callback_data="deposit_btc")],
@@ -1294,8 +4203,9 @@ class ShopBot:
             [InlineKeyboardButton("🔙 بازگشت", callback_data="back")],
         ]
         
-        await update.callback_query.message.reply_photo(
-            photo=wallet_image,
+        await self.reply_card(
+            update.callback_query.message,
+            wallet_card,
             caption=f"💰 *کیف پول شما*\n\n"
                    f"موجودی بیت کوین: `{balance:.8f} BTC`\n"
                    f"تعداد سکه‌ها: `{coins}`\n\n"
@@ -1306,6 +4216,73 @@ class ShopBot:
         await update.callback_query.message.delete()
         return WALLET_ACTIONS
 
+    async def show_transaction_history(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+        """نمایش تاریخچه تراکنش‌ها با صفحه‌بندی"""
+        query = update.callback_query
+        await query.answer()
+        user_id = update.effective_user.id
+        
+        # transaction_history برای صفحه اول یا transaction_history:older|newer:<id>
+        if query.data == TRANSACTIONS_PAGE.prefix:
+            direction = anchor = None
+        else:
+            direction, anchor = TRANSACTIONS_PAGE.decode(query.data)
+        
+        # یک سطر اضافه فقط برای تشخیص وجود صفحه بعد خوانده می‌شود
+        limit = TRANSACTIONS_PAGE_SIZE + 1
+        if direction == "newer":
+            rows = await self.wallet_manager.get_transactions(user_id, limit, after_id=anchor)
+            has_newer = len(rows) == limit
+            rows = rows[-TRANSACTIONS_PAGE_SIZE:]
+            has_older = True
+        else:
+            rows = await self.wallet_manager.get_transactions(user_id, limit, before_id=anchor)
+            has_older = len(rows) == limit
+            rows = rows[:TRANSACTIONS_PAGE_SIZE]
+            has_newer = direction == "older"
+        if not rows and direction is not None:
+            # دکمه قدیمی روی صفحه‌ای که دیگر سطری ندارد؛ صفحه اول نمایش داده می‌شود
+            rows = await self.wallet_manager.get_transactions(user_id, limit)
+            has_older = len(rows) == limit
+            rows = rows[:TRANSACTIONS_PAGE_SIZE]
+            has_newer = False
+        
+        if not rows:
+            text = "📜 *تاریخچه تراکنش‌ها*\n\nهنوز تراکنشی ثبت نشده است."
+        else:
+            lines = []
+            for tx_id, amount_sats, tx_type, status, timestamp in rows:
+                lines.append(
+                    f"{TRANSACTION_TYPES.get(tx_type, tx_type)} | "
+                    f"`{WalletManager.to_btc(amount_sats or 0):+.8f}` BTC | "
+                    f"{TRANSACTION_STATUSES.get(status, status)}\n"
+                    f"   🕒 {timestamp}"
+                )
+            text = "📜 *تاریخچه تراکنش‌ها*\n\n" + "\n\n".join(lines)
+        
+        navigation = []
+        if has_newer:
+            navigation.append(
+                InlineKeyboardButton("⬅️ جدیدتر", callback_data=TRANSACTIONS_PAGE.encode("newer", rows[0][0]))
+            )
+        if has_older:
+            navigation.append(
+                InlineKeyboardButton("قدیمی‌تر ➡️", callback_data=TRANSACTIONS_PAGE.encode("older", rows[-1][0]))
+            )
+        keyboard = [navigation] if navigation else []
+        keyboard.append([InlineKeyboardButton("🔙 بازگشت", callback_data="wallet")])
+        
+        # پیام کیف پول تصویر است؛ صفحه اول به صورت پیام جدید ارسال می‌شود
+        if query.message.photo:
+            await query.message.reply_text(
+                text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown'
+            )
+        else:
+            await query.edit_message_text(
+                text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown'
+            )
+        return WALLET_ACTIONS
+
     async def deposit_btc(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """دریافت آدرس واریز بیت کوین"""
         user_id = update.effective_user.id
@@ -1362,7 +4339,7 @@ class ShopBot:
             f"شما می‌توانید {coins // 300 * 300} سکه خود را به {btc_amount:.3f} BTC تبدیل کنید.\n\n"
             f"آیا مطمئن هستید؟",
             reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("✅ بله، تبدیل کن", callback_data=f"confirm_convert_{coins // 300 * 300}")],
+                [InlineKeyboardButton("✅ بله، تبدیل کن", callback_data=CONVERT_COINS.encode(coins // 300 * 300))],
                 [InlineKeyboardButton("❌ انصراف", callback_data="wallet")],
             ]),
             parse_mode='Markdown'
@@ -1375,7 +4352,7 @@ class ShopBot:
         await query.answer()
         
         user_id = update.effective_user.id
-        coins = int(query.data.split("_")[2])
+        coins, = CONVERT_COINS.decode(query.data)
         
         success = await self.coin_manager.convert_coins_to_btc(user_id, coins)
         if success:
@@ -1435,47 +4412,29 @@ class ShopBot:
         return await self.show_wallet(update, context)
 
     # *********************** سیستم معرفی دوستان ***********************
-    async def generate_referral_image(self, referral_code: str, referral_count: int) -> bytes:
+    async def generate_referral_card(
+        self, referral_code: str, referral_count: int, user_id: Optional[int] = None
+    ) -> CardImage:
         """تولید تصویر سیستم معرفی"""
-        img = Image.new('RGB', (600, 400), color=(30, 30, 60))
-        draw = ImageDraw.Draw(img)
-        
-        # هدر
-        draw.rectangle([(0, 0), (600, 60)], fill=(50, 50, 100))
-        draw.text((150, 20), "سیستم معرفی دوستان", font=TITLE_FONT, fill=(255, 255, 255))
-        
-        # اطلاعات معرفی
-        draw.text((50, 100), f"کد معرف شما:", font=MONO_FONT, fill=(200, 200, 255))
-        draw.text((50, 130), referral_code, font=TITLE_FONT, fill=(0, 255, 255))
-        
-        draw.text((50, 180), f"تعداد معرفی‌های شما:", font=MONO_FONT, fill=(200, 200, 255))
-        draw.text((50, 210), f"{referral_count}/10", font=TITLE_FONT, fill=(255, 255, 0))
-        
-        draw.text((50, 260), "پاداش: 50,000 تومان بیت کوین", font=MONO_FONT, fill=(200, 255, 200))
-        draw.text((50, 290), "برای هر 10 معرفی موفق", font=MONO_FONT, fill=(200, 255, 200))
-        
-        # ذخیره تصویر در بایت
-        img_byte_arr = io.BytesIO()
-        img.save(img_byte_arr, format='PNG')
-        img_byte_arr.seek(0)
-        return img_byte_arr.getvalue()
+        return CardImage(
+            "referral", {"referral_code": referral_code, "referral_count": referral_count}, tag=user_id
+        )
 
     async def show_referral(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """نمایش بخش معرفی دوستان"""
         user_id = update.effective_user.id
         referral_code = await self.referral_system.get_referral_code(user_id)
         
-        async with aiosqlite.connect(USERS_DB_PATH) as db:
-            cursor = await db.execute(
-                "SELECT COUNT(*) FROM referrals WHERE referrer_id = ?",
-                (user_id,),
-            )
-            referral_count = (await cursor.fetchone())[0]
+        referral_count = (await Database.fetchone(
+            USERS_DB_PATH,
+            "SELECT COUNT(*) FROM referrals WHERE referrer_id = ?",
+            (user_id,),
+        ))[0]
         
         remaining = max(0, 10 - referral_count)
         
         # تولید تصویر معرفی
-        referral_image = await self.generate_referral_image(referral_code, referral_count)
+        referral_card = await self.generate_referral_card(referral_code, referral_count, user_id)
         
         message = (
             "👥 *سیستم معرفی دوستان*\n\n"
@@ -1486,8 +4445,9 @@ class ShopBot:
             f"https://t.me/{context.bot.username}?start={referral_code}"
         )
         
-        await update.callback_query.message.reply_photo(
-            photo=referral_image,
+        await self.reply_card(
+            update.callback_query.message,
+            referral_card,
             caption=message,
             parse_mode='Markdown'
         )
@@ -1495,8 +4455,14 @@ class ShopBot:
         return REFERRAL_MENU
 
     async def handle_referral_start(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-        """پردازش لینک معرفی دوستان"""
-        user = update.effective_user
+        """پردازش لینک معرفی دوستان؛ ورودی دستور /start"""
+        started = time.perf_counter()
+        try:
+            return await self._handle_referral_start(update, context)
+        finally:
+            self.start_latency.observe(time.perf_counter() - started)
+
+    async def _handle_referral_start(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         args = context.args
         
         if args and args[0].startswith("REF-"):
@@ -1517,43 +4483,14 @@ class ShopBot:
         return await self.start_auth(update, context)
 
     # *********************** گردونه شانس ***********************
-    async def generate_wheel_image(self) -> bytes:
+    async def generate_wheel_card(self) -> CardImage:
         """تولید تصویر گردونه شانس"""
-        img = Image.new('RGB', (500, 500), color=(30, 30, 60))
-        draw = ImageDraw.Draw(img)
-        
-        # رسم گردونه
-        center = (250, 250)
-        radius = 200
-        prizes = ["1 سکه", "3 سکه", "5 سکه", "10 سکه", "کد تخفیف 10%"]
-        colors = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 0), (255, 0, 255)]
-        
-        for i in range(5):
-            start_angle = i * 72
-            end_angle = (i + 1) * 72
-            draw.pieslice(
-                [center[0]-radius, center[1]-radius, center[0]+radius, center[1]+radius],
-                start_angle, end_angle, fill=colors[i]
-            )
-            
-            # افزودن متن جایزه
-            angle = math.radians(start_angle + 36)
-            text_pos = (
-                center[0] + (radius * 0.7) * math.cos(angle),
-                center[1] + (radius * 0.7) * math.sin(angle)
-            )
-            draw.text(text_pos, prizes[i], font=TITLE_FONT, fill=(0, 0, 0))
-        
-        # افزودن نشانگر
-        draw.polygon(
-            [(center[0], center[1]-radius-20), (center[0]-15, center[1]-radius), 
-             (center[0]+15, center[1]-radius)], fill=(255, 255, 255))
-        
-        # ذخیره تصویر در بایت
-        img_byte_arr = io.BytesIO()
-        img.save(img_byte_arr, format='PNG')
-        img_byte_arr.seek(0)
-        return img_byte_arr.getvalue()
+        # گردونه کاملاً ثابت است و تا پایان عمر پروسه در کش می‌ماند
+        return CardImage("wheel", {}, ttl=float("inf"))
+
+    async def generate_wheel_spin_card(self) -> CardImage:
+        """انیمیشن چرخش گردونه؛ یک بار ساخته و با file_id بازاستفاده می‌شود"""
+        return CardImage("wheel_spin", {"frames": WHEEL_SPIN_FRAMES}, ttl=float("inf"), animated=True)
 
     async def spin_wheel(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """چرخاندن گردونه شانس"""
@@ -1561,6 +4498,7 @@ class ShopBot:
         await query.answer()
         
         user_id = update.effective_user.id
+        started = time.perf_counter()
         
         # بررسی امکان چرخش گردونه
         last_spin = await self.get_last_wheel_spin(user_id)
@@ -1573,19 +4511,9 @@ class ShopBot:
             )
             return WHEEL_OF_FORTUNE
         
-        # نمایش انیمیشن چرخش
-        wheel_image = await self.generate_wheel_image()
-        message = await query.edit_message_media(
-            InputMediaPhoto(wheel_image, caption="🌀 گردونه در حال چرخش...")
-        )
-        
-        # شبیه‌سازی چرخش
-        for _ in range(8):
-            wheel_image = await self.generate_wheel_image()
-            await message.edit_media(
-                InputMediaPhoto(wheel_image, caption="🌀 گردونه در حال چرخش...")
-            )
-            await asyncio.sleep(0.5)
+        # نمایش انیمیشن چرخش (از پیش رندر شده) با یک ویرایش
+        spin_card = await self.generate_wheel_spin_card()
+        message = await self.edit_card(query, spin_card, caption="🌀 گردونه در حال چرخش...")
         
         # انتخاب جایزه تصادفی (با احتمال کمتر برای جایزه بزرگ)
         prize = random.choices(
@@ -1622,32 +4550,31 @@ class ShopBot:
                 [InlineKeyboardButton("🔙 بازگشت", callback_data="back")]
             ])
         )
+        self.spin_latency.observe(time.perf_counter() - started)
         return WHEEL_OF_FORTUNE
 
     async def get_last_wheel_spin(self, user_id: int) -> Optional[datetime]:
         """دریافت زمان آخرین چرخش گردونه"""
-        async with aiosqlite.connect(COINS_DB_PATH) as db:
-            cursor = await db.execute(
-                "SELECT last_wheel_spin FROM user_coins WHERE user_id = ?", (user_id,)
-            )
-            result = await cursor.fetchone()
-            if result and result[0]:
-                return datetime.strptime(result[0], "%Y-%m-%d %H:%M:%S")
-            return None
+        result = await Database.fetchone(
+            COINS_DB_PATH,
+            "SELECT last_wheel_spin FROM user_coins WHERE user_id = ?", (user_id,)
+        )
+        if result and result[0]:
+            return datetime.strptime(result[0], "%Y-%m-%d %H:%M:%S")
+        return None
 
     async def save_wheel_spin(self, user_id: int) -> bool:
         """ذخیره زمان آخرین چرخش گردونه"""
         try:
-            async with aiosqlite.connect(COINS_DB_PATH) as db:
-                await db.execute(
-                    """
-                    INSERT OR REPLACE INTO user_coins (user_id, last_wheel_spin)
-                    VALUES (?, CURRENT_TIMESTAMP)
-                    """,
-                    (user_id,)
-                )
-                await db.commit()
-                return True
+            await Database.execute(
+                COINS_DB_PATH,
+                """
+                INSERT INTO user_coins (user_id, last_wheel_spin) VALUES (?, CURRENT_TIMESTAMP)
+                ON CONFLICT(user_id) DO UPDATE SET last_wheel_spin = CURRENT_TIMESTAMP
+                """,
+                (user_id,)
+            )
+            return True
         except Exception as e:
             logger.error(f"خطا در ذخیره زمان چرخش گردونه: {e}")
             return False
@@ -1668,10 +4595,11 @@ class ShopBot:
             )
             return WHEEL_OF_FORTUNE
         
-        wheel_image = await self.generate_wheel_image()
+        wheel_card = await self.generate_wheel_card()
         
-        await update.callback_query.message.reply_photo(
-            photo=wheel_image,
+        await self.reply_card(
+            update.callback_query.message,
+            wheel_card,
             caption="🎡 *گردونه شانس*\n\nهر 24 ساعت یک بار می‌توانید گردونه را بچرخانید و جایزه بگیرید!",
             reply_markup=InlineKeyboardMarkup([
                 [InlineKeyboardButton("🌀 بچرخون!", callback_data="spin_wheel")],
@@ -1683,50 +4611,22 @@ class ShopBot:
         return WHEEL_OF_FORTUNE
 
     # *********************** پروفایل کاربری ***********************
-    async def generate_profile_image(self, user_id: int, username: str, coins: int, 
-                                   join_date: str, avatar: str, dark_mode: bool) -> bytes:
+    async def generate_profile_card(self, user_id: int, username: str, coins: int, 
+                                    join_date: str, avatar: str, dark_mode: bool) -> CardImage:
         """تولید کارت پروفایل گرافیکی"""
-        bg_color = (30, 30, 60) if dark_mode else (240, 240, 240)
-        text_color = (255, 255, 255) if dark_mode else (0, 0, 0)
-        secondary_color = (200, 200, 255) if dark_mode else (100, 100, 150)
-        
-        img = Image.new('RGB', (800, 600), color=bg_color)
-        draw = ImageDraw.Draw(img)
-        
-        # هدر
-        draw.rectangle([(0, 0), (800, 80)], fill=(50, 50, 100))
-        draw.text((20, 20), "پروفایل کاربری RedHotMafia", font=TITLE_FONT, fill=(255, 255, 255))
-        
-        # آواتار
-        avatar_emoji = AVATARS.get(avatar, "🕴️")
-        draw.text((50, 120), avatar_emoji, font=ImageFont.load_default(size=72), fill=text_color)
-        
-        # اطلاعات کاربر
-        y_position = 120
         level = await self.coin_manager.get_user_level(coins)
         _, _, progress = await self.coin_manager.get_level_progress(coins)
         
-        draw.text((200, y_position), f"👤 نام کاربری: {username}", font=MONO_FONT, fill=text_color)
-        y_position += 40
-        draw.text((200, y_position), f"🆔 شناسه کاربری: {user_id}", font=MONO_FONT, fill=text_color)
-        y_position += 40
-        draw.text((200, y_position), f"📅 تاریخ عضویت: {join_date}", font=MONO_FONT, fill=text_color)
-        y_position += 40
-        draw.text((200, y_position), f"🪙 سکه‌ها: {coins}", font=MONO_FONT, fill=text_color)
-        y_position += 40
-        draw.text((200, y_position), f"🏆 سطح: {level}", font=MONO_FONT, fill=text_color)
-        y_position += 40
-        
-        # نوار پیشرفت
-        draw.rectangle([(200, y_position), (600, y_position + 20)], outline=secondary_color, width=2)
-        draw.rectangle([(200, y_position), (200 + (400 * progress // 100), y_position + 20)], fill=(0, 255, 0))
-        draw.text((610, y_position), f"{progress}%", font=MONO_FONT, fill=text_color)
-        
-        # ذخیره تصویر در بایت
-        img_byte_arr = io.BytesIO()
-        img.save(img_byte_arr, format='PNG')
-        img_byte_arr.seek(0)
-        return img_byte_arr.getvalue()
+        return CardImage("profile", {
+            "user_id": user_id,
+            "username": username,
+            "coins": coins,
+            "join_date": str(join_date),
+            "avatar": avatar,
+            "dark_mode": bool(dark_mode),
+            "level": level,
+            "progress": progress,
+        }, tag=user_id)
 
     async def show_profile(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """نمایش پروفایل کاربر"""
@@ -1734,18 +4634,14 @@ class ShopBot:
         user_id = user.id
         
         # دریافت اطلاعات کاربر
-        coins = await self.coin_manager.get_coins(user_id)
-        avatar = await self.coin_manager.get_avatar(user_id)
-        dark_mode = await self.coin_manager.get_dark_mode(user_id)
-        
-        async with aiosqlite.connect(USERS_DB_PATH) as db:
-            cursor = await db.execute(
-                "SELECT registered_at FROM users WHERE user_id = ?", (user_id,)
-            )
-            join_date = (await cursor.fetchone())[0] if await cursor.fetchone() else "نامشخص"
+        snapshot = await self.profile_manager.get_snapshot(user_id)
+        coins = snapshot["coins"]
+        avatar = snapshot["avatar"]
+        dark_mode = snapshot["dark_mode"]
+        join_date = snapshot["registered_at"] or "نامشخص"
         
         # تولید تصویر پروفایل
-        profile_image = await self.generate_profile_image(
+        profile_card = await self.generate_profile_card(
             user_id, user.full_name, coins, join_date, avatar, dark_mode
         )
         
@@ -1757,8 +4653,9 @@ class ShopBot:
             [InlineKeyboardButton("🔙 بازگشت", callback_data="back")],
         ]
         
-        await update.callback_query.message.reply_photo(
-            photo=profile_image,
+        await self.reply_card(
+            update.callback_query.message,
+            profile_card,
             caption=f"👤 *پروفایل کاربری*\n\n"
                    f"🪙 سکه‌های شما: {coins}\n"
                    f"🏆 سطح فعلی: {await self.coin_manager.get_user_level(coins)}",
@@ -1801,9 +4698,9 @@ class ShopBot:
                     avatar_name = f"🔒 {avatar_name} (نیاز به سطح {required_level})"
                     callback_data = "locked_avatar"
                 else:
-                    callback_data = f"select_avatar_{avatar_key}"
+                    callback_data = AVATAR_SELECT.encode(avatar_key)
             else:
-                callback_data = f"select_avatar_{avatar_key}"
+                callback_data = AVATAR_SELECT.encode(avatar_key)
             
             row.append(InlineKeyboardButton(avatar_name, callback_data=callback_data))
             if (i + 1) % 2 == 0:
@@ -1831,7 +4728,7 @@ class ShopBot:
             await query.answer("این آواتار برای سطح شما قفل شده است!", show_alert=True)
             return AVATAR_SELECTION
         
-        avatar_key = query.data.split("_")[2]
+        avatar_key, = AVATAR_SELECT.decode(query.data)
         user_id = update.effective_user.id
         
         success = await self.coin_manager.set_avatar(user_id, avatar_key)
@@ -1842,31 +4739,12 @@ class ShopBot:
         
         return await self.show_profile(update, context)
 
-    async def generate_leaderboard_image(self, leaderboard: List[Tuple], user_rank: Optional[int]) -> bytes:
+    async def generate_leaderboard_card(self, leaderboard: List[Tuple], user_rank: Optional[int]) -> CardImage:
         """تولید تصویر جدول رتبه‌بندی"""
-        img = Image.new('RGB', (800, 600), color=(30, 30, 60))
-        draw = ImageDraw.Draw(img)
-        
-        # هدر
-        draw.rectangle([(0, 0), (800, 80)], fill=(50, 50, 100))
-        draw.text((250, 20), "جدول رتبه‌بندی", font=TITLE_FONT, fill=(255, 255, 255))
-        
-        # اطلاعات رتبه‌بندی
-        y_position = 100
-        for i, (username, coins) in enumerate(leaderboard[:5], start=1):
-            draw.text((50, y_position), f"{i}. {username}", font=MONO_FONT, fill=(200, 200, 255))
-            draw.text((600, y_position), f"{coins} سکه", font=MONO_FONT, fill=(255, 215, 0))
-            y_position += 40
-        
-        # نمایش رتبه کاربر
-        if user_rank:
-            draw.text((50, 500), f"رتبه شما: {user_rank}", font=TITLE_FONT, fill=(0, 255, 255))
-        
-        # ذخیره تصویر در بایت
-        img_byte_arr = io.BytesIO()
-        img.save(img_byte_arr, format='PNG')
-        img_byte_arr.seek(0)
-        return img_byte_arr.getvalue()
+        return CardImage("leaderboard", {
+            "leaderboard": [[username, coins] for username, coins in leaderboard],
+            "user_rank": user_rank,
+        })
 
     async def show_leaderboard(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """نمایش جدول رتبه‌بندی"""
@@ -1875,10 +4753,11 @@ class ShopBot:
         user_rank = await self.coin_manager.get_user_rank(user_id)
         
         # تولید تصویر جدول رتبه‌بندی
-        leaderboard_image = await self.generate_leaderboard_image(leaderboard, user_rank)
+        leaderboard_card = await self.generate_leaderboard_card(leaderboard, user_rank)
         
-        await update.callback_query.message.reply_photo(
-            photo=leaderboard_image,
+        await self.reply_card(
+            update.callback_query.message,
+            leaderboard_card,
             caption="🏆 *جدول رتبه‌بندی*\n\n5 کاربر برتر بر اساس تعداد سکه‌ها",
             reply_markup=InlineKeyboardMarkup([
                 [InlineKeyboardButton("🔙 بازگشت", callback_data="profile")],
@@ -1912,6 +4791,8 @@ class ShopBot:
         """افزودن محصول جدید"""
         query = update.callback_query
         await query.answer()
+        # ویرایش نیمه‌تمام قبلی لغو می‌شود تا متن بعدی محصول جدید ثبت شود
+        context.user_data.pop('editing_product', None)
         
         await query.edit_message_text(
             "لطفاً اطلاعات محصول را به فرمت زیر ارسال کنید:\n\n"
@@ -1926,15 +4807,9 @@ class ShopBot:
         query = update.callback_query
         await query.answer()
         
-        keyboard = []
-        for product_key in self.products.keys():
-            keyboard.append([InlineKeyboardButton(self.products[product_key].name, callback_data=f"edit_{product_key}")])
-        
-        keyboard.append([InlineKeyboardButton("🔙 بازگشت", callback_data="manage_products")])
-        
         await query.edit_message_text(
             "✏️ *ویرایش محصول*\n\nلطفاً محصولی را که می‌خواهید ویرایش کنید انتخاب کنید:",
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            reply_markup=self.catalog.snapshot.edit_keyboard,
             parse_mode='Markdown'
         )
         return ADMIN_MANAGE_PRODUCTS
@@ -1944,19 +4819,19 @@ class ShopBot:
         query = update.callback_query
         await query.answer()
         
-        keyboard = []
-        for product_key in self.products.keys():
-            keyboard.append([InlineKeyboardButton(self.products[product_key].name, callback_data=f"remove_{product_key}")])
-        
-        keyboard.append([InlineKeyboardButton("🔙 بازگشت", callback_data="manage_products")])
-        
         await query.edit_message_text(
             "🗑️ *حذف محصول*\n\nلطفاً محصولی را که می‌خواهید حذف کنید انتخاب کنید:",
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            reply_markup=self.catalog.snapshot.remove_keyboard,
             parse_mode='Markdown'
         )
         return ADMIN_MANAGE_PRODUCTS
 
+    async def process_product_text(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+        """متن اطلاعات محصول: ویرایش اگر محصولی برای ویرایش انتخاب شده، وگرنه افزودن"""
+        if context.user_data.get('editing_product'):
+            return await self.save_edited_product(update, context)
+        return await self.process_add_product(update, context)
+
     async def process_add_product(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """پردازش افزودن محصول جدید"""
         try:
@@ -1971,18 +4846,19 @@ class ShopBot:
             btc_address = parts[4].strip()
             stock = int(parts[5].strip())
             
-            # تولید کلید محصول
-            product_key = name.lower().replace(' ', '_')
+            # تولید کلید محصول (کوتاه و بدون _ تا در callback_data قابل استفاده باشد)
+            product_key = uuid.uuid4().hex[:8]
             
             # افزودن محصول جدید
-            self.products[product_key] = Product(
+            await self.catalog.save(Product(
                 name=name,
                 price=price,
                 description=description,
                 features=features,
                 btc_address=btc_address,
-                stock=stock
-            )
+                stock=stock,
+                key=product_key,
+            ))
             
             await update.message.reply_text(
     f"✅ محصول '{name}' با موفقیت افزوده شد!",
@@ -2006,10 +4882,23 @@ class ShopBot:
         query = update.callback_query
         await query.answer()
         
-        product_key = query.data.split('_')[1]
-        product = self.products[product_key]
+        product_key, = PRODUCT_EDIT.decode(query.data)
+        product = self.products.get(product_key)
+        if product is None:
+            # دکمه قدیمی: محصول در این فاصله حذف شده است
+            await query.edit_message_text(
+                "⚠️ محصول یافت نشد! ممکن است قبلاً حذف شده باشد.",
+                reply_markup=InlineKeyboardMarkup([
+                    [InlineKeyboardButton("🔙 بازگشت به مدیریت", callback_data="admin")]
+                ])
+            )
+            return ADMIN_ACTIONS
         
         context.user_data['editing_product'] = product_key
+        # امکانات در یک خط نمایش داده می‌شوند تا با فرمت ورودی (جدا شده با -) سازگار باشند
+        features = " ".join(product.features)
+        # موجودی فرم شامل واحدهای رزرو شده است؛ save آن‌ها را دوباره کم می‌کند
+        stock = product.stock + await Catalog.held(product_key)
         
         await query.edit_message_text(
             f"✏️ *ویرایش محصول: {product.name}*\n\n"
@@ -2017,7 +4906,7 @@ class ShopBot:
             f"نام محصول\nقیمت\nتوضیحات\nامکانات (با خط جدید و - جدا کنید)\nآدرس بیت کوین\nموجودی\n\n"
             f"مثال:\n"
             f"{product.name}\n{product.price}\n{product.description}\n"
-            f"{'\\n'.join(product.features)}\n{product.btc_address}\n{product.stock}",
+            f"{features}\n{product.btc_address}\n{stock}",
             parse_mode='Markdown'
         )
         return ADMIN_MANAGE_PRODUCTS
@@ -2027,11 +4916,21 @@ class ShopBot:
         query = update.callback_query
         await query.answer()
         
-        product_key = query.data.split('_')[1]
-        product_name = self.products[product_key].name
+        product_key, = PRODUCT_REMOVE.decode(query.data)
+        product = self.products.get(product_key)
+        if product is None:
+            # دکمه قدیمی: محصول در این فاصله حذف شده است
+            await query.edit_message_text(
+                "⚠️ محصول یافت نشد! ممکن است قبلاً حذف شده باشد.",
+                reply_markup=InlineKeyboardMarkup([
+                    [InlineKeyboardButton("🔙 بازگشت به مدیریت", callback_data="admin")]
+                ])
+            )
+            return ADMIN_ACTIONS
+        product_name = product.name
         
         # حذف محصول
-        del self.products[product_key]
+        await self.catalog.remove(product_key)
         
         await query.edit_message_text(
             f"✅ محصول '{product_name}' با موفقیت حذف شد!",
@@ -2044,7 +4943,7 @@ class ShopBot:
     async def save_edited_product(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """ذخیره تغییرات محصول ویرایش شده"""
         try:
-            product_key = context.user_data['editing_product']
+            product_key = context.user_data.pop('editing_product')
             parts = update.message.text.split('\n')
             
             if len(parts) < 6:
@@ -2058,14 +4957,15 @@ class ShopBot:
             stock = int(parts[5].strip())
             
             # به‌روزرسانی محصول
-            self.products[product_key] = Product(
+            await self.catalog.save(Product(
                 name=name,
                 price=price,
                 description=description,
                 features=features,
                 btc_address=btc_address,
-                stock=stock
-            )
+                stock=stock,
+                key=product_key,
+            ))
             
             await update.message.reply_text(
                 f"✅ محصول '{name}' با موفقیت به‌روزرسانی شد!",
@@ -2141,98 +5041,17 @@ class ShopBot:
             return ADMIN_ACTIONS
 
     # *********************** دستورات ربات ***********************
-    async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-        """دستور شروع ربات"""
-        try:
-            await self.show_hacking_animation(update)
-            await self.show_battery_animation(update)
-            
-            user = update.effective_user
-            stats_msg = await self.get_stats_message()
-            
-            # دریافت اطلاعات کاربر
-            balance = await self.wallet_manager.get_balance(user.id)
-            coins = await self.coin_manager.get_coins(user.id)
-            orders = await self.get_user_orders(user.id)
-            referral_code = await self.referral_system.get_referral_code(user.id)
-            avatar = await self.coin_manager.get_avatar(user.id)
-            dark_mode = await self.coin_manager.get_dark_mode(user.id)
-            
-            async with aiosqlite.connect(USERS_DB_PATH) as db:
-                cursor = await db.execute(
-                    "SELECT registered_at FROM users WHERE user_id = ?", (user.id,)
-                )
-                join_date = (await cursor.fetchone())[0] if await cursor.fetchone() else "نامشخص"
-            
-            # تولید کارت پروفایل
-            profile_image = await self.generate_profile_image(
-                user.id, user.full_name, coins, join_date, avatar, dark_mode
-            )
-            
-            # ارسال تصویر پروفایل
-            await update.message.reply_photo(
-                photo=profile_image,
-                caption=f"👋 سلام {user.full_name}!\n\nبه ربات فروشگاه RedHotMafia خوش آمدید!\n\n{stats_msg}",
-                parse_mode='Markdown'
-            )
-            
-            # منوی شیشه‌ای
-            keyboard = [
-                [InlineKeyboardButton("🎮 محصولات ما", callback_data="products")],
-                [InlineKeyboardButton("📦 سفارشات من", callback_data="my_orders")],
-                [InlineKeyboardButton("💰 کیف پول دیجیتال", callback_data="wallet")],
-                [InlineKeyboardButton("👤 پروفایل کاربری", callback_data="profile")],
-                [InlineKeyboardButton("👥 سیستم معرفی", callback_data="referral")],
-                [InlineKeyboardButton("🆘 پشتیبانی", callback_data="support")],
-                [InlineKeyboardButton("📚 راهنمای ربات", callback_data="help_command")],
-            ]
-
-            if self.is_admin(user.id):
-                keyboard.append(
-                    [InlineKeyboardButton("🔐 پنل مدیریت پیشرفته", callback_data="admin")]
-                )
-
-            await update.message.reply_text(
-                "لطفاً یکی از گزینه‌های زیر را انتخاب کنید:",
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-            
-            # شروع ارسال پیام‌های دوره‌ای
-            if not self.daily_notification_task:
-                self.daily_notification_task = asyncio.create_task(self.send_periodic_notifications(context))
-            
-            return SELECTING_ACTION
-
-        except Exception as e:
-            logger.error(f"خطا در شروع: {e}", exc_info=True)
-            await update.message.reply_text("⚠️ خطای سیستمی! لطفا بعدا تلاش کنید.")
-            return ConversationHandler.END
-
-    async def generate_license_image(self, license_code: str) -> bytes:
+    async def generate_license_card(self, license_code: str) -> CardImage:
         """تولید کارت لایسنس گرافیکی"""
-        img = Image.new('RGB', (600, 300), color=(0, 0, 0))
-        draw = ImageDraw.Draw(img)
-        
-        # افزودن افکت هکری
-        for _ in range(50):
-            x1, y1 = random.randint(0, 600), random.randint(0, 300)
-            x2, y2 = random.randint(0, 600), random.randint(0, 300)
-            draw.line([(x1, y1), (x2, y2)], fill=(0, 255, 0), width=1)
-        
-        # افزودن متن لایسنس
-        draw.text((150, 100), "REDHOT MAFIA LICENSE", font=TITLE_FONT, fill=(0, 255, 0))
-        draw.text((150, 150), license_code, font=TITLE_FONT, fill=(0, 255, 255))
-        draw.text((150, 200), "Valid for 30 days", font=MONO_FONT, fill=(255, 255, 255))
-        
-        # ذخیره تصویر در بایت
-        img_byte_arr = io.BytesIO()
-        img.save(img_byte_arr, format='PNG')
-        img_byte_arr.seek(0)
-        return img_byte_arr.getvalue()
+        # هر لایسنس فقط یک بار ارسال می‌شود و نیازی به کش ندارد
+        return CardImage(
+            "license", {"license_code": license_code, "seed": random.getrandbits(32)}, cache=False
+        )
 
     async def send_license(self, context: ContextTypes.DEFAULT_TYPE, user_id: int, license_code: str):
         """ارسال لایسنس به صورت گرافیکی"""
-        license_image = await self.generate_license_image(license_code)
+        license_card = await self.generate_license_card(license_code)
+        license_image = await self.render_service.render_card(license_card)
         
         await context.bot.send_photo(
             chat_id=user_id,
@@ -2244,26 +5063,11 @@ class ShopBot:
             parse_mode='Markdown'
         )
 
-    async def generate_invoice_image(self, order_details: dict) -> bytes:
+    async def generate_invoice_card(self, order_details: dict, user_id: Optional[int] = None) -> CardImage:
         """تولید فاکتور گرافیکی"""
-        img = Image.new('RGB', (800, 600), color=(240, 240, 240))
-        draw = ImageDraw.Draw(img)
-        
-        # هدر فاکتور
-        draw.rectangle([(0, 0), (800, 80)], fill=(30, 30, 60))
-        draw.text((20, 20), "فاکتور سفارش RedHotMafia", font=TITLE_FONT, fill=(255, 255, 255))
-        
-        # جزئیات سفارش
-        y_position = 100
-        for key, value in order_details.items():
-            draw.text((20, y_position), f"{key}: {value}", font=MONO_FONT, fill=(0, 0, 0))
-            y_position += 30
-        
-        # ذخیره تصویر در بایت
-        img_byte_arr = io.BytesIO()
-        img.save(img_byte_arr, format='PNG')
-        img_byte_arr.seek(0)
-        return img_byte_arr.getvalue()
+        return CardImage(
+            "invoice", {"order_details": [[key, str(value)] for key, value in order_details.items()]}, tag=user_id
+        )
 
     async def view_user_orders(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """مشاهده سفارشات کاربر با فاکتور گرافیکی"""
@@ -2291,10 +5095,11 @@ class ShopBot:
             }
             
             # تولید فاکتور گرافیکی
-            invoice_image = await self.generate_invoice_image(order_details)
+            invoice_card = await self.generate_invoice_card(order_details, user_id)
             
-            await update.callback_query.message.reply_photo(
-                photo=invoice_image,
+            await self.reply_card(
+                update.callback_query.message,
+                invoice_card,
                 caption=f"سفارش #{order_id}",
             )
         
@@ -2311,26 +5116,20 @@ class ShopBot:
         query = update.callback_query
         await query.answer()
         
-        product_key = query.data.split("_")[1]
-        product = self.products[product_key]
-        
-        # به روزرسانی موجودی محصول
-        product.update_stock()
+        product_key, = PRODUCT_DETAILS.decode(query.data)
+        snapshot = self.catalog.snapshot
+        product = snapshot.products.get(product_key)
+        if product is None:
+            return await self.show_products(update, context)
         
         # هشدار موجودی کم
         stock_warning = ""
         if product.stock <= 1:
             stock_warning = "\n\n⚠️ *هشدار: موجودی در حال اتمام است!*"
         
-        # دکمه‌های شیشه‌ای
-        keyboard = [
-            [InlineKeyboardButton("💳 خرید محصول", callback_data=f"pay_{product_key}")],
-            [InlineKeyboardButton("🔙 بازگشت به محصولات", callback_data="products")],
-        ]
-        
         await query.edit_message_text(
             product.get_info() + stock_warning,
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            reply_markup=snapshot.detail_keyboards[product_key],
             parse_mode='Markdown'
         )
         return SELECTING_ACTION
@@ -2340,14 +5139,18 @@ class ShopBot:
         query = update.callback_query
         await query.answer()
         
-        product_key = query.data.split("_")[1]
-        product = self.products[product_key]
+        product_key, = PRODUCT_PAY.decode(query.data)
+        product = self.products.get(product_key)
+        if product is None:
+            return await self.show_products(update, context)
         
         # ذخیره محصول انتخاب شده در context
         context.user_data["selected_product"] = product_key
         
-        # بررسی موجودی محصول
-        if product.stock <= 0:
+        # رزرو یک واحد تا پایان پرداخت
+        reservation_id = await self.catalog.reserve(product_key, update.effective_user.id)
+        context.user_data["reservation_id"] = reservation_id
+        if reservation_id is None:
             await query.edit_message_text(
                 "⚠️ متأسفانه این محصول در حال حاضر موجود نیست. لطفاً محصول دیگری انتخاب کنید.",
                 reply_markup=InlineKeyboardMarkup([
@@ -2363,10 +5166,11 @@ class ShopBot:
             f"2. پس از واریز، هش تراکنش (TX Hash) را برای ما ارسال کنید.\n\n"
             f"3. پرداخت شما حداکثر تا **1 ساعت** تأیید خواهد شد.\n\n"
             f"4. پس از تأیید، کد لایسنس به صورت خودکار برای شما ارسال می‌شود.\n\n"
+            f"⏳ یک عدد از این محصول به مدت {RESERVATION_TTL // 60} دقیقه برای شما رزرو شده است.\n\n"
             f"⚠️ توجه: در صورت عدم ارسال هش تراکنش در مدت 24 ساعت، سفارش شما لغو خواهد شد.",
             parse_mode='Markdown',
             reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔙 بازگشت", callback_data=f"product_{product_key}")]
+                [InlineKeyboardButton("🔙 بازگشت", callback_data=PRODUCT_DETAILS.encode(product_key))]
             ])
         )
         return CONFIRM_PAYMENT
@@ -2374,36 +5178,54 @@ class ShopBot:
     async def handle_tx_hash(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """پردازش هش تراکنش"""
         user = update.effective_user
-        tx_hash = update.message.text.strip()
+        tx_hash = update.message.text.strip().lower()
         
-        if not re.match(r"^[a-fA-F0-9]{64}$", tx_hash):
+        if not re.match(r"^[a-f0-9]{64}$", tx_hash):
             await update.message.reply_text(
                 "فرمت هش تراکنش صحیح نیست. لطفاً یک هش تراکنش معتبر وارد کنید:"
             )
             return CONFIRM_PAYMENT
         
+        # ارسال دوباره همان هش سفارش جدیدی نمی‌سازد
+        existing = await self.get_order_by_tx_hash(tx_hash)
+        if existing:
+            return await self.reply_existing_order(update, context, user.id, existing)
+        
         # ذخیره سفارش
         tracking_code = self.generate_tracking_code()
         product_key = context.user_data.get("selected_product", "mafia")
-        product = self.products[product_key]
+        product = self.products.get(product_key)
+        
+        # ثبت سفارش و اتصال رزرو موجودی در یک تراکنش
+        order = None
+        if product is not None:
+            async with Database.transaction(DB_PATH) as db:
+                reserved = await Catalog.attach(
+                    db, context.user_data.get("reservation_id"), product_key, user.id, tracking_code
+                )
+                if reserved:
+                    order = await self.save_order(
+                        user.id,
+                        user.full_name,
+                        product,
+                        tracking_code,
+                        tx_hash
+                    )
+                    if order is None or order[1] != tracking_code:
+                        await Catalog.resolve(db, tracking_code, completed=False)
+            await self.catalog.reload()
         
-        # بررسی مجدد موجودی محصول
-        if product.stock <= 0:
+        if product is None or not reserved:
             await update.message.reply_text(
                 "⚠️ متأسفانه موجودی این محصول به پایان رسیده است. لطفاً محصول دیگری انتخاب کنید."
             )
             return await self.show_products(update, context)
-        
-        # کاهش موجودی محصول پس از تأیید پرداخت
-        product.stock -= 1
-        
-        await self.save_order(
-            user.id,
-            user.full_name,
-            product,
-            tracking_code,
-            tx_hash
-        )
+        if order is None:
+            await update.message.reply_text("⚠️ خطای سیستمی! لطفا بعدا تلاش کنید.")
+            return CONFIRM_PAYMENT
+        if order[1] != tracking_code:
+            # همین هش همزمان در درخواست دیگری ثبت شده است
+            return await self.reply_existing_order(update, context, user.id, order)
         
         # اطلاع به ادمین
         admin_msg = (
@@ -2418,9 +5240,6 @@ class ShopBot:
         
         await self.send_to_admin(context, admin_msg)
         
-        # تأیید خودکار پرداخت بعد از 1 ساعت
-        asyncio.create_task(self.auto_confirm_payment(tx_hash, user.id, tracking_code))
-        
         await update.message.reply_text(
             f"✅ سفارش شما با موفقیت ثبت شد!\n\n"
             f"کد پیگیری: `{tracking_code}`\n\n"
@@ -2431,33 +5250,142 @@ class ShopBot:
         context.user_data.clear()
         return await self.show_main_menu(update, context)
 
-    async def auto_confirm_payment(self, tx_hash: str, user_id: int, tracking_code: str):
-        """تأیید خودکار پرداخت بعد از 1 ساعت"""
-        await asyncio.sleep(3600)  # 1 ساعت تأخیر
+    async def reply_existing_order(
+        self, update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, order: Tuple
+    ) -> int:
+        """پاسخ به ارسال مجدد هش تراکنشی که قبلاً ثبت شده است"""
+        owner_id, tracking_code, status = order
+        if owner_id != user_id:
+            await update.message.reply_text(
+                "⚠️ این هش تراکنش قبلاً برای سفارش دیگری ثبت شده است. لطفاً هش تراکنش خود را وارد کنید:"
+            )
+            return CONFIRM_PAYMENT
         
-        async with aiosqlite.connect(DB_PATH) as db:
-            cursor = await db.execute(
-                "SELECT status FROM orders WHERE tx_hash = ?", (tx_hash,)
+        await update.message.reply_text(
+            f"ℹ️ این تراکنش قبلاً ثبت شده است.\n\n"
+            f"کد پیگیری: `{tracking_code}`\n"
+            f"وضعیت: {status}",
+            parse_mode='Markdown'
+        )
+        context.user_data.clear()
+        return await self.show_main_menu(update, context)
+
+    async def verify_payments(self) -> float:
+        """بررسی دسته‌ای پرداخت سفارش‌های در انتظار و بازگرداندن زمان اجرای بعدی"""
+        last_id = 0
+        while True:
+            orders = await Database.fetchall(
+                DB_PATH,
+                """
+                SELECT id, user_id, tracking_code, tx_hash, btc_address, amount_sats,
+                       timestamp < datetime('now', ?)
+                FROM orders
+                WHERE status = 'pending' AND id > ?
+                ORDER BY id
+                LIMIT ?
+                """,
+                (f"-{PAYMENT_EXPIRY_HOURS} hours", last_id, PAYMENT_VERIFY_BATCH)
             )
-            order = await cursor.fetchone()
+            if not orders:
+                break
+            last_id = orders[-1][0]
             
-            if order and order[0] == "pending":
-                # تأیید خودکار
-                await db.execute(
-                    "UPDATE orders SET status = 'completed' WHERE tx_hash = ?",
-                    (tx_hash,)
-                )
-                await db.commit()
-                
-                # ارسال لایسنس به کاربر
-                await self.send_license(self.application.context, user_id, tracking_code)
-                
-                # اطلاع به کاربر
-                await self.send_to_user(
-                    self.application.context, 
-                    user_id, 
-                    f"🎉 پرداخت شما تأیید شد! کد لایسنس به شما ارسال گردید."
-                )
+            try:
+                txs = await self.payment_verifier.lookup(list({order[3] for order in orders}))
+            except Exception as e:
+                logger.error(f"خطا در دریافت تراکنش‌ها از بلاکچین: {e}")
+                break
+            
+            for order_id, user_id, tracking_code, tx_hash, address, amount_sats, expired in orders:
+                verdict = PaymentVerifier.check(txs.get(tx_hash), address, amount_sats)
+                if verdict == "review":
+                    await self.flag_order_for_review(order_id, tracking_code, tx_hash)
+                elif verdict == "confirmed":
+                    await self.complete_paid_order(order_id, user_id, tracking_code)
+                elif verdict == "invalid" or (verdict == "missing" and expired):
+                    await self.cancel_unpaid_order(order_id, user_id, tracking_code, tx_hash, verdict)
+            
+            if len(orders) < PAYMENT_VERIFY_BATCH:
+                break
+        
+        return time.time() + PAYMENT_VERIFY_INTERVAL
+
+    async def flag_order_for_review(self, order_id: int, tracking_code: str, tx_hash: str) -> None:
+        """انتقال سفارشی که قابل بررسی خودکار نیست (بدون آدرس یا مبلغ) به بررسی دستی ادمین"""
+        updated = await Database.execute(
+            DB_PATH, "UPDATE orders SET status = 'review' WHERE id = ? AND status = 'pending'", (order_id,)
+        )
+        if not updated:
+            return
+        await self.send_to_admin(
+            self.application,
+            f"🔎 سفارش #{order_id} ({tracking_code}) آدرس یا مبلغ مشخصی ندارد و خودکار تأیید نمی‌شود.\n"
+            f"🔗 TX Hash: {tx_hash}\nلطفاً پرداخت را دستی بررسی و سفارش را تأیید یا حذف کنید."
+        )
+
+    async def complete_paid_order(self, order_id: int, user_id: int, tracking_code: str) -> None:
+        """تکمیل سفارشی که پرداخت آن روی بلاکچین تأیید شده است"""
+        async with Database.transaction(DB_PATH) as db:
+            rows = await db.execute_fetchall(
+                "UPDATE orders SET status = 'completed' WHERE id = ? AND status = 'pending' RETURNING id",
+                (order_id,)
+            )
+            if rows:
+                await Catalog.resolve(db, tracking_code, completed=True)
+        if not rows:
+            return
+        
+        # ارسال لایسنس به کاربر؛ خطای ارسال نباید بقیه دسته تأیید را متوقف کند
+        try:
+            await self.send_license(self.application, user_id, tracking_code)
+        except Exception as e:
+            logger.error(f"خطا در ارسال لایسنس سفارش {order_id} به کاربر {user_id}: {e}")
+            await self.send_to_admin(
+                self.application,
+                f"⚠️ پرداخت سفارش #{order_id} ({tracking_code}) تأیید شد اما ارسال لایسنس "
+                f"به کاربر {user_id} انجام نشد. لطفاً لایسنس را دستی ارسال کنید.\nخطا: {e}"
+            )
+            await self.send_to_user(
+                self.application,
+                user_id,
+                f"✅ پرداخت سفارش {tracking_code} تأیید شد. ارسال لایسنس با تأخیر انجام می‌شود؛ "
+                f"پشتیبانی در حال پیگیری است."
+            )
+            return
+        
+        # اطلاع به کاربر
+        await self.send_to_user(
+            self.application, 
+            user_id, 
+            f"🎉 پرداخت شما تأیید شد! کد لایسنس به شما ارسال گردید."
+        )
+
+    async def cancel_unpaid_order(
+        self, order_id: int, user_id: int, tracking_code: str, tx_hash: str, verdict: str
+    ) -> None:
+        """لغو سفارشی که پرداخت آن معتبر نیست یا در مهلت مقرر پیدا نشد"""
+        async with Database.transaction(DB_PATH) as db:
+            rows = await db.execute_fetchall(
+                "UPDATE orders SET status = 'canceled' WHERE id = ? AND status = 'pending' RETURNING id",
+                (order_id,)
+            )
+            restocked = bool(rows) and await Catalog.resolve(db, tracking_code, completed=False)
+        if not rows:
+            return
+        if restocked:
+            await self.catalog.reload()
+        
+        reason = "تراکنش به آدرس محصول یا با مبلغ کافی واریز نشده است" if verdict == "invalid" \
+            else f"تراکنش تا {PAYMENT_EXPIRY_HOURS} ساعت روی شبکه پیدا نشد"
+        await self.send_to_user(
+            self.application,
+            user_id,
+            f"❌ سفارش {tracking_code} لغو شد: {reason}.\nدر صورت نیاز با پشتیبانی تماس بگیرید."
+        )
+        await self.send_to_admin(
+            self.application,
+            f"❌ سفارش #{order_id} ({tracking_code}) لغو شد: {reason}\n🔗 TX Hash: {tx_hash}"
+        )
 
     async def admin_panel(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """پنل مدیریت"""
@@ -2484,23 +5412,65 @@ class ShopBot:
         return ADMIN_ACTIONS
 
     async def view_orders(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-        """مشاهده سفارشات برای ادمین"""
+        """مرور سفارشات برای ادمین با فیلتر و صفحه‌بندی"""
         query = update.callback_query
-        await query.answer()
-        
-        orders = await self.get_all_orders()
+        if query:
+            await query.answer()
+        order_filters = context.user_data.setdefault(
+            "order_filters", {"status": None, "product": None, "days": None}
+        )
         
-        if not orders:
-            await query.edit_message_text(
-                "هیچ سفارشی ثبت نشده است.",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 بازگشت", callback_data="admin")]
-                ])
+        data = query.data if query else "view_orders"
+        prefix = data.partition(CALLBACK_SEPARATOR)[0]
+        if prefix == ORDERS_FILTER.prefix:
+            # هر دکمه فیلتر بین مقادیر ممکن می‌چرخد
+            name, = ORDERS_FILTER.decode(data)
+            choices = {
+                "status": ORDER_STATUS_FILTERS,
+                "product": (None, *(product.name for product in self.products.values())),
+                "days": ORDER_DAYS_FILTERS,
+            }[name]
+            current = order_filters[name]
+            position = choices.index(current) if current in choices else -1
+            order_filters[name] = choices[(position + 1) % len(choices)]
+            context.user_data["order_page"] = None
+        elif prefix == ORDERS_PAGE.prefix:
+            context.user_data["order_page"] = ORDERS_PAGE.decode(data)
+        elif data == "view_orders":
+            context.user_data["order_page"] = None
+        
+        return await self.show_orders_page(update, context)
+
+    async def show_orders_page(
+        self, update: Update, context: ContextTypes.DEFAULT_TYPE, notice: str = ""
+    ) -> int:
+        """نمایش صفحه جاری مرورگر سفارشات"""
+        query = update.callback_query
+        order_filters = context.user_data.setdefault(
+            "order_filters", {"status": None, "product": None, "days": None}
+        )
+        page = context.user_data.get("order_page")
+        
+        # یک سطر اضافه فقط برای تشخیص وجود صفحه بعد خوانده می‌شود
+        limit = ORDERS_PAGE_SIZE + 1
+        if page and page[0] == "newer":
+            orders = await self.get_orders_page(**order_filters, after_id=page[1], limit=limit)
+            has_newer = len(orders) == limit
+            orders = orders[-ORDERS_PAGE_SIZE:]
+            has_older = True
+        else:
+            orders = await self.get_orders_page(
+                **order_filters, before_id=page[1] if page else None, limit=limit
             )
-            return ADMIN_ACTIONS
+            has_older = len(orders) == limit
+            orders = orders[:ORDERS_PAGE_SIZE]
+            has_newer = page is not None
         
-        message = "📋 *لیست سفارشات*\n\n"
-        for order in orders[:10]:  # نمایش 10 سفارش آخر
+        message = f"{notice}\n\n" if notice else ""
+        message += "📋 *لیست سفارشات*\n\n"
+        if not orders:
+            message += "هیچ سفارشی با این فیلترها ثبت نشده است."
+        for order in orders:
             order_id, user_id, full_name, product, price, tracking_code, status, timestamp = order
             message += (
                 f"🆔 #{order_id}\n"
@@ -2512,22 +5482,45 @@ class ShopBot:
                 f"📅 {timestamp}\n\n"
             )
         
-        keyboard = []
-        for order in orders[:10]:
+        product_label = order_filters["product"] or "همه محصولات"
+        keyboard = [[
+            InlineKeyboardButton(
+                f"📌 {ORDER_STATUS_LABELS[order_filters['status']]}", callback_data=ORDERS_FILTER.encode("status")
+            ),
+            InlineKeyboardButton(f"📦 {product_label[:20]}", callback_data=ORDERS_FILTER.encode("product")),
+            InlineKeyboardButton(
+                f"📅 {ORDER_DAYS_LABELS[order_filters['days']]}", callback_data=ORDERS_FILTER.encode("days")
+            ),
+        ]]
+        for order in orders:
             order_id = order[0]
-            if order[6] == 'pending':
+            if order[6] in ('pending', 'review'):
                 keyboard.append([
-                    InlineKeyboardButton(f"✅ تأیید #{order_id}", callback_data=f"confirm_{order_id}"),
-                    InlineKeyboardButton(f"❌ حذف #{order_id}", callback_data=f"delete_{order_id}")
+                    InlineKeyboardButton(f"✅ تأیید #{order_id}", callback_data=ORDER_CONFIRM.encode(order_id)),
+                    InlineKeyboardButton(f"❌ حذف #{order_id}", callback_data=ORDER_DELETE.encode(order_id))
                 ])
         
+        navigation = []
+        if has_newer and orders:
+            navigation.append(InlineKeyboardButton("⬅️ جدیدتر", callback_data=ORDERS_PAGE.encode("newer", orders[0][0])))
+        if has_older:
+            navigation.append(InlineKeyboardButton("قدیمی‌تر ➡️", callback_data=ORDERS_PAGE.encode("older", orders[-1][0])))
+        if navigation:
+            keyboard.append(navigation)
         keyboard.append([InlineKeyboardButton("🔙 بازگشت", callback_data="admin")])
         
-        await query.edit_message_text(
-            message,
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode='Markdown'
-        )
+        if query:
+            await query.edit_message_text(
+                message,
+                reply_markup=InlineKeyboardMarkup(keyboard),
+                parse_mode='Markdown'
+            )
+        else:
+            await update.message.reply_text(
+                message,
+                reply_markup=InlineKeyboardMarkup(keyboard),
+                parse_mode='Markdown'
+            )
         return ADMIN_ACTIONS
 
     async def view_stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -2538,19 +5531,26 @@ class ShopBot:
         online_users = self.stats_generator.get_online_users()
         successful_orders = self.stats_generator.get_successful_orders()
         
-        async with aiosqlite.connect(USERS_DB_PATH) as db:
-            cursor = await db.execute("SELECT COUNT(*) FROM users")
-            total_users = (await cursor.fetchone())[0]
-            
-            cursor = await db.execute("SELECT COUNT(*) FROM referrals")
-            total_referrals = (await cursor.fetchone())[0]
+        total_users, total_referrals = await Database.fetchone(
+            USERS_DB_PATH,
+            "SELECT (SELECT COUNT(*) FROM users), (SELECT COUNT(*) FROM referrals)"
+        )
+        spin_stats = self.spin_latency.get_stats()
+        start_stats = self.start_latency.get_stats()
+        profile_stats = profile_cache.get_stats()
+        scheduler_stats = await self.scheduler.get_stats()
         
         await query.edit_message_text(
             f"📊 *آمار سیستم*\n\n"
             f"👥 کاربران آنلاین: {online_users}\n"
             f"✅ خریدهای موفق: {successful_orders}\n"
             f"👤 کاربران ثبت‌نامی: {total_users}\n"
-            f"🤝 معرفی‌های انجام شده: {total_referrals}\n\n"
+            f"🤝 معرفی‌های انجام شده: {total_referrals}\n"
+            f"🎡 زمان چرخش گردونه (p95): {spin_stats['p95']:.2f} ثانیه\n"
+            f"🚀 زمان پاسخ /start (p95): {start_stats['p95']:.2f} ثانیه\n"
+            f"🗂 نرخ برخورد کش پروفایل: {profile_stats['hit_rate']:.0%}\n"
+            f"⏰ کارهای زمان‌بندی شده: {scheduler_stats['pending']} "
+            f"(تأخیر p95: {scheduler_stats['lag']['p95']:.1f} ثانیه)\n\n"
             f"🔄 آخرین به‌روزرسانی: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
             reply_markup=InlineKeyboardMarkup([
                 [InlineKeyboardButton("🔙 بازگشت", callback_data="admin")]
@@ -2564,7 +5564,7 @@ class ShopBot:
         query = update.callback_query
         await query.answer()
         
-        order_id = int(query.data.split("_")[1])
+        order_id, = ORDER_CONFIRM.decode(query.data)
         await self.update_order_status(order_id, "completed")
         
         order = await self.get_order(order_id)
@@ -2575,25 +5575,22 @@ class ShopBot:
             # ارسال لایسنس به کاربر
             await self.send_license(context, user_id, tracking_code)
             
-            await query.edit_message_text(
-                f"✅ سفارش #{order_id} با موفقیت تأیید شد و کد لایسنس برای کاربر ارسال گردید."
+            return await self.show_orders_page(
+                update, context, f"✅ سفارش #{order_id} با موفقیت تأیید شد و کد لایسنس برای کاربر ارسال گردید."
             )
         
-        return await self.view_orders(update, context)
+        return await self.show_orders_page(update, context)
 
     async def delete_order(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """حذف سفارش توسط ادمین"""
         query = update.callback_query
         await query.answer()
         
-        order_id = int(query.data.split("_")[1])
+        order_id, = ORDER_DELETE.decode(query.data)
         await self.update_order_status(order_id, "canceled")
+        await self.catalog.reload()
         
-        await query.edit_message_text(
-            f"❌ سفارش #{order_id} با موفقیت لغو شد."
-        )
-        
-        return await self.view_orders(update, context)
+        return await self.show_orders_page(update, context, f"❌ سفارش #{order_id} با موفقیت لغو شد.")
 
     async def support_request(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """درخواست پشتیبانی"""
@@ -2755,90 +5752,58 @@ class ShopBot:
         query = update.callback_query
         await query.answer()
         
-        keyboard = []
-        for product_key, product in self.products.items():
-            # به روزرسانی موجودی محصول
-            product.update_stock()
-            
-            # نمایش موجودی در دکمه
-            stock_indicator = "🟢" if product.stock > 2 else "🟡" if product.stock > 0 else "🔴"
-            keyboard.append([
-                InlineKeyboardButton(
-                    f"{product.name} {stock_indicator}",
-                    callback_data=f"product_{product_key}"
-                )
-            ])
-        
-        keyboard.append([InlineKeyboardButton("🔙 بازگشت", callback_data="back")])
-        
         await query.edit_message_text(
             "🎮 *لیست محصولات*\n\nلطفاً یکی از محصولات زیر را انتخاب کنید:",
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            reply_markup=self.catalog.snapshot.list_keyboard,
             parse_mode='Markdown'
         )
         return SELECTING_ACTION
 
-    async def send_periodic_notifications(self, context: ContextTypes.DEFAULT_TYPE):
-        """ارسال پیام‌های دوره‌ای به کاربران"""
-        max_retries = 3
-        retry_count = 0
+    @staticmethod
+    def next_daily_notification() -> float:
+        """زمان ارسال اطلاعیه روزانه بعدی (ساعت 12 ظهر)"""
+        now = datetime.now()
+        target_time = now.replace(hour=12, minute=0, second=0, microsecond=0)
+        if now >= target_time:
+            target_time += timedelta(days=1)
+        return target_time.timestamp()
+
+    async def send_daily_notification(self) -> float:
+        """ارسال اطلاعیه روزانه به کاربران و بازگرداندن زمان اجرای بعدی"""
+        users = await Database.fetchall(USERS_DB_PATH, "SELECT user_id FROM users")
         
-        while retry_count < max_retries:
-            try:
-                # محاسبه زمان خواب تا ساعت 12 ظهر روز بعد
-                now = datetime.now()
-                target_time = now.replace(hour=12, minute=0, second=0, microsecond=0)
-                if now > target_time:
-                    target_time += timedelta(days=1)
-                
-                sleep_seconds = (target_time - now).total_seconds()
-                await asyncio.sleep(sleep_seconds)
-                
-                # ارسال پیام به تمام کاربران
-                async with aiosqlite.connect(USERS_DB_PATH) as db:
-                    cursor = await db.execute("SELECT user_id FROM users")
-                    users = await cursor.fetchall()
-                    
-                    tasks = []
-                    for (user_id,) in users:
-                        try:
-                            # تولید محتوای پیام
-                            online_users = self.stats_generator.get_online_users()
-                            successful_orders = self.stats_generator.get_successful_orders()
-                            
-                            message = (
-                                "📢 *اطلاعیه روزانه RedHotMafia*\n\n"
-                                f"👥 کاربران آنلاین امروز: {online_users} نفر\n"
-                                f"✅ خریدهای موفق: {successful_orders} نفر\n\n"
-                                "🎁 پیشنهاد ویژه امروز:\n"
-                                "با خرید هر دو محصول، 20% تخفیف دریافت کنید!\n\n"
-                                f"📢 کانال ما: {self.channel_username}"
-                            )
-                            
-                            # ارسال پیام
-                            tasks.append(
-                                context.bot.send_message(
-                                    chat_id=user_id,
-                                    text=message,
-                                    parse_mode='Markdown'
-                                )
-                            )
-                        except Exception as e:
-                            logger.error(f"خطا در ارسال پیام به کاربر {user_id}: {e}")
-                    
-                    await asyncio.gather(*tasks, return_exceptions=True)
-                
-                retry_count = 0  # Reset retry count after successful run
-                
-            except Exception as e:
-                logger.error(f"خطا در ارسال پیام‌های دوره‌ای: {e}")
-                retry_count += 1
-                await asyncio.sleep(3600)  # در صورت خطا 1 ساعت صبر کن
+        # تولید محتوای پیام
+        online_users = self.stats_generator.get_online_users()
+        successful_orders = self.stats_generator.get_successful_orders()
+        
+        message = (
+            "📢 *اطلاعیه روزانه RedHotMafia*\n\n"
+            f"👥 کاربران آنلاین امروز: {online_users} نفر\n"
+            f"✅ خریدهای موفق: {successful_orders} نفر\n\n"
+            "🎁 پیشنهاد ویژه امروز:\n"
+            "با خرید هر دو محصول، 20% تخفیف دریافت کنید!\n\n"
+            f"📢 کانال ما: {self.channel_username}"
+        )
+        
+        results = await asyncio.gather(
+            *(
+                self.application.bot.send_message(chat_id=user_id, text=message, parse_mode='Markdown')
+                for (user_id,) in users
+            ),
+            return_exceptions=True
+        )
+        for (user_id,), result in zip(users, results):
+            if isinstance(result, Exception):
+                logger.error(f"خطا در ارسال پیام به کاربر {user_id}: {result}")
+        
+        return self.next_daily_notification()
 
     def setup_handlers(self, application: Application) -> None:
         """تنظیم هندلرهای ربات"""
         # هندلر احراز هویت
         auth_conv = ConversationHandler(
+            name="auth",
+            persistent=True,
             entry_points=[
                 CommandHandler("start", self.handle_referral_start),
                 CallbackQueryHandler(self.login, pattern="^login$"),
@@ -2867,13 +5832,19 @@ class ShopBot:
         
         # هندلر کیف پول
         wallet_conv = ConversationHandler(
+            name="wallet",
+            persistent=True,
             entry_points=[CallbackQueryHandler(self.show_wallet, pattern="^wallet$")],
             states={
                 WALLET_ACTIONS: [
-                    CallbackQueryHandler(self.deposit_btc, pattern="^deposit_btc$"),
-                    CallbackQueryHandler(self.withdraw_btc, pattern="^withdraw_btc$"),
-                    CallbackQueryHandler(self.convert_coins, pattern="^convert_coins$"),
-                    CallbackQueryHandler(self.confirm_convert_coins, pattern="^confirm_convert_"),
+                    CallbackRouter({
+                        "deposit_btc": self.deposit_btc,
+                        "withdraw_btc": self.withdraw_btc,
+                        "convert_coins": self.convert_coins,
+                        CONVERT_COINS: self.confirm_convert_coins,
+                        TRANSACTIONS_PAGE: self.show_transaction_history,
+                        "wallet": self.show_wallet,
+                    }).handler(),
                     MessageHandler(filters.TEXT & ~filters.COMMAND, self.process_withdrawal),
                 ],
             },
@@ -2882,6 +5853,8 @@ class ShopBot:
         
         # هندلر گردونه شانس
         wheel_conv = ConversationHandler(
+            name="wheel",
+            persistent=True,
             entry_points=[CallbackQueryHandler(self.show_wheel_of_fortune, pattern="^wheel_of_fortune$")],
             states={
                 WHEEL_OF_FORTUNE: [
@@ -2893,28 +5866,38 @@ class ShopBot:
         
         # هندلر آواتار
         avatar_conv = ConversationHandler(
+            name="avatar",
+            persistent=True,
             entry_points=[CallbackQueryHandler(self.show_avatar_selection, pattern="^change_avatar$")],
             states={
                 AVATAR_SELECTION: [
-                    CallbackQueryHandler(self.select_avatar, pattern="^select_avatar_"),
-                    CallbackQueryHandler(self.select_avatar, pattern="^locked_avatar$"),
+                    CallbackRouter({
+                        AVATAR_SELECT: self.select_avatar,
+                        "locked_avatar": self.select_avatar,
+                    }).handler(),
                 ],
             },
             fallbacks=[CallbackQueryHandler(self.show_profile, pattern="^profile$")],
         )
         
+        # دکمه‌های مدیریت محصولات در هر دو گفتگو مشترک هستند
+        manage_products_routes = {
+            "add_product": self.add_product,
+            "edit_product": self.edit_product,
+            "remove_product": self.remove_product,
+            PRODUCT_EDIT: self.process_edit_product,
+            PRODUCT_REMOVE: self.process_remove_product,
+        }
+        
         # هندلر مدیریت محصولات
         products_conv = ConversationHandler(
+            name="manage_products",
+            persistent=True,
             entry_points=[CallbackQueryHandler(self.admin_manage_products, pattern="^manage_products$")],
             states={
                 ADMIN_MANAGE_PRODUCTS: [
-                    CallbackQueryHandler(self.add_product, pattern="^add_product$"),
-                    CallbackQueryHandler(self.edit_product, pattern="^edit_product$"),
-                    CallbackQueryHandler(self.remove_product, pattern="^remove_product$"),
-                    CallbackQueryHandler(self.process_edit_product, pattern="^edit_"),
-                    CallbackQueryHandler(self.process_remove_product, pattern="^remove_"),
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, self.process_add_product),
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, self.save_edited_product),
+                    CallbackRouter(manage_products_routes).handler(),
+                    MessageHandler(filters.TEXT & ~filters.COMMAND, self.process_product_text),
                 ],
             },
             fallbacks=[CallbackQueryHandler(self.admin_panel, pattern="^admin$")],
@@ -2922,6 +5905,8 @@ class ShopBot:
         
         # هندلر مدیریت سکه‌ها
         coins_conv = ConversationHandler(
+            name="admin_coins",
+            persistent=True,
             entry_points=[CallbackQueryHandler(self.admin_add_coins_menu, pattern="^admin_add_coins$")],
             states={
                 ADMIN_ADD_COINS: [
@@ -2933,35 +5918,43 @@ class ShopBot:
         
         # هندلر اصلی
         main_conv = ConversationHandler(
+            name="main",
+            persistent=True,
             entry_points=[CommandHandler("start", self.handle_referral_start)],
             states={
                 SELECTING_ACTION: [
-                    CallbackQueryHandler(self.show_products, pattern="^products$"),
-                    CallbackQueryHandler(self.show_product_details, pattern="^product_"),
-                    CallbackQueryHandler(self.payment_instructions, pattern="^pay_"),
-                    CallbackQueryHandler(self.support_request, pattern="^support$"),
-                    CallbackQueryHandler(self.admin_panel, pattern="^admin$"),
-                    CallbackQueryHandler(self.view_user_orders, pattern="^my_orders$"),
-                    CallbackQueryHandler(self.show_wallet, pattern="^wallet$"),
-                    CallbackQueryHandler(self.show_profile, pattern="^profile$"),
-                    CallbackQueryHandler(self.show_referral, pattern="^referral$"),
-                    CallbackQueryHandler(self.help_command, pattern="^help_command$"),
-                    CallbackQueryHandler(self.show_wheel_of_fortune, pattern="^wheel_of_fortune$"),
-                    CallbackQueryHandler(self.show_leaderboard, pattern="^leaderboard$"),
-                    CallbackQueryHandler(self.admin_add_coins_menu, pattern="^admin_add_coins$"),
-                    CallbackQueryHandler(self.admin_manage_products, pattern="^manage_products$"),
+                    CallbackRouter({
+                        "products": self.show_products,
+                        PRODUCT_DETAILS: self.show_product_details,
+                        PRODUCT_PAY: self.payment_instructions,
+                        "support": self.support_request,
+                        "admin": self.admin_panel,
+                        "my_orders": self.view_user_orders,
+                        "wallet": self.show_wallet,
+                        "profile": self.show_profile,
+                        "referral": self.show_referral,
+                        "help_command": self.help_command,
+                        "wheel_of_fortune": self.show_wheel_of_fortune,
+                        "leaderboard": self.show_leaderboard,
+                        "admin_add_coins": self.admin_add_coins_menu,
+                        "manage_products": self.admin_manage_products,
+                    }).handler(),
                 ],
                 CONFIRM_PAYMENT: [
                     MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_tx_hash),
                 ],
                 ADMIN_ACTIONS: [
-                    CallbackQueryHandler(self.view_orders, pattern="^view_orders$"),
-                    CallbackQueryHandler(self.view_stats, pattern="^view_stats$"),
-                    CallbackQueryHandler(self.confirm_order, pattern="^confirm_"),
-                    CallbackQueryHandler(self.delete_order, pattern="^delete_"),
-                    CallbackQueryHandler(self.show_main_menu, pattern="^back$"),
-                    CallbackQueryHandler(self.admin_add_coins_menu, pattern="^admin_add_coins$"),
-                    CallbackQueryHandler(self.admin_manage_products, pattern="^manage_products$"),
+                    CallbackRouter({
+                        "view_orders": self.view_orders,
+                        ORDERS_FILTER: self.view_orders,
+                        ORDERS_PAGE: self.view_orders,
+                        "view_stats": self.view_stats,
+                        ORDER_CONFIRM: self.confirm_order,
+                        ORDER_DELETE: self.delete_order,
+                        "back": self.show_main_menu,
+                        "admin_add_coins": self.admin_add_coins_menu,
+                        "manage_products": self.admin_manage_products,
+                    }).handler(),
                 ],
                 SUPPORT_CHAT: [
                     MessageHandler(filters.TEXT & ~filters.COMMAND, self.forward_to_support)
@@ -2977,14 +5970,8 @@ class ShopBot:
                     CallbackQueryHandler(self.admin_panel, pattern="^admin$"),
                 ],
                 ADMIN_MANAGE_PRODUCTS: [
-                    CallbackQueryHandler(self.add_product, pattern="^add_product$"),
-                    CallbackQueryHandler(self.edit_product, pattern="^edit_product$"),
-                    CallbackQueryHandler(self.remove_product, pattern="^remove_product$"),
-                    CallbackQueryHandler(self.process_edit_product, pattern="^edit_"),
-                    CallbackQueryHandler(self.process_remove_product, pattern="^remove_"),
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, self.process_add_product),
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, self.save_edited_product),
-                    CallbackQueryHandler(self.admin_panel, pattern="^admin$"),
+                    CallbackRouter({**manage_products_routes, "admin": self.admin_panel}).handler(),
+                    MessageHandler(filters.TEXT & ~filters.COMMAND, self.process_product_text),
                 ],
             },
             fallbacks=[CommandHandler("cancel", self.cancel)],
@@ -3009,13 +5996,110 @@ class ShopBot:
             CommandHandler("add_coins", self.admin_add_coins_menu, filters.User(self.admin_id))
         )
 
-    async def run(self) -> None:
+    async def post_init(self, application: Application) -> None:
+        """آماده‌سازی دیتابیس روی حلقه رویداد برنامه"""
+        # استخرهای اتصال به حلقه رویدادی که ربات روی آن اجرا می‌شود وابسته‌اند
+        await self.init_db()
+        await self.scheduler.init_db()
+        await self.scheduler.schedule(
+            "daily_notification", self.next_daily_notification(), dedup_key="daily_notification"
+        )
+        await self.scheduler.schedule("verify_payments", time.time(), dedup_key="verify_payments")
+        await self.scheduler.schedule("restock_products", time.time(), dedup_key="restock_products")
+        await self.scheduler.schedule("release_reservations", time.time(), dedup_key="release_reservations")
+        await coin_ranking.load()
+        await leaderboard_snapshot.refresh()
+        self.render_service.start()
+        await self.warm_static_cards()
+        self.run_in_background(self.compact_coin_ledger_periodically())
+        self.run_in_background(self.reconcile_wallets_periodically())
+        self.run_in_background(self.refresh_leaderboard_periodically())
+        self.run_in_background(self.scheduler.run())
+        self.run_in_background(self.evict_idle_user_data_periodically())
+
+    async def reconcile_wallets_periodically(self) -> None:
+        """بازسازی دوره‌ای موجودی کیف پول‌ها از روی تراکنش‌ها"""
+        while True:
+            try:
+                mismatches = await self.wallet_manager.reconcile()
+                if mismatches:
+                    await self.send_to_admin(
+                        self.application,
+                        f"⚠️ مغایرت در {len(mismatches)} کیف پول پیدا و اصلاح شد."
+                    )
+            except Exception as e:
+                logger.error(f"خطا در تطبیق کیف پول‌ها: {e}")
+            await asyncio.sleep(WALLET_RECONCILE_INTERVAL)
+
+    async def refresh_leaderboard_periodically(self) -> None:
+        """بازسازی دوره‌ای نمای جدول رتبه‌بندی"""
+        while True:
+            await asyncio.sleep(LEADERBOARD_REFRESH_INTERVAL)
+            try:
+                await leaderboard_snapshot.refresh()
+            except Exception as e:
+                logger.error(f"خطا در به‌روزرسانی جدول رتبه‌بندی: {e}")
+
+    async def evict_idle_user_data_periodically(self) -> None:
+        """خارج کردن دوره‌ای داده کاربران غیرفعال از حافظه"""
+        while True:
+            await asyncio.sleep(USER_DATA_EVICT_INTERVAL)
+            try:
+                evicted = await self.application.persistence.evict_idle(
+                    self.application, self.application.update_processor.is_busy
+                )
+                if evicted:
+                    logger.info(f"داده {evicted} کاربر غیرفعال از حافظه خارج شد")
+            except Exception as e:
+                logger.error(f"خطا در خارج کردن داده کاربران غیرفعال: {e}")
+
+    async def compact_coin_ledger_periodically(self) -> None:
+        """فشرده‌سازی دوره‌ای رویدادهای قدیمی دفتر سکه‌ها"""
+        while True:
+            await asyncio.sleep(COIN_LEDGER_COMPACT_INTERVAL)
+            try:
+                removed = await CoinLedger.compact()
+                if removed:
+                    logger.info(f"{removed} رویداد قدیمی دفتر سکه‌ها فشرده شد")
+            except Exception as e:
+                logger.error(f"خطا در فشرده‌سازی دفتر سکه‌ها: {e}")
+
+    async def warm_static_cards(self) -> None:
+        """رندر کارت‌های ثابت (گردونه و انیمیشن چرخش) هنگام راه‌اندازی"""
+        try:
+            await asyncio.gather(
+                self.render_service.render_card(await self.generate_wheel_card()),
+                self.render_service.render_card(await self.generate_wheel_spin_card()),
+            )
+        except Exception as e:
+            logger.error(f"خطا در آماده‌سازی کارت‌های ثابت: {e}")
+
+    async def post_shutdown(self, application: Application) -> None:
+        """آزادسازی منابع هنگام خاموش شدن ربات"""
+        for task in list(self.background_tasks):
+            task.cancel()
+        await coin_ledger.close()
+        await self.payment_verifier.backend.close()
+        self.render_service.shutdown()
+        await Database.close_all()
+
+    def run(self) -> None:
         """اجرای ربات"""
         try:
-            await self.init_db()
-            
-            application = Application.builder().token(self.bot_token).build()
+            update_processor = PerUserUpdateProcessor()
+            persistence = SQLitePersistence()
+            update_processor.prepare = persistence.load_conversations
+            application = (
+                Application.builder()
+                .token(self.bot_token)
+                .concurrent_updates(update_processor)
+                .persistence(persistence)
+                .post_init(self.post_init)
+                .post_shutdown(self.post_shutdown)
+                .build()
+            )
             self.setup_handlers(application)
+            persistence.attach(application)
             self.application = application  # برای دسترسی در متدهای دیگر
 
             logger.info("""
@@ -3028,14 +6112,12 @@ class ShopBot:
             """)
             logger.info("ربات فروشگاه RedHotMafia با موفقیت راه‌اندازی شد!")
 
-            await application.run_polling(drop_pending_updates=True)
+            application.run_polling(drop_pending_updates=True)
 
         except Exception as e:
             logger.critical(f"خطا در راه‌اندازی ربات: {e}", exc_info=True)
-            if self.daily_notification_task:
-                self.daily_notification_task.cancel()
 
 
 if __name__ == "__main__":
     bot = ShopBot()
-    asyncio.run(bot.run())
+    bot.run()
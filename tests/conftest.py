@@ -0,0 +1,30 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import shopbot  # noqa: E402
+
+
+@pytest.fixture
+def run(tmp_path, monkeypatch):
+    """اجرای کوروتین در پوشه موقت؛ دفتر سکه و استخرها روی همان حلقه بسته می‌شوند"""
+    monkeypatch.chdir(tmp_path)
+
+    def runner(coro):
+        async def wrapped():
+            try:
+                return await coro
+            finally:
+                await shopbot.coin_ledger.close()
+                await shopbot.Database.close_all()
+        return asyncio.run(wrapped())
+    return runner
+
+
+@pytest.fixture
+def bot():
+    return shopbot.ShopBot()
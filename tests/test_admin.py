@@ -0,0 +1,87 @@
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+from telegram import Chat, Message, Update, User
+from telegram.ext import Application, ConversationHandler
+
+import shopbot as sb
+
+
+class FakeQuery:
+    def __init__(self, data):
+        self.data = data
+        self.edits = []
+
+    async def answer(self):
+        pass
+
+    async def edit_message_text(self, text, **kwargs):
+        self.edits.append(text)
+
+
+@pytest.mark.parametrize("handler, callback", [
+    ("process_edit_product", sb.PRODUCT_EDIT),
+    ("process_remove_product", sb.PRODUCT_REMOVE),
+])
+def test_stale_product_button_reports_not_found(run, bot, handler, callback):
+    query = FakeQuery(callback.encode("deleted"))
+    update = SimpleNamespace(callback_query=query, effective_user=SimpleNamespace(id=bot.admin_id))
+
+    async def scenario():
+        await bot.init_db()
+        return await getattr(bot, handler)(update, SimpleNamespace(user_data={}))
+
+    assert run(scenario()) == sb.ADMIN_ACTIONS
+    assert "یافت نشد" in query.edits[0]
+
+
+class FakeMessage:
+    def __init__(self, text):
+        self.text = text
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+def text_handler(bot, state):
+    """اجرا کننده‌ای که گفتگوی مدیریت محصولات برای یک پیام متنی انتخاب می‌کند"""
+    application = Application.builder().token("123:abc").persistence(sb.SQLitePersistence()).build()
+    bot.setup_handlers(application)
+    update = Update(1, message=Message(1, datetime.now(), Chat(1, "private"), from_user=User(1, "u", False), text="x"))
+    conversations = [h for h in application.handlers[0] if isinstance(h, ConversationHandler)]
+    matches = []
+    for conversation in conversations:
+        for handler in conversation.states.get(state, []):
+            if handler.check_update(update) not in (None, False):
+                matches.append(handler.callback)
+                break
+    return matches
+
+
+@pytest.mark.filterwarnings("ignore:If 'per_message=False'")
+def test_edit_product_end_to_end(run, bot):
+    callbacks = text_handler(bot, sb.ADMIN_MANAGE_PRODUCTS)
+    assert callbacks and all(callback == bot.process_product_text for callback in callbacks)
+
+    async def scenario():
+        await bot.init_db()
+        key = next(iter(bot.products))
+        context = SimpleNamespace(user_data={})
+        admin = SimpleNamespace(id=bot.admin_id)
+        query = FakeQuery(sb.PRODUCT_EDIT.encode(key))
+        await bot.process_edit_product(SimpleNamespace(callback_query=query, effective_user=admin), context)
+
+        message = FakeMessage("نام جدید\n0.0002 BTC\nتوضیح\n- الف - ب\naddr\n3")
+        state = await callbacks[0](SimpleNamespace(message=message, effective_user=admin), context)
+        row = await sb.Database.fetchone(sb.DB_PATH, "SELECT name, price, stock FROM products WHERE key = ?", (key,))
+        count = await sb.Database.fetchone(sb.DB_PATH, "SELECT COUNT(*) FROM products")
+        return state, row, count[0], len(bot.products), bot.products[key].name, context.user_data
+
+    state, row, stored, loaded, name, user_data = run(scenario())
+    assert state == sb.ADMIN_ACTIONS
+    assert row == ("نام جدید", "0.0002 BTC", 3)
+    assert stored == loaded
+    assert name == "نام جدید"
+    assert user_data == {}
@@ -0,0 +1,90 @@
+from types import SimpleNamespace
+
+import httpx
+
+import shopbot as sb
+
+
+class FakeBot:
+    def __init__(self):
+        self.messages = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.messages.append((chat_id, text))
+
+
+def test_esplora_without_tip_height_reports_unknown(run):
+    def handler(request):
+        return httpx.Response(404)
+
+    async def scenario():
+        backend = sb.EsploraBackend("http://esplora.test")
+        backend._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        try:
+            return await backend.get_transactions(["a", "b"])
+        finally:
+            await backend.close()
+
+    assert run(scenario()) == {"a": None, "b": None}
+
+
+def test_failed_license_delivery_does_not_abort_batch(run, bot, monkeypatch):
+    delivered = []
+
+    async def send_license(context, user_id, license_code):
+        if user_id == 1:
+            raise RuntimeError("blocked by user")
+        delivered.append(user_id)
+
+    monkeypatch.setattr(bot, "send_license", send_license)
+    monkeypatch.setattr(sb.PaymentVerifier, "check", staticmethod(lambda tx, address, amount: "confirmed"))
+    bot.application = SimpleNamespace(bot=FakeBot())
+
+    async def lookup(tx_hashes):
+        return dict.fromkeys(tx_hashes)
+
+    monkeypatch.setattr(bot.payment_verifier, "lookup", lookup)
+
+    async def scenario():
+        await bot.init_db()
+        for order_id in (1, 2):
+            await sb.Database.execute(
+                sb.DB_PATH,
+                "INSERT INTO orders (id, user_id, full_name, product, price, tracking_code, tx_hash, btc_address) "
+                "VALUES (?, ?, 'u', 'p', '1', ?, ?, 'addr')",
+                (order_id, order_id, f"T{order_id}", f"tx{order_id}")
+            )
+        await bot.verify_payments()
+        return await sb.Database.fetchall(sb.DB_PATH, "SELECT id, status FROM orders ORDER BY id")
+
+    orders = run(scenario())
+    assert orders == [(1, "completed"), (2, "completed")]
+    assert delivered == [2]
+    assert any(chat_id == bot.admin_id and "#1" in text for chat_id, text in bot.application.bot.messages)
+
+
+def test_orders_without_amount_or_address_go_to_manual_review(run, bot, monkeypatch):
+    bot.application = SimpleNamespace(bot=FakeBot())
+
+    async def lookup(tx_hashes):
+        # تراکنش تأیید شده‌ای که هیچ مبلغی به آدرس فروشگاه نپرداخته است
+        return {tx_hash: {"confirmations": 10, "outputs": {}} for tx_hash in tx_hashes}
+
+    monkeypatch.setattr(bot.payment_verifier, "lookup", lookup)
+
+    async def scenario():
+        await bot.init_db()
+        for order_id, address, amount_sats in ((1, "addr", None), (2, "addr", 0), (3, None, 1000)):
+            await sb.Database.execute(
+                sb.DB_PATH,
+                "INSERT INTO orders (id, user_id, full_name, product, price, tracking_code, tx_hash, "
+                "btc_address, amount_sats) VALUES (?, 1, 'u', 'p', '1', ?, ?, ?, ?)",
+                (order_id, f"T{order_id}", f"tx{order_id}", address, amount_sats)
+            )
+        await bot.verify_payments()
+        await bot.verify_payments()
+        return await sb.Database.fetchall(sb.DB_PATH, "SELECT id, status FROM orders ORDER BY id")
+
+    assert run(scenario()) == [(1, "review"), (2, "review"), (3, "review")]
+    admin_messages = [text for chat_id, text in bot.application.bot.messages if chat_id == bot.admin_id]
+    assert len(admin_messages) == 3
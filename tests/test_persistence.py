@@ -0,0 +1,142 @@
+from datetime import datetime
+
+import pytest
+import telegram
+from telegram import Chat, Message, Update, User
+from telegram.ext import Application, ConversationHandler, MessageHandler, filters
+
+import shopbot as sb
+
+
+def message(user_id, update_id, text):
+    chat = Chat(user_id, "private")
+    return Update(update_id, message=Message(update_id, datetime.now(), chat, from_user=User(user_id, "u", False), text=text))
+
+
+def build(seen, per_user=True):
+    async def start(update, context):
+        context.user_data["selected_product"] = "mafia"
+        return 1
+
+    async def email(update, context):
+        seen.append((update.effective_user.id, "email"))
+        return 2
+
+    async def finish(update, context):
+        seen.append((update.effective_user.id, "finish"))
+        return ConversationHandler.END
+
+    # همان اتصال‌های ShopBot.run
+    processor = sb.PerUserUpdateProcessor()
+    persistence = sb.SQLitePersistence()
+    processor.prepare = persistence.load_conversations
+    application = Application.builder().token("123:abc").concurrent_updates(processor).persistence(persistence).build()
+    persistence.attach(application)
+    application.bot._initialized = True  # بدون درخواست get_me به تلگرام
+    text = filters.TEXT & ~filters.Regex("^/")
+    application.add_handler(ConversationHandler(
+        name="test", persistent=True, per_user=per_user,
+        entry_points=[MessageHandler(filters.Regex("^/start"), start)],
+        states={1: [MessageHandler(text, email)], 2: [MessageHandler(text, finish)]},
+        fallbacks=[],
+    ))
+    return application
+
+
+async def send(application, update):
+    await application.update_processor.process_update(update, application.process_update(update))
+
+
+def conversations(application):
+    return application._conversation_handler_conversations["test"]
+
+
+async def stored(user_id):
+    return await sb.Database.fetchall(
+        sb.USERS_DB_PATH, "SELECT key, state FROM conversation_state WHERE user_id = ?", (user_id,)
+    )
+
+
+def test_conversations_load_lazily_after_restart(run):
+    seen = []
+
+    async def scenario():
+        application = build(seen)
+        await application.initialize()
+        await send(application, message(7, 1, "/start"))
+        await application.update_persistence()
+        await application.shutdown()
+
+        application = build(seen)
+        await application.initialize()
+        loaded_at_start = dict(conversations(application))
+        await send(application, message(7, 2, "a@b.c"))
+        await application.shutdown()
+        return loaded_at_start
+
+    assert run(scenario()) == {}
+    assert seen == [(7, "email")]
+
+
+def test_idle_conversations_leave_memory_and_come_back(run, monkeypatch):
+    seen = []
+
+    async def scenario():
+        application = build(seen)
+        await application.initialize()
+        for user_id in (8, 9):
+            await send(application, message(user_id, user_id, "/start"))
+        await application.update_persistence()
+
+        monkeypatch.setattr(sb, "USER_DATA_IDLE_TTL", -1)
+        await application.persistence.evict_idle(application, application.update_processor.is_busy)
+        in_memory = dict(conversations(application))
+        rows = await stored(8)
+
+        await send(application, message(8, 10, "a@b.c"))
+        await send(application, message(8, 11, "done"))
+        await application.update_persistence()
+        ended = (dict(conversations(application)), await stored(8), await stored(9))
+        await application.shutdown()
+        return in_memory, rows, ended
+
+    in_memory, rows, (after_end, rows_8, rows_9) = run(scenario())
+    assert in_memory == {}
+    assert rows == [("[8, 8]", 1)]
+    assert seen == [(8, "email"), (8, "finish")]
+    assert after_end == {} and rows_8 == []
+    assert rows_9 == [("[9, 9]", 1)]
+
+
+def test_conversations_without_user_in_key_load_eagerly(run, monkeypatch):
+    seen = []
+
+    async def scenario():
+        application = build(seen, per_user=False)
+        await application.initialize()
+        await send(application, message(7, 1, "/start"))
+        await application.update_persistence()
+        stored_user = await sb.Database.fetchall(sb.USERS_DB_PATH, "SELECT key, user_id FROM conversation_state")
+        await application.shutdown()
+
+        application = build(seen, per_user=False)
+        await application.initialize()
+        loaded_at_start = dict(conversations(application))
+        monkeypatch.setattr(sb, "USER_DATA_IDLE_TTL", -1)
+        await send(application, message(7, 2, "a@b.c"))
+        await application.persistence.evict_idle(application, application.update_processor.is_busy)
+        after_evict = dict(conversations(application))
+        await application.shutdown()
+        return stored_user, loaded_at_start, after_evict
+
+    stored_user, loaded_at_start, after_evict = run(scenario())
+    assert stored_user == [("[7]", None)]
+    assert loaded_at_start == {(7,): 1}
+    assert after_evict == {(7,): 2}
+    assert seen == [(7, "email")]
+
+
+def test_attach_rejects_unsupported_telegram_version(monkeypatch):
+    monkeypatch.setattr(telegram, "__version_info__", (23, 0, 0, "final", 0))
+    with pytest.raises(RuntimeError):
+        sb.SQLitePersistence().attach(Application.builder().token("123:abc").build())
@@ -0,0 +1,36 @@
+import shopbot as sb
+
+
+def test_update_keeps_order_consistent():
+    ranking = sb.CoinRanking()
+    for user_id, coins in [(1, 50), (2, 30), (3, 30), (4, 10)]:
+        ranking.update(user_id, coins)
+    ranking.update(2, 60)
+    ranking.update(4, 0)
+    assert ranking.top(5) == [(2, 60), (1, 50), (3, 30)]
+    assert ranking.rank(3) == 3
+
+
+def test_update_out_of_sync_entry_does_not_remove_other_users():
+    ranking = sb.CoinRanking()
+    for user_id, coins in [(1, 50), (2, 40), (3, 30)]:
+        ranking.update(user_id, coins)
+    # موجودی درون‌حافظه‌ای کاربر ۲ با فهرست مرتب ناهماهنگ شده است
+    ranking._coins[2] = 35
+    ranking.update(2, 20)
+    assert ranking.top(5) == [(1, 50), (3, 30), (2, 20)]
+    assert len(ranking) == 3
+
+
+def test_init_drops_fake_leaderboard_table(run):
+    async def scenario():
+        await sb.Database.execute(
+            sb.COINS_DB_PATH, "CREATE TABLE leaderboard (id INTEGER PRIMARY KEY, username TEXT, coins INTEGER)"
+        )
+        await sb.CoinManager.init_db()
+        await sb.CoinManager.init_db()
+        return await sb.Database.fetchone(
+            sb.COINS_DB_PATH, "SELECT COUNT(*) FROM sqlite_master WHERE name = 'leaderboard'"
+        )
+
+    assert run(scenario()) == (0,)
@@ -0,0 +1,44 @@
+import shopbot as sb
+
+
+async def _register(*user_ids):
+    async with sb.Database.transaction(sb.USERS_DB_PATH) as db:
+        await db.executemany(
+            "INSERT INTO users (user_id, email, password) VALUES (?, ?, 'x')",
+            [(user_id, f"{user_id}@example.com") for user_id in user_ids]
+        )
+
+
+def test_failed_bonus_deposit_rolls_back_referral(run, bot, monkeypatch):
+    monkeypatch.setattr(sb.ReferralSystem, "REQUIRED_REFERRALS", 1)
+
+    async def failing_deposit(user_id, amount):
+        return False
+    monkeypatch.setattr(sb.WalletManager, "deposit", staticmethod(failing_deposit))
+
+    async def scenario():
+        await bot.init_db()
+        await _register(1, 2)
+        added = await sb.ReferralSystem.add_referral(1, 2)
+        referrals = await sb.Database.fetchone(sb.USERS_DB_PATH, "SELECT COUNT(*) FROM referrals")
+        return added, referrals[0], await sb.CoinManager.get_coins(1)
+
+    added, referrals, coins = run(scenario())
+    assert added is False
+    assert referrals == 0
+    assert coins == 0
+
+
+def test_referral_pays_bonus(run, bot, monkeypatch):
+    monkeypatch.setattr(sb.ReferralSystem, "REQUIRED_REFERRALS", 1)
+
+    async def scenario():
+        await bot.init_db()
+        await _register(1, 2)
+        added = await sb.ReferralSystem.add_referral(1, 2)
+        return added, await sb.WalletManager.get_balance(1), await sb.CoinManager.get_coins(1)
+
+    added, balance, coins = run(scenario())
+    assert added is True
+    assert balance == sb.ReferralSystem.REFERRAL_BONUS
+    assert coins == 10
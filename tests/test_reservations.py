@@ -0,0 +1,56 @@
+import asyncio
+
+import shopbot as sb
+
+
+async def stock(key):
+    row = await sb.Database.fetchone(sb.DB_PATH, "SELECT stock FROM products WHERE key = ?", (key,))
+    return row[0]
+
+
+async def expire_holds(bot):
+    await sb.Database.execute(sb.DB_PATH, "UPDATE stock_reservations SET expires_at = 0 WHERE status = 'held'")
+    await bot.catalog.sweep()
+
+
+def product(units):
+    return sb.Product("p", "0.001 BTC", "d", [], "addr", units, key="p")
+
+
+def test_concurrent_reserves_of_last_unit(run, bot):
+    async def scenario():
+        await bot.init_db()
+        await bot.catalog.save(product(1))
+        results = await asyncio.gather(*(bot.catalog.reserve("p", user_id) for user_id in range(500)))
+        return sum(1 for result in results if result), await stock("p"), bot.products["p"].stock
+
+    assert run(scenario()) == (1, 0, 0)
+
+
+def test_restock_during_holds_does_not_exceed_daily_stock(run, bot):
+    async def scenario():
+        await bot.init_db()
+        await bot.catalog.save(product(sb.PRODUCT_DAILY_STOCK))
+        await asyncio.gather(*(bot.catalog.reserve("p", user_id) for user_id in range(2)))
+        await sb.Database.execute(
+            sb.DB_PATH, "UPDATE products SET last_restock = datetime('now', '-2 days') WHERE key = 'p'"
+        )
+        await bot.catalog.restock()
+        restocked = await stock("p")
+        await expire_holds(bot)
+        return restocked, await stock("p")
+
+    assert run(scenario()) == (sb.PRODUCT_DAILY_STOCK - 2, sb.PRODUCT_DAILY_STOCK)
+
+
+def test_admin_save_counts_held_units(run, bot):
+    async def scenario():
+        await bot.init_db()
+        await bot.catalog.save(product(5))
+        await asyncio.gather(*(bot.catalog.reserve("p", user_id) for user_id in range(3)))
+        await bot.catalog.save(product(4))
+        saved = await stock("p")
+        await expire_holds(bot)
+        return saved, await stock("p")
+
+    assert run(scenario()) == (1, 4)
@@ -0,0 +1,146 @@
+import asyncio
+import time
+
+import shopbot as sb
+
+
+async def make_due():
+    await sb.Database.execute(sb.STATS_DB_PATH, "UPDATE scheduled_jobs SET run_at = 0 WHERE status = 'pending'")
+
+
+async def job_row(key):
+    return await sb.Database.fetchone(
+        sb.STATS_DB_PATH, "SELECT status, attempts, run_at FROM scheduled_jobs WHERE dedup_key = ?", (key,)
+    )
+
+
+def test_recurring_job_survives_failures_and_restart(run):
+    calls = []
+
+    async def flaky():
+        calls.append(1)
+        if len(calls) <= sb.SCHEDULER_MAX_ATTEMPTS:
+            raise RuntimeError("boom")
+        return time.time() + 3600
+
+    async def scenario():
+        scheduler = sb.JobScheduler()
+        scheduler.register("flaky", flaky, recurring=True)
+        await scheduler.init_db()
+        await scheduler.schedule("flaky", time.time(), dedup_key="flaky")
+        for _ in range(sb.SCHEDULER_MAX_ATTEMPTS):
+            await make_due()
+            await scheduler._run_due()
+        after_failures = await job_row("flaky")
+
+        # راه‌اندازی مجدد: کار همچنان در صف است و این بار موفق می‌شود
+        restarted = sb.JobScheduler()
+        restarted.register("flaky", flaky, recurring=True)
+        await restarted.init_db()
+        await restarted.schedule("flaky", time.time(), dedup_key="flaky")
+        await make_due()
+        await restarted._run_due()
+        return after_failures, await job_row("flaky")
+
+    started = time.time()
+    (status, attempts, run_at), after_restart = run(scenario())
+    assert status == "pending"
+    assert attempts == sb.SCHEDULER_MAX_ATTEMPTS
+    assert run_at <= started + sb.SCHEDULER_MAX_BACKOFF + 60
+    assert after_restart[:2] == ("pending", 0)
+    assert len(calls) == sb.SCHEDULER_MAX_ATTEMPTS + 1
+
+
+def test_schedule_revives_failed_job(run):
+    async def scenario():
+        scheduler = sb.JobScheduler()
+        await scheduler.init_db()
+        await sb.Database.execute(
+            sb.STATS_DB_PATH,
+            "INSERT INTO scheduled_jobs (kind, run_at, status, dedup_key, attempts) "
+            "VALUES ('verify_payments', ?, 'failed', 'verify_payments', 5)",
+            (time.time(),)
+        )
+        revived = await scheduler.schedule("verify_payments", 123.0, dedup_key="verify_payments")
+        duplicate = await scheduler.schedule("verify_payments", 456.0, dedup_key="verify_payments")
+        return revived, duplicate, await job_row("verify_payments")
+
+    revived, duplicate, row = run(scenario())
+    assert revived and not duplicate
+    assert row == ("pending", 0, 123.0)
+
+
+def test_one_off_job_still_fails_after_max_attempts(run):
+    async def broken():
+        raise RuntimeError("boom")
+
+    async def scenario():
+        scheduler = sb.JobScheduler()
+        scheduler.register("broken", broken)
+        await scheduler.init_db()
+        await scheduler.schedule("broken", time.time(), dedup_key="broken")
+        for _ in range(sb.SCHEDULER_MAX_ATTEMPTS):
+            await make_due()
+            await scheduler._run_due()
+        return await job_row("broken")
+
+    assert run(scenario())[:2] == ("failed", sb.SCHEDULER_MAX_ATTEMPTS)
+
+
+def test_job_scheduled_after_reading_next_run_is_not_lost(run, monkeypatch):
+    ran = asyncio.Event()
+
+    async def quick():
+        ran.set()
+
+    async def scenario():
+        scheduler = sb.JobScheduler()
+        scheduler.register("quick", quick)
+        await scheduler.init_db()
+        fetchone = sb.Database.fetchone
+
+        # زمان‌بندی یک کار درست بعد از خواندن موعد بعدی در حلقه
+        async def fetchone_then_schedule(path, sql, *args):
+            row = await fetchone(path, sql, *args)
+            if "MIN(run_at)" in sql and not ran.is_set():
+                monkeypatch.setattr(sb.Database, "fetchone", fetchone)
+                await scheduler.schedule("quick", time.time(), dedup_key="quick")
+            return row
+
+        monkeypatch.setattr(sb.Database, "fetchone", fetchone_then_schedule)
+        loop = asyncio.create_task(scheduler.run())
+        try:
+            await asyncio.wait_for(ran.wait(), timeout=2)
+        finally:
+            loop.cancel()
+        return ran.is_set()
+
+    assert run(scenario())
+
+
+def test_slow_job_does_not_hold_the_batch(run, monkeypatch):
+    monkeypatch.setattr(sb, "SCHEDULER_JOB_BUDGET", 0.05)
+    release = asyncio.Event()
+
+    async def slow():
+        await release.wait()
+
+    async def quick():
+        pass
+
+    async def scenario():
+        scheduler = sb.JobScheduler()
+        scheduler.register("slow", slow)
+        scheduler.register("quick", quick)
+        await scheduler.init_db()
+        await scheduler.schedule("slow", time.time(), dedup_key="slow")
+        await scheduler.schedule("quick", time.time(), dedup_key="quick")
+        await asyncio.wait_for(scheduler._run_due(), timeout=1)
+        during = (await job_row("slow"))[0], (await job_row("quick"))[0]
+        release.set()
+        await asyncio.gather(*scheduler._detached)
+        return during, (await job_row("slow"))[0]
+
+    during, after = run(scenario())
+    assert during == ("running", "done")
+    assert after == "done"
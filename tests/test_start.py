@@ -0,0 +1,54 @@
+from types import SimpleNamespace
+
+import shopbot as sb
+
+
+class FakeMessage:
+    def __init__(self):
+        self.replies = []
+        self.photos = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+    async def reply_photo(self, photo, caption=None, **kwargs):
+        self.photos.append(caption)
+        return SimpleNamespace(photo=[SimpleNamespace(file_id="f")])
+
+
+def make_update(user_id):
+    return SimpleNamespace(
+        effective_user=SimpleNamespace(id=user_id, full_name="u"),
+        message=FakeMessage(),
+    )
+
+
+def test_start_uses_snapshot_and_records_latency(run, bot):
+    async def scenario():
+        await bot.init_db()
+        await sb.Database.execute(
+            sb.USERS_DB_PATH, "INSERT INTO users (user_id, email, password) VALUES (1, 'a@b.c', 'x')"
+        )
+        update = make_update(1)
+        state = await bot.handle_referral_start(update, SimpleNamespace(args=[], user_data={}))
+        return state, update.message, bot.start_latency.get_stats()
+
+    state, message, latency = run(scenario())
+    assert state == sb.SELECTING_ACTION
+    assert "ثبت‌نام کرده‌اید" in message.replies[0]
+    assert len(message.photos) == 1 and "خوش آمدید" in message.photos[0]
+    assert latency["count"] == 1
+
+
+def test_snapshot_reports_registration(run):
+    async def scenario():
+        await sb.ShopBot().init_db()
+        before = await sb.ProfileManager.get_snapshot(2)
+        await sb.Database.execute(
+            sb.USERS_DB_PATH, "INSERT INTO users (user_id, email, password) VALUES (2, 'b@b.c', 'x')"
+        )
+        sb.profile_cache.invalidate(2)
+        after = await sb.ProfileManager.get_snapshot(2)
+        return before["registered"], after["registered"]
+
+    assert run(scenario()) == (False, True)
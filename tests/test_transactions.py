@@ -0,0 +1,35 @@
+from types import SimpleNamespace
+
+import shopbot as sb
+
+
+class FakeQuery:
+    def __init__(self, data):
+        self.data = data
+        self.message = SimpleNamespace(photo=None)
+        self.edits = []
+
+    async def answer(self):
+        pass
+
+    async def edit_message_text(self, text, reply_markup=None, **kwargs):
+        self.edits.append((text, reply_markup))
+
+
+def test_stale_page_button_falls_back_to_first_page(run, bot):
+    async def scenario():
+        await bot.init_db()
+        await sb.WalletManager.deposit(1, 0.001)
+        pages = []
+        for data in (sb.TRANSACTIONS_PAGE.encode("older", 1), sb.TRANSACTIONS_PAGE.encode("newer", 10 ** 6)):
+            query = FakeQuery(data)
+            update = SimpleNamespace(callback_query=query, effective_user=SimpleNamespace(id=1))
+            state = await bot.show_transaction_history(update, SimpleNamespace(user_data={}))
+            pages.append((state, query.edits[0]))
+        return pages
+
+    for state, (text, markup) in run(scenario()):
+        assert state == sb.WALLET_ACTIONS
+        assert "BTC" in text
+        # فقط دکمه بازگشت؛ صفحه اول تنها یک تراکنش دارد
+        assert [[button.callback_data for button in row] for row in markup.inline_keyboard] == [["wallet"]]
@@ -0,0 +1,51 @@
+import asyncio
+
+import pytest
+
+import shopbot as sb
+
+ADDRESS = "1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa"
+
+
+@pytest.mark.parametrize("mode", ["single", "split"])
+def test_concurrent_withdrawals_never_overdraw(run, bot, monkeypatch, mode):
+    monkeypatch.setattr(sb, "STORAGE_MODE", mode)
+
+    async def scenario():
+        await bot.init_db()
+        await sb.WalletManager.deposit(1, 0.01)
+        results = await asyncio.gather(
+            *(sb.WalletManager.withdraw(1, 0.0005, ADDRESS) for _ in range(3000))
+        )
+        balance = await sb.Database.fetchone(
+            sb.WALLET_DB_PATH, "SELECT balance_sats FROM wallets WHERE user_id = 1"
+        )
+        return sum(results), balance[0], await sb.WalletManager.reconcile()
+
+    succeeded, balance_sats, drift = run(scenario())
+    assert succeeded == 20
+    assert balance_sats == 0
+    assert drift == []
+
+
+def test_reconcile_repairs_drift_without_touching_concurrent_writes(run, bot):
+    async def scenario():
+        await bot.init_db()
+        for user_id in range(1, 51):
+            await sb.WalletManager.deposit(user_id, 0.001)
+        await sb.Database.execute(
+            sb.WALLET_DB_PATH, "UPDATE wallets SET balance_sats = 1 WHERE user_id IN (3, 7)"
+        )
+
+        # واریزهای همزمان با تطبیق نباید به عنوان مغایرت دیده یا بازنویسی شوند
+        deposits = asyncio.gather(*(sb.WalletManager.deposit(user_id, 0.0001) for user_id in range(1, 51)))
+        repaired, _ = await asyncio.gather(sb.WalletManager.reconcile(), deposits)
+        balances = await sb.Database.fetchall(
+            sb.WALLET_DB_PATH, "SELECT user_id, balance_sats FROM wallets ORDER BY user_id"
+        )
+        return repaired, balances, await sb.WalletManager.reconcile()
+
+    repaired, balances, drift = run(scenario())
+    assert sorted(row[0] for row in repaired) == [3, 7]
+    assert all(balance == 110_000 for _, balance in balances)
+    assert drift == []